@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# title: library interface of dsub
+#
+# For tools that check, plan or submit productions without going through the
+# dsub command line:
+#
+#   import api
+#   userPara = api.parseConfig('job.cfg')
+#   errors = api.checkConfig(userPara)
+#   jobs = api.planJobs(userPara, username='yant')
+#   files = api.renderJob(userPara, jobs[0], api.loadTemplates(userPara))
+#   summary = api.submit(userPara)
+#   summaries = api.submitAll([api.parseConfig(cfg) for cfg in ['a.cfg', 'b.cfg']])
+#   job = api.lookupJob(summary['masterDir'], jobID)
+#
+# Nothing here imports DIRAC. The backend does that on first use, i.e. when
+# submit() runs or planJobs() has to look up the username in the proxy.
+import os, os.path
+import dsub, discovery, repository
+
+
+class ConfigError(Exception):
+    pass
+
+
+def parseConfig(cfg_file):
+    """Read a job cfg file into the userPara dict, with the defaults filled in."""
+    if not os.path.isfile(cfg_file):
+        raise ConfigError('%s is not a job cfg file.' % cfg_file)
+    return dsub.getUserPara(cfg_file)
+
+def checkConfig(userPara):
+    """Return the list of problems with userPara, empty if it can be submitted."""
+    return dsub.validateUserPara(userPara)
+
+def findInputs(userPara):
+    """Return the (filepath, size, filename) tuples of the input files in the
+    order dsub numbers their jobs: depth first in sorted order under input_dir,
+    in order of first appearance in input_filelist.
+    """
+    if userPara.has_key('input_filelist'):
+        return discovery.readFilelist(userPara['input_filelist'], userPara['discovery_threads'])[0]
+    if userPara.has_key('input_dir'):
+        return list(discovery.iterStdhep(userPara['input_dir'], userPara['discovery_threads'],\
+                                            userPara['index_dir']))
+    raise ConfigError('Neither input_dir nor input_filelist is given.')
+
+def planJobs(userPara, inputDataList=None, username=None):
+    """Return one dict per job of the production, in submission order:
+    inputFile, filename, size, batch, batchStr, evtStart, evtmax and
+    outputData. Without a username it is taken from the proxy. With
+    target_walltime the jobs are sized from the event counts of the files.
+    """
+    if inputDataList is None:
+        inputDataList = findInputs(userPara)
+    if username is None:
+        dsub.selectBackend(userPara)
+    dfcprefix = dsub.getDFCprefix(username)
+    eventCounts = dsub.getEventCounts(userPara, inputDataList)
+    jobs = []
+    for filepath, size, filename in inputDataList:
+        name_wo_ext = os.path.splitext(filename)[0]
+        for batch, batchStr, evtStart, evtmax in dsub.getFileBatches(userPara, filepath, eventCounts):
+            jobs.append({'inputFile': filepath, 'filename': filename, 'size': size, 'batch': batch,\
+                            'batchStr': batchStr, 'evtStart': evtStart, 'evtmax': evtmax,\
+                            'outputData': dsub.getOutputData(userPara, dfcprefix, name_wo_ext, batchStr)})
+    return jobs
+
+def loadTemplates(userPara):
+    """Compile the event.macro, simu.macro and reco.xml of work_dir once."""
+    work_dir = userPara['work_dir']
+    return (dsub.prepareEvtMacro(work_dir), dsub.prepareSimuMacro(work_dir), dsub.prepareRecoXML(work_dir))
+
+def renderJob(userPara, job, compiled):
+    """Return {filename: content} of job.py and the macros of a planned job."""
+    evtMacroTemp, simuMacroTemp, recoXML = compiled
+    name_wo_ext = os.path.splitext(job['filename'])[0]
+    jobPara = dsub.getScriptPara(userPara)
+    jobArgs = {'inputFile': job['filename'], 'batchStr': job['batchStr'], 'evtStart': job['evtStart'],\
+                'evtmax': str(job['evtmax']), 'sim': job['outputData'][0], 'rec': job['outputData'][1]}
+    return {'job.py': dsub.renderJobScript(jobPara, jobArgs),
+            'event.macro': dsub.renderEvtMacro(evtMacroTemp, job['evtmax'], job['filename']),
+            'simu.macro': dsub.renderSimuMacro(simuMacroTemp, name_wo_ext, job['batchStr'], job['evtStart']),
+            'reco.xml': dsub.renderRecoXML(recoXML, name_wo_ext, job['batchStr'])}
+
+def submit(userPara, resumeDir=None):
+    """Submit a production, or resume the one in resumeDir. Returns a dict with
+    masterDir, totalFiles, filesOK, totalJobs and jobsOK.
+    """
+    errors = checkConfig(userPara)
+    if errors:
+        raise ConfigError('; '.join(errors))
+    return dsub.splitAndSubmit(userPara, resumeDir)
+
+def submitAll(userParaList):
+    """Submit several productions through one submit pool, the jobs of each
+    taking their turn. Nothing is submitted unless every config is fine.
+    Returns one summary dict per production, as submit() does.
+    """
+    errors = []
+    for i, userPara in enumerate(userParaList):
+        errors.extend(['production %d: %s' %(i + 1, error) for error in checkConfig(userPara)])
+    if len(set([userPara.get('backend', 'dirac') for userPara in userParaList])) > 1:
+        errors.append('the productions should all use the same backend')
+    if errors:
+        raise ConfigError('; '.join(errors))
+    return dsub.submitProductions(userParaList)
+
+def lookupJob(masterDir, jobID):
+    """Return the job number, input file, batch and LFNs of a DIRAC job ID of
+    the production in masterDir, None if it is not one of its jobs or
+    masterDir has no manifest.
+    """
+    if not os.path.isfile(os.path.join(masterDir, repository.manifestName)):
+        return None
+    manifest = repository.Manifest(masterDir, readOnly=True)
+    try:
+        return manifest.lookup(jobID)
+    finally:
+        manifest.close()
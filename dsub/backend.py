@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# title: pluggable grid backends for dsub
+#
+# dsub reaches the catalog, the WMS and the proxy only through the active
+# backend:
+#   getProxyInfo(), FileCatalogClient(), ReplicaManager(), Dirac(), Job()
+# 'dirac' (the default) imports DIRAC when it is first used. 'local' is an
+# in-process stand-in with configurable latency and failure injection, for
+# dry runs and benchmarks without a DIRAC installation.
+import os.path, time, random, threading
+import localcatalog
+from localcatalog import S_OK, S_ERROR
+
+diracInitialized = False
+
+
+def initDIRAC(switches=None, ignoreErrors=True):
+    """Parse the command line with DIRAC's Script once, registering the given
+    [(short, long, help)] switches first. Returns the Script module.
+    """
+    global diracInitialized
+    from DIRAC.Core.Base import Script
+    if not diracInitialized:
+        for short, long, help in (switches or []):
+            Script.registerSwitch(short, long, help)
+        Script.parseCommandLine( ignoreErrors = ignoreErrors )
+        diracInitialized = True
+    return Script
+
+
+class DiracBackend(object):
+
+    name = 'dirac'
+
+    def __init__(self):
+        initDIRAC()
+        from DIRAC.Core.Security.ProxyInfo import getProxyInfo
+        from DIRAC.Interfaces.API.Job import Job
+        from DIRAC.Interfaces.API.Dirac import Dirac
+        from DIRAC.Resources.Catalog.FileCatalogClient import FileCatalogClient
+        from DIRAC.DataManagementSystem.Client.ReplicaManager import ReplicaManager
+        self._getProxyInfo = getProxyInfo
+        self._Job = Job
+        self._Dirac = Dirac
+        self._FileCatalogClient = FileCatalogClient
+        self._ReplicaManager = ReplicaManager
+
+    def getProxyInfo(self):
+        return self._getProxyInfo()
+
+    def FileCatalogClient(self):
+        return self._FileCatalogClient('DataManagement/FileCatalog')
+
+    def ReplicaManager(self):
+        return self._ReplicaManager()
+
+    def Dirac(self):
+        return self._Dirac()
+
+    def Job(self):
+        return self._Job()
+
+
+class LocalJob(object):
+    # records what dsub sets on a DIRAC Job
+
+    def __init__(self):
+        self.attributes = {}
+
+    def _set(self, key, value):
+        self.attributes[key] = value
+
+    def setName(self, name):
+        self._set('Name', name)
+
+    def setJobGroup(self, group):
+        self._set('JobGroup', group)
+
+    def setExecutable(self, executable, arguments='', logFile=''):
+        self._set('Executable', executable)
+        self._set('Arguments', arguments)
+        self._set('StdOutput', logFile)
+
+    def setInputSandbox(self, files):
+        self._set('InputSandbox', list(files))
+
+    def setOutputSandbox(self, files):
+        self._set('OutputSandbox', list(files))
+
+    def setOutputData(self, lfns, outputSE=None):
+        self._set('OutputData', list(lfns))
+        self._set('OutputSE', outputSE)
+
+    def setDestination(self, sites):
+        self._set('Site', sites)
+
+    def setCPUTime(self, cpuTime):
+        self._set('CPUTime', cpuTime)
+
+    def setNumberOfProcessors(self, numberOfProcessors):
+        self._set('NumberOfProcessors', numberOfProcessors)
+        self._set('Tags', ['MultiProcessor', '%dProcessors' %numberOfProcessors])
+
+    def setGenericParametricInput(self, parameters):
+        self._set('Parameters', list(parameters))
+
+
+class LocalDirac(object):
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def submit(self, job):
+        b = self.backend
+        if b.latency:
+            time.sleep(b.latency)
+        b.lock.acquire()
+        try:
+            if b.failureRate and b.random.random() < b.failureRate:
+                b.failures += 1
+                return S_ERROR('Injected submission failure')
+            for path in job.attributes.get('InputSandbox', []):
+                if not path.startswith('LFN:') and not os.path.exists(path):
+                    return S_ERROR('Input sandbox file %s does not exist' %path)
+            ids = []
+            for parameter in job.attributes.get('Parameters', [None]):
+                b.lastJobID += 1
+                ids.append(b.lastJobID)
+                b.jobs[b.lastJobID] = dict(job.attributes, Parameter=parameter, Status='Waiting')
+        finally:
+            b.lock.release()
+        if job.attributes.has_key('Parameters'):
+            return S_OK(ids)
+        return S_OK(ids[0])
+
+    def selectJobs(self, owner=None, jobGroup=None, date=None, status=None):
+        b = self.backend
+        b.lock.acquire()
+        try:
+            ids = [str(jobID) for jobID, job in sorted(b.jobs.items())\
+                    if (jobGroup is None or job.get('JobGroup') == jobGroup)\
+                    and (status is None or job['Status'] == status)]
+        finally:
+            b.lock.release()
+        return S_OK(ids)
+
+    def status(self, jobIDs):
+        # as Dirac().status(), a job sent to several sites is at 'ANY' until it runs
+        return self._summaries(jobIDs, ['Status', 'MinorStatus', 'Site'])
+
+    def getJobJDL(self, jobID):
+        b = self.backend
+        if b.latency:
+            time.sleep(b.latency)
+        b.lock.acquire()
+        try:
+            job = b.jobs.get(int(jobID))
+            if job is None:
+                return S_ERROR('Job %s not found' %jobID)
+            jdl = {'Executable': job.get('Executable'), 'JobGroup': job.get('JobGroup')}
+            if job.get('Site'):
+                jdl['Site'] = job['Site']
+            return S_OK(jdl)
+        finally:
+            b.lock.release()
+
+    def getJobSummary(self, jobIDs):
+        return self._summaries(jobIDs, ['Status', 'MinorStatus', 'ApplicationStatus', 'Site', 'JobGroup', 'JobName'])
+
+    def _summaries(self, jobIDs, keys):
+        b = self.backend
+        if b.latency:
+            time.sleep(b.latency)
+        result = {}
+        b.lock.acquire()
+        try:
+            if b.failureRate and b.random.random() < b.failureRate:
+                b.failures += 1
+                return S_ERROR('Injected monitoring failure')
+            for jobID in jobIDs:
+                job = b.jobs.get(int(jobID))
+                if job is None:
+                    continue
+                sites = job.get('Site') or ['ANY']
+                if isinstance(sites, basestring):
+                    sites = [sites]
+                summary = {'Status': job['Status'], 'MinorStatus': job.get('MinorStatus', ''),\
+                            'ApplicationStatus': job.get('ApplicationStatus', 'Unknown'),\
+                            'Site': len(sites) == 1 and sites[0] or 'ANY', 'JobGroup': job.get('JobGroup'),\
+                            'JobName': job.get('Name')}
+                result[int(jobID)] = dict((key, summary[key]) for key in keys)
+        finally:
+            b.lock.release()
+        return S_OK(result)
+
+
+class LocalBackend(object):
+
+    name = 'local'
+
+    def __init__(self, latency=0.0, failureRate=0.0, seed=None, username='dryrun'):
+        self.latency = latency
+        self.failureRate = failureRate
+        self.random = random.Random(seed)
+        self.username = username
+        self.lock = threading.Lock()
+        self.catalog = localcatalog.LocalFileCatalog(latency, failureRate, seed)
+        self.jobs = {}
+        self.lastJobID = 0
+        self.failures = 0
+
+    def getProxyInfo(self):
+        return S_OK({'username': self.username, 'group': 'cepc_user'})
+
+    def FileCatalogClient(self):
+        return self.catalog
+
+    def ReplicaManager(self):
+        return localcatalog.LocalReplicaManager(self.catalog)
+
+    def Dirac(self):
+        return LocalDirac(self)
+
+    def Job(self):
+        return LocalJob()
+
+
+backends = {'dirac': DiracBackend, 'local': LocalBackend}
+_current = None
+
+def setBackend(backend, **kwargs):
+    """Make a backend instance, or the name of one in backends, the active one."""
+    global _current
+    if isinstance(backend, basestring):
+        backend = backends[backend](**kwargs)
+        backend.settings = kwargs
+    _current = backend
+    return backend
+
+def select(name, **kwargs):
+    """Make a backend of the given name the active one, keeping the active one
+    when it is of that name and was made with the same settings.
+    """
+    if _current is None or _current.name != name or getattr(_current, 'settings', None) != kwargs:
+        setBackend(name, **kwargs)
+    return _current
+
+def reset():
+    global _current
+    _current = None
+
+def get():
+    if _current is None:
+        setBackend('dirac')
+    return _current
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# title: end-to-end submission benchmark for dsub
+# usage: python benchmark.py [-n 10,100] [-m 1,4] [--latency 0.005] [--failure-rate 0.01]
+#                            [--workers 4] [--sandbox shared] [--parametric] [--walltime 1500] [--slice] [--keep]
+#
+# Generates a synthetic tree of .stdhep files and a work_dir with templates in
+# a temporary directory, runs splitAndSubmit against the local backend for
+# every N files x M batches and reports the time spent per stage and the
+# submitted jobs per second.
+import sys, os, os.path, time, shutil, tempfile
+from optparse import OptionParser
+import backend, dsub, stats, retry, stdhep
+
+stages = ['discoverInputData', 'getEventCounts', 'sliceInputData', 'registerInputData', 'cleanOutputData', 'generateJobFiles', 'generateJobScript', 'submitJob']
+
+evtMacro = """\
+/generator/generator input.stdhep
+/run/beamOn 10
+"""
+
+simuMacro = """\
+/Mokka/init/detectorModel CEPC_v1
+/Mokka/init/dbHost 202.114.78.211
+/Mokka/init/initialMacroFile event.macro
+/Mokka/init/lcioFilename output.slcio
+/Mokka/init/randomSeed 1
+"""
+
+recoXML = """\
+<marlin>
+ <execute>
+  <processor name="MyMarlinPandora"/>
+  <processor name="MyLCIOOutputProcessor"/>
+ </execute>
+ <global>
+  <parameter name="LCIOInputFiles"> input.slcio </parameter>
+ </global>
+ <processor name="MyMarlinPandora" type="PandoraPFANewProcessor">
+  <parameter name="PandoraSettingsXmlFile" type="String">PandoraSettings.xml</parameter>
+ </processor>
+ <processor name="MyLCIOOutputProcessor" type="LCIOOutputProcessor">
+  <parameter name="LCIOOutputFile" type="string"> output.slcio </parameter>
+ </processor>
+</marlin>
+"""
+
+pandoraSettings = """\
+<pandora>
+ <algorithm type="PhotonReconstruction">
+  <HistogramFile>PandoraLikelihoodData.xml</HistogramFile>
+ </algorithm>
+</pandora>
+"""
+
+
+def writeFile(path, content):
+    f = open(path, 'w')
+    f.write(content)
+    f.close()
+
+def makeWorkDir(root):
+    work_dir = os.path.join(root, 'work')
+    os.mkdir(work_dir)
+    writeFile(os.path.join(work_dir, 'event.macro'), evtMacro)
+    writeFile(os.path.join(work_dir, 'simu.macro'), simuMacro)
+    writeFile(os.path.join(work_dir, 'reco.xml'), recoXML)
+    writeFile(os.path.join(work_dir, 'PandoraSettingsDefault.xml'), pandoraSettings)
+    writeFile(os.path.join(work_dir, 'PandoraLikelihoodData9EBin.xml'), '<likelihood/>\n')
+    return work_dir
+
+eventsPerFile = 100
+
+def makeInputTree(root, nfiles, size, filesPerDir=100, events=False):
+    input_dir = os.path.join(root, 'cefs', 'data', 'sample')
+    for i in range(nfiles):
+        dirpath = os.path.join(input_dir, 'part%03d' %(i // filesPerDir))
+        if not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        f = open(os.path.join(dirpath, 'sample_%06d.stdhep' %i), 'wb')
+        stdhep.writeHeader(f, eventsPerFile)
+        if events:
+            # real event records, for slicing
+            for n in range(eventsPerFile):
+                stdhep.writeEvent(f, n, os.urandom(size // eventsPerFile))
+        else:
+            f.write(os.urandom(size))
+        f.close()
+    return input_dir
+
+def writeCfg(root, input_dir, work_dir, nbatch, options):
+    evtmax = 100
+    if options.slice:
+        # the batches share the events of a file, a slice past its end gets no job
+        evtmax = max(1, eventsPerFile // nbatch)
+    lines = ['input_dir = %s' %input_dir,
+             'output_dir = benchmark/output',
+             'evtmax = %d' %evtmax,
+             'batch = %d' %nbatch,
+             'work_dir = %s' %work_dir,
+             'repo_dir = %s' %root,
+             'index_dir = %s' %os.path.join(root, 'index'),
+             'lfn_cache = %s' %os.path.join(root, 'registered.json'),
+             'backend = local',
+             'local_latency = %f' %options.latency,
+             'local_failure_rate = %f' %options.failureRate,
+             'submit_workers = %d' %options.workers,
+             'sandbox = %s' %options.sandbox,
+             'parametric = %s' %(options.parametric and 'yes' or 'no')]
+    if options.walltime:
+        lines.append('target_walltime = %d' %options.walltime)
+    if options.slice:
+        lines.append('slice_inputs = yes')
+        lines.append('slice_dir = %s' %os.path.join(root, 'cefs', 'slices'))
+    cfg_file = os.path.join(root, 'job.cfg')
+    writeFile(cfg_file, '\n'.join(lines) + '\n')
+    return cfg_file
+
+
+def runOne(nfiles, nbatch, options):
+    root = tempfile.mkdtemp(prefix='dsub-benchmark-')
+    try:
+        work_dir = makeWorkDir(root)
+        input_dir = makeInputTree(root, nfiles, options.size, events=options.slice)
+        cfg_file = writeCfg(root, input_dir, work_dir, nbatch, options)
+        userPara = dsub.getUserPara(cfg_file)
+        # a backend of its own, the jobs of the run are counted in it
+        backend.reset()
+        localBackend = dsub.selectBackend(userPara)
+        runStats = stats.reset()
+        retry.reset()
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        start = time.time()
+        try:
+            dsub.splitAndSubmit(userPara)
+        finally:
+            elapsed = time.time() - start
+            sys.stdout.close()
+            sys.stdout = stdout
+        njobs = len(localBackend.jobs)
+        expected = nfiles * nbatch
+        if options.walltime:
+            expected = nfiles * len(stdhep.splitEvents(eventsPerFile, 0, dsub.getEventsPerJob(userPara)))
+        print '%d files x %d batches: %d of %d jobs submitted in %.3f s, %.1f jobs/s' %(nfiles, nbatch,\
+                njobs, expected, elapsed, njobs / max(elapsed, 1e-6))
+        summary = runStats.summary()
+        for name in stages:
+            stage = summary['stages'].get(name)
+            if stage:
+                print '    %-20s %8d calls %10.3f s  p50 <= %.3f s  p99 <= %.3f s' %(name, stage['calls'],\
+                        stage['total'], stage['p50'], stage['p99'])
+        for name, value in sorted(summary['counters'].items()):
+            print '    %-20s %8d' %(name, value)
+        for name, counters in sorted(retry.summary().items()):
+            print '    %-20s %8d calls %10d retries %6d gave up %8.1f s slept' %(name + ' retry', counters['calls'],\
+                    counters['retries'], counters['gaveUp'], counters['slept'])
+        print '    %-20s %8d calls %10d failures injected' %('catalog', localBackend.catalog.calls,\
+                localBackend.catalog.failures)
+        return elapsed, njobs
+    finally:
+        if options.keep:
+            print '    kept %s' %root
+        else:
+            shutil.rmtree(root)
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--files', default='10,100', help='comma separated numbers of input files')
+    parser.add_option('-m', '--batches', default='1,4', help='comma separated numbers of batches per file')
+    parser.add_option('--size', type='int', default=4096, help='bytes per synthetic .stdhep file')
+    parser.add_option('--latency', type='float', default=0.0, help='seconds per catalog and WMS call')
+    parser.add_option('--failure-rate', dest='failureRate', type='float', default=0.0,\
+                        help='fraction of catalog and WMS calls that fail')
+    parser.add_option('--workers', type='int', default=1, help='submit_workers')
+    parser.add_option('--sandbox', default='job', help='job or shared')
+    parser.add_option('--parametric', action='store_true', default=False)
+    parser.add_option('--walltime', type='int', default=0, help='target_walltime, split files by event count')
+    parser.add_option('--slice', action='store_true', default=False, help='slice_inputs, one input file per job')
+    parser.add_option('--keep', action='store_true', default=False, help='keep the generated directories')
+    options, args = parser.parse_args()
+    for nfiles in [int(n) for n in options.files.split(',')]:
+        for nbatch in [int(m) for m in options.batches.split(',')]:
+            runOne(nfiles, nbatch, options)
+
+if __name__ == '__main__':
+    main()
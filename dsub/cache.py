@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# title: caches for dsub
+#
+# TTLCache memoizes values in the process, e.g. the proxy info that used to
+# be decoded for every getUsername(). RegisteredCache remembers on disk which
+# input files are registered in the DFC, keyed by path, size and mtime, so a
+# resubmission of the same sample does not query the catalog again. Entries
+# expire after a TTL, and a file that changed is registered again.
+#
+# The productions of one process share one RegisteredCache per path, see
+# getRegisteredCache(). A save merges its changes into what is on disk at
+# that moment, so other dsub processes writing the same file keep theirs.
+#
+# ClientPool lends clients that must not be used by two threads at once,
+# creating them as needed up to a maximum and waiting for one beyond that.
+import os, os.path, time, json, tempfile, threading, Queue
+
+defaultRegisteredCache = os.path.join(os.path.expanduser('~'), '.dsub', 'registered.json')
+defaultRegisteredTTL = 7 * 86400
+
+
+class TTLCache(object):
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def get(self, key, compute):
+        # the cached value of key, compute() it if missing or expired
+        self.lock.acquire()
+        try:
+            item = self.values.get(key)
+            if item and time.time() - item[0] < self.ttl:
+                return item[1]
+        finally:
+            self.lock.release()
+        value = compute()
+        self.lock.acquire()
+        self.values[key] = (time.time(), value)
+        self.lock.release()
+        return value
+
+    def invalidate(self, key=None):
+        # forget key, or everything
+        self.lock.acquire()
+        if key is None:
+            self.values.clear()
+        else:
+            self.values.pop(key, None)
+        self.lock.release()
+
+
+class ClientPool(object):
+
+    def __init__(self, create, size):
+        self.create = create
+        self.size = max(1, size)
+        self.lock = threading.Lock()
+        self.created = 0
+        self.idle = Queue.Queue()
+
+    def acquire(self):
+        # an idle client, a new one while fewer than size exist
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            pass
+        self.lock.acquire()
+        try:
+            canCreate = self.created < self.size
+            if canCreate:
+                self.created += 1
+        finally:
+            self.lock.release()
+        if not canCreate:
+            return self.idle.get()
+        try:
+            return self.create()
+        except:
+            self.lock.acquire()
+            self.created -= 1
+            self.lock.release()
+            raise
+
+    def release(self, client):
+        self.idle.put(client)
+
+
+def readJson(path):
+    # the json value in path, None if it is missing or broken
+    try:
+        f = open(path)
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return None
+
+def writeJson(path, value):
+    # replace path atomically, through a temporary file of its own
+    dirpath = os.path.dirname(path)
+    if dirpath and not os.path.isdir(dirpath):
+        try:
+            os.makedirs(dirpath)
+        except OSError:
+            if not os.path.isdir(dirpath):
+                raise
+    fd, tmp = tempfile.mkstemp(dir=dirpath or '.', prefix=os.path.basename(path) + '.')
+    try:
+        f = os.fdopen(fd, 'w')
+        try:
+            json.dump(value, f)
+        finally:
+            f.close()
+        os.chmod(tmp, 0644)
+        os.rename(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class RegisteredCache(object):
+
+    def __init__(self, path=defaultRegisteredCache, ttl=defaultRegisteredTTL):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+        # changes since the last save, None for a removed entry
+        self.changes = {}
+        self.cleared = False
+        self.load()
+
+    def load(self):
+        self.entries = readJson(self.path) or {}
+
+    def lookup(self, filepath, size, mtime):
+        # the LFN filepath was registered as, if size and mtime still match
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(filepath.decode('utf-8', 'replace'))
+        finally:
+            self.lock.release()
+        if not entry:
+            return None
+        lfn, esize, emtime, registeredAt = entry
+        if esize != size or emtime != mtime or time.time() - registeredAt > self.ttl:
+            return None
+        return lfn.encode('utf-8')
+
+    def add(self, filepath, size, mtime, lfn):
+        key = filepath.decode('utf-8', 'replace')
+        self.lock.acquire()
+        self.entries[key] = self.changes[key] = [lfn, size, mtime, time.time()]
+        self.lock.release()
+
+    def invalidate(self, filepaths=None):
+        # forget the given files, or everything
+        self.lock.acquire()
+        if filepaths is None:
+            self.entries = {}
+            self.changes = {}
+            self.cleared = True
+        else:
+            for filepath in filepaths:
+                key = filepath.decode('utf-8', 'replace')
+                self.entries.pop(key, None)
+                self.changes[key] = None
+        self.lock.release()
+
+    def save(self):
+        self.lock.acquire()
+        try:
+            if not (self.changes or self.cleared):
+                return
+            # merged into the file as it is now, another process may have added to it
+            entries = {}
+            if not self.cleared:
+                entries = readJson(self.path) or {}
+            for key, entry in self.changes.items():
+                if entry is None:
+                    entries.pop(key, None)
+                else:
+                    entries[key] = entry
+            now = time.time()
+            for key, entry in entries.items():
+                if now - entry[3] > self.ttl:
+                    del entries[key]
+            writeJson(self.path, entries)
+            self.entries = entries
+            self.changes = {}
+            self.cleared = False
+        finally:
+            self.lock.release()
+
+
+_registeredCaches = {}
+_registeredLock = threading.Lock()
+
+def getRegisteredCache(path=defaultRegisteredCache, ttl=defaultRegisteredTTL):
+    """Return the RegisteredCache of path shared by the whole process."""
+    _registeredLock.acquire()
+    try:
+        regCache = _registeredCaches.get(path)
+        if regCache is None:
+            regCache = _registeredCaches[path] = RegisteredCache(path, ttl)
+        regCache.ttl = min(regCache.ttl, ttl)
+        return regCache
+    finally:
+        _registeredLock.release()
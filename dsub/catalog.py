@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# title: bulk DFC helpers for dsub
+#
+# The DFC calls isFile, removeCatalogFile and addFile all accept a list (or a
+# dict) of LFNs, so input data is registered chunk by chunk with one shared
+# client instead of one round trip per file. Stale output files are found by
+# listing each output directory once and removed chunk by chunk.
+import uuid, os.path
+import retry
+
+inputLFNPrefix = '/cepc/lustre-ro'
+defaultChunkSize = 500
+maxRepeatTimes = 10
+
+# shared by every DFC call of this process, so a failing catalog pauses all of them
+dfcBreaker = retry.CircuitBreaker('dfc', threshold=5, resetTimeout=30.0)
+dfcPolicy = retry.RetryPolicy('dfc', attempts=maxRepeatTimes, base=0.5, maxDelay=30.0, deadline=600.0,\
+                                breaker=dfcBreaker)
+
+
+def chunks(items, size):
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+def newGUID():
+    return str(uuid.uuid4())
+
+def inputLFN(filepath):
+    return inputLFNPrefix + filepath
+
+def _pending(lfns, done):
+    return [lfn for lfn in lfns if lfn not in done]
+
+def _queryChunk(fcc, lfns, results, policy):
+    status = {}
+    def query():
+        is_registered = fcc.isFile(_pending(lfns, status))
+        if is_registered['OK']:
+            status.update(is_registered['Value']['Successful'])
+        return is_registered
+    is_registered = policy.call(query, lambda result: not _pending(lfns, status))
+    for lfn in _pending(lfns, status):
+        results[lfn]['is_registered'] = 'querry error. unkown'
+        print 'Failed to query %s in DFC. Error message is %s' %(lfn, is_registered.get('Message', ''))
+    return status
+
+def _removeChunk(rm, lfns, results, policy):
+    removed = set()
+    def remove():
+        is_removed = rm.removeCatalogFile(_pending(lfns, removed))
+        if is_removed['OK']:
+            for lfn, value in is_removed['Value']['Successful'].items():
+                if value.get('FileCatalog'):
+                    removed.add(lfn)
+        return is_removed
+    policy.call(remove, lambda result: not _pending(lfns, removed))
+    for lfn in lfns:
+        if lfn in removed:
+            results[lfn]['is_removed'] = True
+        else:
+            results[lfn]['is_removed'] = 'remove error'
+            print 'Failed to remove %s from DFC.' %lfn
+
+def _addChunk(fcc, fileDict, results, policy):
+    added = set()
+    messages = {}
+    def add():
+        is_added = fcc.addFile(dict((lfn, info) for lfn, info in fileDict.items() if lfn not in added))
+        if is_added['OK']:
+            for lfn, value in is_added['Value']['Successful'].items():
+                if value:
+                    added.add(lfn)
+            for lfn, value in is_added['Value']['Failed'].items():
+                messages[lfn] = 'Failed to add file' + lfn
+        return is_added
+    is_added = policy.call(add, lambda result: not _pending(fileDict, added))
+    for lfn in fileDict:
+        if lfn in added:
+            results[lfn]['OK'] = True
+        else:
+            results[lfn]['OK'] = False
+            results[lfn]['Message'] = messages.get(lfn) or is_added.get('Message') or 'Failed to add file' + lfn
+
+def registerInputDataBulk(inputDataList, fcc, rm, se='IHEP-STORM', chunkSize=defaultChunkSize, policy=dfcPolicy):
+    """Register (filepath, size, ...) tuples in the DFC, re-adding the ones that
+    already exist. Returns a dict mapping each filepath to its result dict.
+    """
+    results = {}
+    byPath = {}
+    fileDict = {}
+    for item in inputDataList:
+        filepath, size = item[0], item[1]
+        lfn = inputLFN(filepath)
+        if lfn in fileDict:
+            byPath[filepath] = results[lfn]
+            continue
+        results[lfn] = {'lfn': lfn, 'is_registered': False}
+        byPath[filepath] = results[lfn]
+        fileDict[lfn] = {'PFN': '', 'Size': size, 'SE': se, 'GUID': newGUID(), 'Checksum': ''}
+
+    for lfns in chunks(fileDict.keys(), chunkSize):
+        status = _queryChunk(fcc, lfns, results, policy)
+        registered = [lfn for lfn in lfns if status.get(lfn)]
+        for lfn in registered:
+            results[lfn]['is_registered'] = True
+        if registered:
+            _removeChunk(rm, registered, results, policy)
+        _addChunk(fcc, dict((lfn, fileDict[lfn]) for lfn in lfns), results, policy)
+    return byPath
+
+def _listChunk(fcc, dirs, listing, policy):
+    def query():
+        is_listed = fcc.listDirectory(_pending(dirs, listing))
+        if is_listed['OK']:
+            for path, content in is_listed['Value']['Successful'].items():
+                listing[path] = set(content.get('Files', {}).keys())
+            for path, message in is_listed['Value']['Failed'].items():
+                # a directory that does not exist yet holds no stale files
+                if 'No such file or directory' in str(message) or 'does not exist' in str(message):
+                    listing[path] = set()
+        return is_listed
+    is_listed = policy.call(query, lambda result: not _pending(dirs, listing))
+    for path in _pending(dirs, listing):
+        print 'Failed to list %s in DFC. Error message is %s' %(path, is_listed.get('Message', ''))
+
+def cleanOutputData(lfns, fcc, rm, chunkSize=defaultChunkSize, policy=dfcPolicy, listing=None):
+    """Remove the LFNs that are already registered, listing every directory
+    of them once. Returns a dict with the 'stale' LFNs found, the ones
+    'removed', and the 'unlisted' directories that could not be checked.
+    A listing {directory: set of LFNs} kept from an earlier call for other
+    LFNs of the same production saves listing its directories again.
+    """
+    dirs = sorted(set([os.path.dirname(lfn) for lfn in lfns]))
+    if listing is None:
+        listing = {}
+    for part in chunks(_pending(dirs, listing), chunkSize):
+        _listChunk(fcc, part, listing, policy)
+    stale = [lfn for lfn in lfns if lfn in listing.get(os.path.dirname(lfn), ())]
+    results = dict((lfn, {'lfn': lfn}) for lfn in stale)
+    for part in chunks(stale, chunkSize):
+        _removeChunk(rm, part, results, policy)
+    return {'stale': stale, 'removed': [lfn for lfn in stale if results[lfn]['is_removed'] is True],
+            'unlisted': [path for path in dirs if not listing.has_key(path)]}
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# title: Mokka DB mirror selection and admission for job.py
+# usage: python dbmirror.py [njobs] [capacity]
+#
+# Shipped in the input sandbox with job.py. Every configured mirror is probed
+# with a MySQL login as Mokka's DB user, closed with COM_QUIT, which tells a
+# healthy server from one that is out of connections (error packet) or
+# unreachable. A probe that hung up in the middle of the handshake would
+# count as an aborted connect towards the server's max_connect_errors, and
+# enough of them block the host of the job. The job starts Mokka against the
+# fastest healthy mirror, and only waits, with jittered backoff, while all
+# of them are busy, instead of sleeping for a random time up to 15 minutes.
+#
+# Run as a script it compares both strategies against local stand-in DBs.
+import sys, time, random, socket, struct, threading
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+import retry
+
+defaultPort = 3306
+defaultMirrors = ['202.114.78.211', '202.122.37.75']
+defaultMaxWait = 900
+probeTimeout = 5.0
+# Mokka's own defaults, unless simu.macro sets /Mokka/init/user and /Mokka/init/dbPasswd
+defaultCredentials = ('consult', 'consult')
+# error codes of a server that is up but has no connection to spare
+busyCodes = [1040, 1203, 1226]
+# client capabilities: long password, protocol 4.1, 4.1 authentication
+clientFlags = 0x0001 | 0x0200 | 0x8000
+
+
+def parseMirror(mirror):
+    # 'host' or 'host:port' -> (host, port)
+    host, sep, port = mirror.partition(':')
+    return host, int(port or defaultPort)
+
+def isMirror(mirror):
+    # True for a 'host' or 'host:port' Mokka can be pointed at
+    host, sep, port = mirror.partition(':')
+    if not host or (sep and not (port.isdigit() and 0 < int(port) < 65536)):
+        return False
+    return True
+
+def readCredentials(macro='simu.macro'):
+    # (user, password) Mokka logs in with
+    user, password = defaultCredentials
+    try:
+        f = open(macro)
+        try:
+            for line in f:
+                words = line.split()
+                if len(words) > 1 and words[0] == '/Mokka/init/user':
+                    user = words[1]
+                elif len(words) > 1 and words[0] == '/Mokka/init/dbPasswd':
+                    password = words[1]
+        finally:
+            f.close()
+    except IOError:
+        pass
+    return user, password
+
+def _recv(s, n):
+    data = ''
+    while len(data) < n:
+        chunk = s.recv(n - len(data))
+        if not chunk:
+            raise socket.error('connection closed by the server')
+        data += chunk
+    return data
+
+def readPacket(s):
+    # -> (sequence number, payload) of a MySQL packet
+    header = _recv(s, 4)
+    (length,) = struct.unpack('<I', header[:3] + '\0')
+    return ord(header[3]), _recv(s, length)
+
+def writePacket(s, seq, payload):
+    s.sendall(struct.pack('<I', len(payload))[:3] + chr(seq % 256) + payload)
+
+def scramble(password, seed):
+    # the mysql_native_password answer to the seed of the server
+    if not password:
+        return ''
+    stage1 = sha1(password).digest()
+    mix = sha1(seed + sha1(stage1).digest()).digest()
+    return ''.join([chr(ord(a) ^ ord(b)) for a, b in zip(stage1, mix)])
+
+def _seed(greeting):
+    # the 20 bytes of authentication data of a protocol 10 greeting
+    pos = greeting.index('\0', 1) + 1 + 4
+    seed = greeting[pos:pos + 8]
+    pos += 8 + 1 + 2 + 1 + 2 + 2 + 1 + 10
+    return seed + greeting[pos:pos + 12]
+
+def _errorState(payload):
+    (code,) = struct.unpack('<H', payload[1:3])
+    if code in busyCodes:
+        return 'busy'
+    return 'down'
+
+def login(s, credentials=defaultCredentials):
+    """Log in on the connected socket s. Returns 'ok', 'busy' or 'down', and
+    whether the session is open and has to be ended with logout().
+    """
+    user, password = credentials
+    seq, greeting = readPacket(s)
+    if greeting[:1] == '\xff':
+        return _errorState(greeting), False
+    if greeting[:1] != '\x0a':
+        return 'down', False
+    response = struct.pack('<IIB23x', clientFlags, 1 << 24, 33) + user + '\0'
+    answer = scramble(password, _seed(greeting))
+    writePacket(s, seq + 1, response + chr(len(answer)) + answer)
+    seq, reply = readPacket(s)
+    if reply[:1] == '\xfe' and len(reply) > 1:
+        # the server asks for the answer to a new seed
+        plugin, sep, seed = reply[1:].partition('\0')
+        if plugin != 'mysql_native_password':
+            return 'ok', False
+        writePacket(s, seq + 1, scramble(password, seed[:20]))
+        seq, reply = readPacket(s)
+    if reply[:1] == '\xff':
+        return _errorState(reply), False
+    return 'ok', reply[:1] == '\x00'
+
+def logout(s):
+    # COM_QUIT, a clean end of the session for the server
+    writePacket(s, 0, '\x01')
+
+def probe(mirror, timeout=probeTimeout, credentials=defaultCredentials):
+    """Return (state, seconds) of a mirror, state one of 'ok', 'busy', 'down'."""
+    host, port = parseMirror(mirror)
+    start = time.time()
+    try:
+        s = socket.create_connection((host, port), timeout)
+        try:
+            s.settimeout(timeout)
+            state, session = login(s, credentials)
+            if session:
+                logout(s)
+        finally:
+            s.close()
+    except (socket.error, socket.timeout, struct.error, ValueError):
+        return 'down', None
+    return state, time.time() - start
+
+def rank(mirrors, timeout=probeTimeout, credentials=defaultCredentials):
+    """Probe all mirrors at once. Returns [(mirror, state, seconds)], healthy
+    ones first, fastest first.
+    """
+    results = {}
+    def work(mirror):
+        results[mirror] = probe(mirror, timeout, credentials)
+    threads = [threading.Thread(target=work, args=(mirror,)) for mirror in mirrors]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    order = {'ok': 0, 'busy': 1, 'down': 2}
+    ranking = [(mirror, results[mirror][0], results[mirror][1]) for mirror in mirrors]
+    ranking.sort(key=lambda item: (order[item[1]], item[2] is None, item[2]))
+    return ranking
+
+def admit(mirrors, maxWait=defaultMaxWait, report=None, base=5.0, maxDelay=120.0, timeout=probeTimeout,\
+            credentials=defaultCredentials):
+    """Wait until a mirror accepts connections, at most maxWait seconds.
+    Returns (mirror, state, seconds) of the one to use, healthy or not.
+    """
+    if not mirrors:
+        raise ValueError('no DB mirror to admit a job to')
+    policy = retry.RetryPolicy('db', attempts=1000, base=base, maxDelay=maxDelay, deadline=maxWait)
+    last = []
+    def attempt():
+        ranking = rank(mirrors, timeout, credentials)
+        last[:] = ranking
+        best = ranking[0]
+        if best[1] != 'ok' and report:
+            report('Waiting for DB: %s' %', '.join(['%s %s' %(m, state) for m, state, t in ranking]))
+        return {'OK': best[1] == 'ok', 'Value': best, 'Message': 'no DB mirror available'}
+    policy.call(attempt)
+    return last[0]
+
+
+class StandInDB(object):
+    # accepts like a MySQL server with max_connections, each client holds
+    # its connection for 'hold' seconds as Mokka does while reading geometry.
+    # Connections closed before a login or without COM_QUIT are counted as
+    # aborted, as the server counts them towards max_connect_errors.
+
+    def __init__(self, capacity, hold, latency=0.0, credentials=defaultCredentials):
+        self.capacity = capacity
+        self.hold = hold
+        self.latency = latency
+        self.credentials = credentials
+        self.active = 0
+        self.aborted = 0
+        self.lock = threading.Lock()
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(128)
+        self.mirror = '127.0.0.1:%d' %self.server.getsockname()[1]
+        t = threading.Thread(target=self._accept)
+        t.setDaemon(True)
+        t.start()
+
+    def _accept(self):
+        while True:
+            conn, addr = self.server.accept()
+            t = threading.Thread(target=self._serve, args=(conn,))
+            t.setDaemon(True)
+            t.start()
+
+    def _serve(self, conn):
+        if self.latency:
+            time.sleep(self.latency)
+        self.lock.acquire()
+        admitted = self.active < self.capacity
+        if admitted:
+            self.active += 1
+        self.lock.release()
+        clean = False
+        try:
+            if not admitted:
+                writePacket(conn, 0, '\xff\x10\x04Too many connections')
+                clean = True
+                return
+            seed = ''.join([chr(random.randint(33, 126)) for i in range(20)])
+            writePacket(conn, 0, '\x0a5.1.73\x00' + struct.pack('<I', 1) + seed[:8] + '\x00'\
+                        + struct.pack('<HBHHB10x', 0xf7ff, 33, 2, 0, 21) + seed[8:] + '\x00')
+            conn.settimeout(probeTimeout)
+            seq, response = readPacket(conn)
+            user, rest = response[32:].split('\0', 1)
+            answer = rest[1:1 + ord(rest[0])]
+            if (user, answer) != (self.credentials[0], scramble(self.credentials[1], seed)):
+                writePacket(conn, seq + 1, '\xff\x15\x04#28000Access denied for user')
+                clean = True
+                return
+            writePacket(conn, seq + 1, '\x00\x00\x00\x02\x00\x00\x00')
+            # a probe quits at once, a client reads for a while
+            conn.settimeout(self.hold + probeTimeout)
+            seq, command = readPacket(conn)
+            clean = command == '\x01'
+        except (socket.error, socket.timeout, struct.error, ValueError, IndexError):
+            pass
+        finally:
+            self.lock.acquire()
+            if admitted:
+                self.active -= 1
+            if not clean:
+                self.aborted += 1
+            self.lock.release()
+            conn.close()
+
+
+def connect(mirror, hold):
+    # what Mokka does: a session of 'hold' seconds, False if refused
+    host, port = parseMirror(mirror)
+    s = socket.create_connection((host, port), probeTimeout)
+    try:
+        state, session = login(s)
+        if not session:
+            return False
+        time.sleep(hold)
+        logout(s)
+        return True
+    finally:
+        s.close()
+
+def simulate(strategy, njobs, capacity, hold, maxWait):
+    dbs = [StandInDB(capacity, hold), StandInDB(capacity, hold, latency=0.01)]
+    mirrors = [db.mirror for db in dbs]
+    waits = []
+    failures = []
+    lock = threading.Lock()
+    def job():
+        start = time.time()
+        if strategy == 'sleep':
+            time.sleep(maxWait * random.random())
+            mirror = mirrors[0]
+            waited = time.time() - start
+            ok = connect(mirror, hold)
+        else:
+            # as job.py does: a refused session is admitted and started again
+            policy = retry.RetryPolicy('session', attempts=1000, base=0.05, maxDelay=0.5, deadline=maxWait)
+            waited = []
+            def session():
+                mirror = admit(mirrors, maxWait - (time.time() - start), base=0.05, maxDelay=0.5)[0]
+                waited[:] = [time.time() - start]
+                return {'OK': connect(mirror, hold)}
+            ok = policy.call(session)['OK']
+            waited = waited[0]
+        lock.acquire()
+        waits.append(waited)
+        if not ok:
+            failures.append(start)
+        lock.release()
+    threads = [threading.Thread(target=job) for i in range(njobs)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sum(waits) / len(waits), max(waits), len(failures), sum([db.aborted for db in dbs])
+
+
+if __name__ == '__main__':
+    njobs = 200
+    capacity = 20
+    if len(sys.argv) > 1:
+        njobs = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        capacity = int(sys.argv[2])
+    hold = 0.2
+    maxWait = 3.0
+    for strategy in ['sleep', 'admit']:
+        mean, longest, failed, aborted = simulate(strategy, njobs, capacity, hold, maxWait)
+        print '%-6s %d jobs, 2 mirrors of %d connections: mean wait %.3f s, max wait %.3f s, %d DB failures,'\
+                ' %d aborted connects' %(strategy, njobs, capacity, mean, longest, failed, aborted)
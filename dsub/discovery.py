@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# title: input discovery for dsub
+#
+# Walks an input_dir with a pool of threads, taking sizes from the stat done
+# while scanning each directory (os.walk + getsize costs two metadata round
+# trips per file on Lustre). The result of every directory scan is kept in a
+# per-input_dir index, keyed by the directory mtime, so a later submission over
+# the same sample only rescans directories where files were added or removed.
+#
+# An input_filelist is streamed in chunks: duplicates are dropped with a set
+# and each chunk is stat'ed in parallel, which gives existence and size at once.
+#
+# iterStdhep and iterFilelist give the files while the walk or the reading
+# goes on, for dsub to register and submit the first ones meanwhile. Both give
+# them in the same order on every run, whatever the order the threads finish
+# in, since dsub numbers the jobs in this order.
+import os, os.path, stat, hashlib, threading, Queue
+import cache
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+defaultThreads = 8
+filelistChunkSize = 1000
+defaultIndexDir = os.path.join(os.path.expanduser('~'), '.dsub', 'index')
+
+
+def isStdhep(filename):
+    return filename[-7:].lower() == '.stdhep'
+
+def listEntries(path):
+    # -> ([subdir names], [[filename, size, mtime]]) for the .stdhep files
+    subdirs = []
+    files = []
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+            elif isStdhep(entry.name) and entry.is_file():
+                st = entry.stat()
+                files.append([entry.name, st.st_size, st.st_mtime])
+        return subdirs, files
+    for name in os.listdir(path):
+        try:
+            st = os.lstat(os.path.join(path, name))
+            if stat.S_ISDIR(st.st_mode):
+                subdirs.append(name)
+                continue
+            if not isStdhep(name):
+                continue
+            if stat.S_ISLNK(st.st_mode):
+                # like os.walk, follow links to files but not to directories
+                st = os.stat(os.path.join(path, name))
+            if stat.S_ISREG(st.st_mode):
+                files.append([name, st.st_size, st.st_mtime])
+        except OSError:
+            continue
+    return subdirs, files
+
+def _unicode(name):
+    # the index is json, keep every name in it as unicode
+    if isinstance(name, str):
+        return name.decode('utf-8', 'replace')
+    return name
+
+def indexPath(indexDir, inputdir):
+    return os.path.join(indexDir, hashlib.md5(inputdir).hexdigest() + '.json')
+
+def loadIndex(path):
+    return cache.readJson(path) or {}
+
+def saveIndex(path, index):
+    cache.writeJson(path, index)
+
+
+class Walker(object):
+
+    def __init__(self, index, threads=defaultThreads):
+        self.oldIndex = index
+        self.index = {}
+        self.threads = max(1, threads)
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.scannedCond = threading.Condition(self.lock)
+        self.scanned = 0
+        self.errors = []
+        self.failed = set()
+        self.done = False
+
+    def _scan(self, path):
+        key = _unicode(path)
+        mtime = os.stat(path).st_mtime
+        cached = self.oldIndex.get(key)
+        if cached and cached[0] == mtime:
+            entry = cached
+        else:
+            subdirs, files = listEntries(path)
+            entry = [mtime, [_unicode(name) for name in subdirs],\
+                        [[_unicode(name), size, fmtime] for name, size, fmtime in files]]
+            self.lock.acquire()
+            self.scanned += 1
+            self.lock.release()
+        self.lock.acquire()
+        self.index[key] = entry
+        self.scannedCond.notifyAll()
+        self.lock.release()
+        for name in entry[1]:
+            self.queue.put(os.path.join(path, name.encode('utf-8')))
+
+    def _work(self):
+        while True:
+            path = self.queue.get()
+            if path is None:
+                break
+            try:
+                self._scan(path)
+            except OSError, e:
+                self.lock.acquire()
+                self.errors.append((path, str(e)))
+                self.failed.add(_unicode(path))
+                self.scannedCond.notifyAll()
+                self.lock.release()
+            self.queue.task_done()
+
+    def walk(self, top):
+        self.queue.put(top)
+        threads = []
+        for i in range(self.threads):
+            t = threading.Thread(target=self._work)
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+        self.queue.join()
+        for t in threads:
+            self.queue.put(None)
+        for t in threads:
+            t.join()
+        return self.index
+
+    def stream(self, top):
+        # yield (dirpath, files) of each directory with .stdhep files, depth
+        # first with the subdirectories in sorted order. The threads scan
+        # ahead in any order, a directory is yielded once it is scanned and
+        # all the ones before it are yielded.
+        self.done = False
+        def walk():
+            try:
+                self.walk(top)
+            finally:
+                self.lock.acquire()
+                self.done = True
+                self.scannedCond.notifyAll()
+                self.lock.release()
+        t = threading.Thread(target=walk)
+        t.setDaemon(True)
+        t.start()
+        pending = [top]
+        while pending:
+            path = pending.pop()
+            key = _unicode(path)
+            self.lock.acquire()
+            try:
+                while not (self.index.has_key(key) or key in self.failed or self.done):
+                    self.scannedCond.wait()
+                entry = self.index.get(key)
+            finally:
+                self.lock.release()
+            if entry is None:
+                continue
+            for name in sorted(entry[1], reverse=True):
+                pending.append(os.path.join(path, name.encode('utf-8')))
+            if entry[2]:
+                yield path, entry[2]
+        t.join()
+
+
+def iterStdhep(inputdir, threads=defaultThreads, indexDir=defaultIndexDir):
+    """Yield (filepath, size, filename) of the .stdhep files under inputdir
+    while it is walked, directory by directory, depth first. Directories and
+    the files in each are in sorted order, the same on every run.
+    """
+    inputdir = os.path.abspath(inputdir)
+    path = indexPath(indexDir, inputdir)
+    walker = Walker(loadIndex(path), threads)
+    nfiles = 0
+    for dirpath, files in walker.stream(inputdir):
+        for filename, size, fmtime in sorted(files):
+            filename = filename.encode('utf-8')
+            nfiles += 1
+            yield (os.path.join(dirpath, filename), size, filename)
+    for dirpath, error in walker.errors:
+        print 'WARNNING: failed to scan %s: %s' %(dirpath, error)
+    try:
+        saveIndex(path, walker.index)
+    except (IOError, OSError), e:
+        print 'WARNNING: failed to save input index %s: %s' %(path, e)
+    print 'Scanned %d of %d directories under %s, found %d .stdhep files.' %(walker.scanned,\
+            len(walker.index), inputdir, nfiles)
+
+def findStdhep(inputdir, threads=defaultThreads, indexDir=defaultIndexDir):
+    """Return sorted (filepath, size, filename) tuples of all .stdhep files under inputdir."""
+    inputDataList = list(iterStdhep(inputdir, threads, indexDir))
+    inputDataList.sort()
+    return inputDataList
+
+
+class StatPool(object):
+
+    def __init__(self, threads=defaultThreads):
+        self.tasks = Queue.Queue()
+        self.threads = []
+        for i in range(max(1, threads)):
+            t = threading.Thread(target=self._work)
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+    def _work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            results, i, path = task
+            try:
+                results[i] = os.stat(path)
+            except OSError:
+                results[i] = None
+            self.tasks.task_done()
+
+    def stat(self, paths):
+        # os.stat results in the order of paths, None for missing ones
+        results = [None] * len(paths)
+        for i, path in enumerate(paths):
+            self.tasks.put((results, i, path))
+        self.tasks.join()
+        return results
+
+    def close(self):
+        for t in self.threads:
+            self.tasks.put(None)
+        for t in self.threads:
+            t.join()
+
+
+def iterFilelist(listfile, threads=defaultThreads, counts=None):
+    """Yield (filepath, size, filename) of the existing /cefs .stdhep files
+    listed in listfile, in order of first appearance, a chunk at a time.
+    The lines, ignored, duplicate and missing ones are counted in counts.
+    """
+    if counts is None:
+        counts = {}
+    counts.update({'lines': 0, 'ignored': 0, 'duplicate': 0, 'missing': 0})
+    seen = set()
+    pool = StatPool(threads)
+    def flush(chunk):
+        found = []
+        for filepath, st in zip(chunk, pool.stat(chunk)):
+            if st is None or not stat.S_ISREG(st.st_mode):
+                counts['missing'] += 1
+            else:
+                found.append( (filepath, st.st_size, os.path.basename(filepath)) )
+        return found
+    chunk = []
+    f = open(listfile)
+    try:
+        for eachline in f:
+            line = eachline.strip()
+            if line == '':
+                continue
+            counts['lines'] += 1
+            if not (line.startswith('/cefs/') and isStdhep(line)):
+                counts['ignored'] += 1
+                continue
+            if line in seen:
+                counts['duplicate'] += 1
+                continue
+            seen.add(line)
+            chunk.append(line)
+            if len(chunk) >= filelistChunkSize:
+                for item in flush(chunk):
+                    yield item
+                chunk = []
+        if chunk:
+            for item in flush(chunk):
+                yield item
+    finally:
+        f.close()
+        pool.close()
+
+def readFilelist(listfile, threads=defaultThreads):
+    """Return ((filepath, size, filename) tuples, counts) for the existing
+    /cefs .stdhep files listed in listfile, in order of first appearance.
+    """
+    counts = {}
+    inputDataList = list(iterFilelist(listfile, threads, counts))
+    return inputDataList, counts
@@ -1,22 +1,36 @@
 #!/usr/bin/env python
 # title: job submit tool for cepc sim.+rec. jobs
-# usage: dsub job.cfg
+# usage: dsub job.cfg [job2.cfg ...]
+#        dsub --productions=productions.txt
+#        dsub --resume repository/N
 # author: yant@ihep.ac.cn
 # last updated: 2015-06-15
 # version 1.0
 # add a long commet for testing if the scroll bar below can float. Let's see! Let's see!Let's see! Let's see! Let's see! Let's see! Let's see! Let's see! Let's see! Let's see! Let's see! Let's see! Let's see!
-import sys, os, os.path, re, time, commands, shutil
+import sys, os, os.path, re, time, shutil, getopt, threading, itertools
 try:
     import xml.etree.cElementTree as ET
 except ImportError:
     import xml.etree.ElementTree as ET
-from DIRAC.Core.Base import Script
-Script.parseCommandLine( ignoreErrors = False )
-from DIRAC.Core.Security.ProxyInfo import getProxyInfo
-from DIRAC.Interfaces.API.Job import Job
-from DIRAC.Interfaces.API.Dirac import Dirac
-from DIRAC.Resources.Catalog.FileCatalogClient import FileCatalogClient
-from DIRAC.DataManagementSystem.Client.ReplicaManager import ReplicaManager
+import backend, catalog, submitpool, journal, discovery, templates, sandbox, stats, retry, cache, joblog, dbmirror
+import stdhep, sitestats, monitor, multicore, repository, pipeline
+
+dsubSwitches = [('', 'resume=', 'resume the production of a master directory, e.g. repository/3'),
+                ('', 'clear-cache', 'forget the cached DFC registrations of input files'),
+                ('', 'exit-codes=', 'exit codes resubmit retries, e.g. 11,21,grid (default 11,21,24,31,grid)'),
+                ('', 'max-resubmit=', 'resubmit a job at most this many times (default 3)'),
+                ('', 'dry-run', 'show what resubmit would do without submitting'),
+                ('', 'productions=', 'a file listing the cfg files of several productions, one per line')]
+# proxy info per backend, decoded once per hour at most
+proxyCache = cache.TTLCache(3600)
+# shared by the productions of one dsub run, one pool per backend
+catalogClients = cache.TTLCache(3600)
+catalogPoolSize = 4
+templateCache = {}
+schedulerCache = {}
+schedulerLock = threading.Lock()
+# files in the first chunk of the pipeline, small for the first jobs to go out early
+firstChunkSize = 20
 
 
 def getUserPara(cfg_file):
@@ -33,12 +47,16 @@ def getUserPara(cfg_file):
             continue
         lhs, rhs = line.split("=", 1)
         key = lhs.strip()
-        if key in ['seed', 'evtmax', 'evtstart', 'batch']:
+        if key in ['seed', 'evtmax', 'evtstart', 'batch', 'submit_workers', 'submit_inflight',\
+                    'discovery_threads', 'lfn_cache_ttl', 'stall_timeout', 'reco_stall_timeout', 'status_interval', 'db_max_wait', 'target_walltime', 'bytes_per_event',\
+                    'site_choices', 'site_stats_hours', 'cores', 'pipeline_chunk']:
             value = int(rhs)
-        elif key == 'sites':
+        elif key in ['local_latency', 'local_failure_rate', 'seconds_per_event']:
+            value = float(rhs)
+        elif key in ['parametric', 'slice_inputs']:
+            value = rhs.strip().lower() in ['yes', 'true', '1']
+        elif key in ['sites', 'db_mirrors']:
             value = re.sub('\s+', '', rhs).split(',')
-        elif key == 'job_group':
-            value = getProxyInfo()['Value']['username'] + '_' + time.strftime("%y%m%d") + '_' + rhs.strip()
         else:
             value = rhs.strip()
         userPara[key] = value
@@ -49,164 +67,258 @@ def getUserPara(cfg_file):
         userPara['evtstart'] = 0
     if not userPara.has_key('batch'):
         userPara['batch'] = 1
+    if not userPara.has_key('seconds_per_event'):
+        userPara['seconds_per_event'] = 60.0
+    if not userPara.has_key('parametric'):
+        userPara['parametric'] = False
+    if not userPara.has_key('slice_inputs'):
+        userPara['slice_inputs'] = False
+    if not userPara.has_key('sandbox'):
+        userPara['sandbox'] = 'job'
+    if not userPara.has_key('submit_workers'):
+        userPara['submit_workers'] = 1
+    if not userPara.has_key('submit_inflight'):
+        userPara['submit_inflight'] = 2 * userPara['submit_workers']
+    if not userPara.has_key('pipeline_chunk'):
+        userPara['pipeline_chunk'] = catalog.defaultChunkSize
+    if not userPara.has_key('discovery_threads'):
+        userPara['discovery_threads'] = discovery.defaultThreads
+    if not userPara.has_key('index_dir'):
+        userPara['index_dir'] = discovery.defaultIndexDir
+    if not userPara.has_key('lfn_cache'):
+        userPara['lfn_cache'] = cache.defaultRegisteredCache
+    if not userPara.has_key('lfn_cache_ttl'):
+        userPara['lfn_cache_ttl'] = cache.defaultRegisteredTTL
     if not userPara.has_key('work_dir'):
         userPara['work_dir'] = os.getcwd()
     if not userPara.has_key('repo_dir'):
         userPara['repo_dir'] = os.getcwd()
-    if not userPara.has_key('job_group'):
-        userPara['job_group'] = getProxyInfo()['Value']['username'] + '_' + time.strftime("%y%m%d_%H%M") + 'cepc_sr'
     if not userPara.has_key('sites'):
         userPara['sites'] = ['CLOUD.IHEP-OPENSTACK.cn', 'CLOUD.IHEP-OPENNEBULA.cn', 'CLUSTER.WHU.cn']
+    if not userPara.has_key('site_stats'):
+        userPara['site_stats'] = 'jobs'
+    if not userPara.has_key('site_choices'):
+        userPara['site_choices'] = sitestats.defaultChoices
+    if not userPara.has_key('site_stats_hours'):
+        userPara['site_stats_hours'] = sitestats.defaultHours
     return userPara
 
-def checkUserPara(userPara):
-    # check keys of user paramter
+def selectBackend(userPara):
+    # done where a production is submitted, resumed or queried, not when its
+    # cfg file is read; 'backend = local' in the cfg file gives an offline dry run
+    if userPara.get('backend', 'dirac') == 'local':
+        return backend.select('local', latency=userPara.get('local_latency', 0.0),\
+                                failureRate=userPara.get('local_failure_rate', 0.0))
+    return backend.select('dirac')
+
+def getUsername():
+    current = backend.get()
+    proxyInfo = proxyCache.get(current, current.getProxyInfo)
+    if not proxyInfo['OK']:
+        proxyCache.invalidate(current)
+        print 'ERROR: failed to get proxy info. %s' %proxyInfo['Message']
+        sys.exit(1)
+    return proxyInfo['Value']['username']
+
+def getJobGroup(userPara):
+    # needs the proxy, so it is only resolved when a production is started
+    if userPara.has_key('job_group'):
+        return getUsername() + '_' + time.strftime("%y%m%d") + '_' + userPara['job_group']
+    return getUsername() + '_' + time.strftime("%y%m%d_%H%M") + 'cepc_sr'
+
+def validateUserPara(userPara):
+    # -> list of error messages, empty if the cfg is fine
+    errors = []
     reqParaKeys = ['evtmax']
     paraKeys = userPara.keys()
     if not ( ('input_dir' in paraKeys) or ('input_filelist' in paraKeys) ):
-        print "ERROR: Neither 'input_dir' nor 'input_filelist' is assigned in cfg file."
-        sys.exit(1)
+        errors.append("Neither 'input_dir' nor 'input_filelist' is assigned in cfg file.")
     if not ( ('output_dir' in paraKeys) or (('output_dir_sim' in paraKeys) and ('output_dir_rec' in paraKeys)) ):
-        print "ERROR: 'output_dir' or both 'output_dir_sim' and 'output_dir_rec' should be given in cfg file."
+        errors.append("'output_dir' or both 'output_dir_sim' and 'output_dir_rec' should be given in cfg file.")
     for key in reqParaKeys:
         if not (key in paraKeys):
-            print "ERROR: %s is not assigned in cfg file." % item
-            sys.exit(1)
+            errors.append("%s is not assigned in cfg file." % key)
     # check repo dir
     if not (os.path.isdir(userPara['repo_dir']) and os.access(userPara['repo_dir'],os.W_OK) ):
-        print 'ERROR: work dir %s is not writable' %userPara['repo_dir']
+        errors.append('work dir %s is not writable' %userPara['repo_dir'])
     # check input dir or filelist
     if 'input_dir' in paraKeys:
         if not os.path.isdir(userPara['input_dir']):
-            print 'ERROR: input_dir %s is not a directory' % userPara['input_dir']
-            sys.exit(1)
+            errors.append('input_dir %s is not a directory' % userPara['input_dir'])
         if not ( userPara['input_dir'].startswith('/cefs/') ):
-            print 'ERROR: input_dir %s should be in /cefs ' % userPara['input_dir']
-            sys.exit(1)
+            errors.append('input_dir %s should be in /cefs ' % userPara['input_dir'])
     if 'input_filelist' in paraKeys:
         if not os.path.isfile(userPara['input_filelist']):
-            print 'ERROR: input_filelist %s is not a file.' % userPara['input_filelist']
-            sys.exit(1)
+            errors.append('input_filelist %s is not a file.' % userPara['input_filelist'])
+    if not userPara.get('backend', 'dirac') in backend.backends:
+        errors.append("backend should be one of %s." % ', '.join(backend.backends))
+    if not userPara['sandbox'] in ['job', 'shared']:
+        errors.append("sandbox should be 'job' or 'shared'.")
+    if userPara.get('target_walltime') and userPara['parametric']:
+        errors.append("target_walltime gives every file its own number of jobs, it can not be used with parametric.")
+    if userPara['slice_inputs']:
+        if userPara['parametric']:
+            errors.append("slice_inputs gives every job its own input file, it can not be used with parametric.")
+        if not userPara.get('slice_dir', '').startswith('/cefs/'):
+            errors.append("slice_inputs needs a slice_dir in /cefs for the sliced input files.")
     # check sites
     cepcSites = ['CLOUD.IHEP-OPENSTACK.cn', 'CLOUD.IHEP-OPENNEBULA.cn', 'CLOUD.IHEP-PUBLIC.cn', 'CLOUD.WHU.cn',\
                     'CLUSTER.WHU.cn', 'CLUSTER.SJTU.cn', 'CLUSTER.PKU.cn', 'CLUSTER.GXU.cn', 'CLUSTER.BUAA.cn',\
                     'CLUSTER.SDU-MLL.cn', 'CLUSTER.SDU-HXT.cn']
     for site in userPara['sites']:
         if not (site in cepcSites):
-            print "ERROR: %s is not an valid CEPC site. " % site
-            sys.exit(1)
+            errors.append("%s is not an valid CEPC site. " % site)
+    if not (userPara['site_stats'] in ['jobs', 'none'] or os.path.isfile(userPara['site_stats'])):
+        errors.append("site_stats should be 'jobs', 'none' or a JSON file of site statistics.")
+    if userPara['site_choices'] < 1:
+        errors.append("site_choices should be at least 1.")
+    if userPara.get('cores', 1) < 1:
+        errors.append("cores should be at least 1.")
+    if userPara['pipeline_chunk'] < 1:
+        errors.append("pipeline_chunk should be at least 1.")
+    if not userPara.get('db_mirrors', dbmirror.defaultMirrors):
+        errors.append("db_mirrors should list at least one DB host.")
+    for mirror in userPara.get('db_mirrors', []):
+        if not dbmirror.isMirror(mirror):
+            errors.append("'%s' in db_mirrors should be a host or host:port." % mirror)
+    return errors
 
-def checkInputFilelist(listfile):
-    if not os.path.isfile(listfile):
-        print 'ERROR: %s is not a file' %listfile
+def checkUserPara(userPara):
+    errors = validateUserPara(userPara)
+    for error in errors:
+        print 'ERROR: ' + error
+    if errors:
         sys.exit(1)
-    filelist = []
-    f = open(listfile)
-    for eachline in f:
-        line = eachline.strip()
-        if line == '':
-            continue
-        if not (line.startswith('/cefs/')):
-            print 'WARNNING: input data %s not in /cefs, ignored.' %line
-            continue
-        if (os.path.isfile(line) and (line[-7:].lower() == '.stdhep')):
-            if line not in filelist:
-                filelist.append(line)
+
+def readProductionList(path):
+    # cfg files one per line, relative to the list, '#' starts a comment
+    if not os.path.isfile(path):
+        print 'ERROR: %s is not a list of cfg files.' %path
+        sys.exit(1)
+    cfgFiles = []
+    f = open(path)
+    for eachLine in f:
+        line = eachLine.partition('#')[0].strip()
+        if line:
+            cfgFiles.append(os.path.join(os.path.dirname(os.path.abspath(path)), line))
     f.close()
-    if len(filelist) == 0:
-        print 'ERROR: No .stdhep files found in %s' %listfile
+    return cfgFiles
+
+def checkProductions(cfgFiles):
+    # every cfg file is checked before anything is submitted, -> [userPara]
+    userParaList = []
+    failed = False
+    for cfg_file in cfgFiles:
+        userPara = getUserPara(cfg_file)
+        errors = validateUserPara(userPara)
+        if len(cfgFiles) > 1:
+            errors = ['%s: %s' %(cfg_file, error) for error in errors]
+        for error in errors:
+            print 'ERROR: ' + error
+        failed = failed or bool(errors)
+        userParaList.append(userPara)
+    if len(set([userPara.get('backend', 'dirac') for userPara in userParaList])) > 1:
+        print 'ERROR: the productions of one dsub run should all use the same backend.'
+        failed = True
+    if failed:
         sys.exit(1)
-    return filelist
+    return userParaList
 
-def getInputDataList(userPara):
-    inputDataList = []
+def iterInputData(userPara):
+    # (filepath, size, filename) of the input files while they are being found
+    found = 0
     if userPara.has_key('input_filelist'):
-        filelist = checkInputFilelist(userPara['input_filelist'])
-        for filepath in filelist:
-            inputDataList.append( (filepath, os.path.getsize(filepath), os.path.basename(filepath)) )
+        listfile = userPara['input_filelist']
+        if not os.path.isfile(listfile):
+            print 'ERROR: %s is not a file' %listfile
+            sys.exit(1)
+        counts = {}
+        for item in discovery.iterFilelist(listfile, userPara['discovery_threads'], counts):
+            found += 1
+            yield item
+        print '%d lines read from %s: %d not /cefs .stdhep files ignored, %d duplicates, %d missing.' %(\
+                counts['lines'], listfile, counts['ignored'], counts['duplicate'], counts['missing'])
+        if found == 0:
+            print 'ERROR: No .stdhep files found in %s' %listfile
+            sys.exit(1)
     elif userPara.has_key('input_dir'):
         inputdir = userPara['input_dir']
-        for dir, subdir, files in os.walk(inputdir):
-            for filename in files:
-                if filename[-7:].lower() == '.stdhep':
-                    filepath = os.path.join(dir, filename)
-                    inputDataList.append( (filepath, os.path.getsize(filepath), filename) )
-        if len(inputDataList) == 0:
+        for item in discovery.iterStdhep(inputdir, userPara['discovery_threads'], userPara['index_dir']):
+            found += 1
+            yield item
+        if found == 0:
             print 'ERROR: No .stdhep file founded in input dir %s' %inputdir
             sys.exit(1)
     else:
         print 'ERROR: Neither input dir or filelist if given.'
         sys.exit(1)
-    return inputDataList
-
-def registerInputData(filepath, size):
-    infoDict = {}
-    infoDict['PFN'] = ''
-    infoDict['Size'] = size
-    infoDict['SE'] = 'IHEP-STORM'
-    infoDict['GUID'] = commands.getoutput('uuidgen')
-    infoDict['Checksum'] = ''
-    fileDict = {}
-    lfn = '/cepc/lustre-ro' + filepath
-    fileDict[lfn] = infoDict
-    fcc = FileCatalogClient('DataManagement/FileCatalog')
-    rm = ReplicaManager()
-    result = {}
-    result['lfn'] = lfn
-    result['is_registered'] = False
-    for repeatTimes in range(10):
-        is_registered = fcc.isFile(lfn)
-        if (is_registered['OK'] and is_registered['Value']['Successful'].has_key(lfn)):
-            break
-        else:
-            continue
-    if not is_registered['OK']:
-        result['is_registered'] = 'querry error. unkown'
-        print 'Failed to query %s in DFC. Error message is %s' %(lfn, is_registered['Message'])
-    if is_registered['Value']['Successful'][lfn]:
-        result['is_registered'] = True
-        for repeatTimes in range(10):
-            is_removed = rm.removeCatalogFile(lfn)
-            if (is_removed['OK'] and is_removed['Value']['Successful'][lfn]['FileCatalog']):
-                result['is_removed'] = True
-                break
+
+def openRegisteredCache(userPara):
+    path = userPara.get('lfn_cache', cache.defaultRegisteredCache)
+    if path == 'no':
+        return None
+    return cache.getRegisteredCache(path, userPara.get('lfn_cache_ttl', cache.defaultRegisteredTTL))
+
+def saveRegisteredCache(regCache):
+    try:
+        regCache.save()
+    except (IOError, OSError), e:
+        print 'WARNNING: failed to save %s: %s' %(regCache.path, e)
+
+@stats.timed('registerInputData')
+def registerInputData(inputDataList, userPara, regCache=None):
+    # with the regCache of the caller, who saves it when all is registered
+    results = {}
+    toRegister = inputDataList
+    opened = regCache is None
+    if opened:
+        regCache = openRegisteredCache(userPara)
+    if regCache:
+        # files registered by an earlier run and unchanged since skip the DFC
+        pool = discovery.StatPool(userPara['discovery_threads'])
+        statList = pool.stat([item[0] for item in inputDataList])
+        pool.close()
+        toRegister = []
+        for item, st in zip(inputDataList, statList):
+            lfn = st and regCache.lookup(item[0], st.st_size, st.st_mtime)
+            if lfn:
+                results[item[0]] = {'lfn': lfn, 'is_registered': True, 'OK': True, 'cached': True}
             else:
-                continue
-        if not is_removed['OK']:
-            result['is_removed'] = 'remove error'
-            print 'Failed to remove %s from DFC.' %lfn
-    for repeatTimes in range(10):
-        is_added = fcc.addFile(fileDict)
-        if (is_added['OK'] and is_added['Value']['Successful'][lfn]):
-            result['OK'] = True
-            return result
-        else:
-            continue
-    if not is_added['OK']:
-        result['OK'] = False
-        result['Message'] = is_added['Message']
-    elif is_added['Value']['Failed']:
-        result['OK'] = False
-        result['Message'] = 'Failed to add file' + lfn
-    return result
+                toRegister.append(item)
+        stats.count('lfn_cache_hits', len(results))
+        print '%d of %d input files are known to be registered in DFC.' %(len(results), len(inputDataList))
+    if toRegister:
+        clients = getCatalogClients()
+        fcc, rm = clients.acquire()
+        try:
+            registered = catalog.registerInputDataBulk(toRegister, fcc, rm)
+        finally:
+            clients.release((fcc, rm))
+        results.update(registered)
+        if regCache:
+            for item, st in zip(inputDataList, statList):
+                rzt = registered.get(item[0])
+                if rzt and rzt['OK'] and st:
+                    regCache.add(item[0], st.st_size, st.st_mtime, rzt['lfn'])
+    if regCache and opened:
+        saveRegisteredCache(regCache)
+    return results
 
 def createMasterRepoDir(repoDirRoot):
-    repoDir = os.path.join(repoDirRoot, 'repository')
-    if not os.path.isdir(repoDir):
-        os.mkdir(repoDir)
-    masterDir = os.path.join( repoDir, repr(len(os.listdir(repoDir))) )
-    if not os.path.isdir(masterDir):
-        os.mkdir(masterDir)
-    else:
-        print 'Error: master directory %s is already exist. Please check it to avoid overwrite.' %masterDir
+    # concurrent dsub runs get different master directories, see repository.py
+    try:
+        return repository.allocateMasterDir(repoDirRoot)
+    except OSError, e:
+        print 'ERROR: failed to create a master directory under %s. %s' %(repoDirRoot, e)
         sys.exit(1)
-    return masterDir
 
 def setFixedPara(jobPara, userPara, masterDir):
     jobPara['SE'] = 'IHEP-STORM'
     jobPara['sites'] = userPara['sites']
-    jobPara['jobGroup'] = userPara['job_group']
-    jobPara['CPUTime'] = 86400
+    jobPara['jobGroup'] = userPara['dirac_job_group']
+    # the CPU time of all the cores of a multi-core job
+    jobPara['CPUTime'] = 86400 * userPara.get('cores', 1)
+    jobPara.update(getScriptPara(userPara))
     jobPara['jobScript'] = 'job.py'
     jobPara['jobScriptLog'] = 'script.log'
     jobPara['inputSandbox'] = [os.path.join(masterDir, files) for files in ['job.py',\
@@ -216,13 +328,31 @@ def setFixedPara(jobPara, userPara, masterDir):
                                 'simu.sh', 'simu.log', 'reco.xml', 'reco.sh', 'reco.log']
     return jobPara
 
-def getDFCprefix():
-    username = getProxyInfo()['Value']['username']
+def getScriptPara(userPara):
+    # settings baked into job.py
+    return {'stallTimeout': userPara.get('stall_timeout', joblog.defaultStallTimeout),
+            'recoStallTimeout': userPara.get('reco_stall_timeout', joblog.defaultRecoStallTimeout),
+            'statusInterval': userPara.get('status_interval', joblog.defaultStatusInterval),
+            'dbMirrors': userPara.get('db_mirrors', dbmirror.defaultMirrors),
+            'dbMaxWait': userPara.get('db_max_wait', dbmirror.defaultMaxWait),
+            'cores': userPara.get('cores', 1)}
+
+def getCatalogClients():
+    # the pool of (fcc, rm) pairs of the backend, a pair is used by one
+    # thread at a time while the registration stages of several productions
+    # run side by side
+    current = backend.get()
+    return catalogClients.get(current, lambda: cache.ClientPool(\
+                    lambda: (current.FileCatalogClient(), current.ReplicaManager()), catalogPoolSize))
+
+def getDFCprefix(username=None):
+    if username is None:
+        username = getUsername()
     initial = username[0]
     prefix = '/cepc/user/' + initial + '/' + username + '/' 
     return prefix
 
-def setVarPara(jobPara, dfcprefix, masterDir, subdir, inputFilename, inputDataLFN, batchStr):
+def getOutputData(userPara, dfcprefix, inputFilename, batchStr):
     if userPara.has_key('output_dir'):
         output_sim = os.path.join(dfcprefix, userPara['output_dir'], 'sim', inputFilename\
                                     + '_sim' + batchStr + '.slcio')
@@ -233,7 +363,10 @@ def setVarPara(jobPara, dfcprefix, masterDir, subdir, inputFilename, inputDataLF
                                     + '_sim' + batchStr + '.slcio')
         output_rec = os.path.join(dfcprefix, userPara['output_dir_rec'], inputFilename\
                                     + '_rec' + batchStr + '.slcio')
-    jobPara['outputData'] = ['LFN:' + output_sim, 'LFN:' + output_rec] 
+    return ['LFN:' + output_sim, 'LFN:' + output_rec]
+
+def setVarPara(jobPara, userPara, dfcprefix, masterDir, subdir, inputFilename, inputDataLFN, batchStr):
+    jobPara['outputData'] = getOutputData(userPara, dfcprefix, inputFilename, batchStr)
     jobPara['jobName'] = 'CEPC_v1_(%s.%s)_%s%s' %(os.path.basename(masterDir), os.path.basename(subdir),\
                             inputFilename, batchStr)
     jobPara['inputSandbox'][0] = os.path.join(subdir, 'job.py')
@@ -242,7 +375,11 @@ def setVarPara(jobPara, dfcprefix, masterDir, subdir, inputFilename, inputDataLF
     jobPara['inputSandbox'][5] = os.path.join(subdir, 'reco.xml')
     jobPara['inputSandbox'][6] = 'LFN:' + inputDataLFN
 
-def generateJobScript(subdir, jobPara, batchEvtStart):
+def getJobModules(jobPara):
+    # the modules of dsub job.py imports, from its input sandbox
+    return [retry, joblog, dbmirror] + (jobPara['cores'] > 1 and [multicore] or [])
+
+def renderJobScript(jobPara, jobArgs):
 
     # import, function definition
     module_head =\
@@ -251,8 +388,10 @@ def generateJobScript(subdir, jobPara, batchEvtStart):
 # job script for CEPC-DIRAC
 # author: yant@ihep.ac.cn
 #
-import os, sys, time, random, commands
+import os, sys, time, random
 from pprint import pprint
+from xml.sax.saxutils import escape
+import retry, joblog, dbmirror
 from DIRAC.Core.Base import Script
 Script.parseCommandLine( ignoreErrors = False )
 from DIRAC import siteName
@@ -296,59 +435,127 @@ def setRandomSeed():
     new_f.writelines(new_template)
     new_f.close()
 
-def checkOutputData(lfnx):
+def setJobFiles():
+    # shared and parametric jobs get generic files, fill in this job's values
+    # a job reading a slice of its input file is given the name of the whole file
+    name = jobArgs.get('name', os.path.splitext(jobArgs['inputFile'])[0])
+    values = [('@inputFile@', jobArgs['inputFile']), ('@name@', name),\\
+                ('@batchStr@', jobArgs['batchStr']), ('@evtStart@', jobArgs['evtStart']),\\
+                ('@evtmax@', jobArgs['evtmax'])]
+    for name in ['event.macro', 'simu.macro', 'reco.xml']:
+        f = open(name)
+        template = f.read()
+        f.close()
+        for token, value in values:
+            if name == 'reco.xml':
+                value = escape(value)
+            template = template.replace(token, value)
+        new_f = open(name, 'w')
+        new_f.write(template)
+        new_f.close()
+
+# thousands of jobs check the DFC, spread their retries out
+dfcBreaker = retry.CircuitBreaker('dfc', threshold=3, resetTimeout=60.0)
+dfcPolicy = retry.RetryPolicy('dfc', attempts=10, base=2.0, maxDelay=120.0, deadline=1800.0, breaker=dfcBreaker)
+
+def setDBHost(mirror):
+    # host or host:port, as configured in db_mirrors
+    f = open('simu.macro')
+    template = f.readlines()
+    f.close()
+    new_f = open('simu.macro', 'w')
+    for line in template:
+        if line.startswith('/Mokka/init/dbHost'):
+            line = '/Mokka/init/dbHost %s\\n' %mirror
+        new_f.write(line)
+    new_f.close()
+
+def admitDB(maxWait):
+    # the fastest mirror that accepts connections, waiting while all are busy
+    mirror, state, seconds = dbmirror.admit(dbMirrors, maxWait, setJobStatus,\\
+                                credentials=dbmirror.readCredentials('simu.macro'))
+    print 'Use DB %s (%s)' %(mirror, state)
+    setDBHost(mirror)
+    return mirror
+
+def readmitDB():
+    # after the DB refused Mokka, None when dbMaxWait is used up
+    if time.time() > dbDeadline:
+        return None
+    time.sleep(min(60 * random.random(), max(dbDeadline - time.time(), 0)))
+    return admitDB(dbDeadline - time.time())
+
+def writeScript(name, command):
+    f = open(name, 'w')
+    f.write('#!/bin/bash\\n'
+            'unset MARLIN_DLL\\n'
+            'export ILC_HOME=/cvmfs/cepc.ihep.ac.cn/cepcsoft/x64_SL6/xuyin/ilcsoft/v01-17-05\\n'
+            'source $ILC_HOME/init_ilcsoft_150612.sh\\n'
+            + command + '\\n')
+    f.close()
+    os.chmod(name, 0755)
+
+def checkOutputData(lfnxs):
+    # dsub removed stale outputs before submission, so this is one query for
+    # all outputs and a removal only when e.g. an earlier attempt registered them
     fcc = FileCatalogClient('DataManagement/FileCatalog')
-    rm = ReplicaManager()
-    result = {}
-    lfn = lfnx[4:]
-    result['lfn'] = lfn
-    result['is_registered'] = False
-    result['is_removed'] = False
-    result['query_OK'] = True
-    for repeatTimes in range(10):
-        is_registered = fcc.isFile(lfn)
-        if (is_registered['OK'] and is_registered['Value']['Successful'].has_key(lfn)):
-            break
-        else:
-            continue
-    if not is_registered['OK']:
+    lfns = [lfnx[4:] for lfnx in lfnxs]
+    result = {'lfns': lfns, 'registered': [], 'removed': [], 'query_OK': True}
+    is_registered = dfcPolicy.call(lambda: fcc.isFile(lfns),\\
+                        lambda r: r['OK'] and len(r['Value']['Successful']) == len(lfns))
+    if not (is_registered['OK'] and len(is_registered['Value']['Successful']) == len(lfns)):
         result['query_OK'] = False
-        print >> errFile, 'Failed to query %s in DFC. Error message is %s' %(lfn, is_registered['Message'])
+        print >> errFile, 'Failed to query %s in DFC. Error message is %s' %(lfns, is_registered.get('Message',\\
+                            is_registered.get('Value')))
         return result
-    else:
-        print >> logFile, 'Query successfully. OutputData registered info is:'
-        pprint(is_registered, logFile)
-    if is_registered['Value']['Successful'][lfn]:
-        result['is_registered'] = True
-        for repeatTimes in range(10):
-            is_removed = rm.removeCatalogFile(lfn)
-            if (is_removed['OK'] and is_removed['Value']['Successful'][lfn]['FileCatalog']):
-                result['is_removed'] = True
+    result['registered'] = [lfn for lfn in lfns if is_registered['Value']['Successful'][lfn]]
+    if result['registered']:
+        rm = ReplicaManager()
+        is_removed = dfcPolicy.call(lambda: rm.removeCatalogFile(result['registered']),\\
+                        lambda r: r['OK'] and len(r['Value']['Successful']) == len(result['registered']))
+        if is_removed['OK']:
+            result['removed'] = [lfn for lfn, value in is_removed['Value']['Successful'].items()\\
+                                    if value.get('FileCatalog')]
+            for lfn in result['removed']:
                 print >> logFile, '%s is removed from DFC' %lfn
-                break
-            else:
-                continue
-        if not is_removed['OK']:
-            print >> errFile, 'Failed to remove %s from DFC. Error message is %s' %(lfn, is_removed['Message'])
-    else:
-        print >> logFile, '%s is not registered. Nothing to do.' %lfn
+        else:
+            print >> errFile, 'Failed to remove %s from DFC. Error message is %s' %(result['registered'],\\
+                                is_removed['Message'])
     print >> logFile, 'result of dfc check is:'
     pprint(result, logFile)
     print >> logFile, '  '
     return result
 
-def is_found(errstr, file):
-    return not os.system("grep '%s' %s" %(errstr, file))
-
 logFile = open('job.log', 'w')
 errFile = open('job.err', 'w')
 """
+    # job.py imports exactly the modules startProduction ships with it
+    module_head = module_head.replace('import retry, joblog, dbmirror\n',\
+                    'import %s\n' %', '.join([module.__name__ for module in getJobModules(jobPara)]))
 
-    # parameters
+    # parameters, key=value arguments override the ones known at generation
+    module_head += "jobArgs = %r\n" % jobArgs
     module_head +=\
 """
-batchEvtStart = %s
-""" % batchEvtStart
+for arg in Script.getPositionalArgs():
+    key, value = arg.split('=', 1)
+    jobArgs[key] = value
+"""
+    if jobPara.has_key('parameters'):
+        module_head +=\
+"""
+if not jobArgs.has_key('evtStart'):
+    # parametric jobs derive their first event from the batch number
+    jobArgs['evtStart'] = str(%s)
+""" % jobPara['paraEvtStart']
+    module_head += "batchEvtStart = int(jobArgs['evtStart'])\n"
+    module_head += "evtmax = int(jobArgs['evtmax'])\n"
+    module_head += "stallTimeout = %d\n" %jobPara['stallTimeout']
+    module_head += "recoStallTimeout = %d\n" %jobPara['recoStallTimeout']
+    module_head += "statusInterval = %d\n" %jobPara['statusInterval']
+    module_head += "dbMirrors = %r\n" %jobPara['dbMirrors']
+    module_head += "dbMaxWait = %d\n" %jobPara['dbMaxWait']
+    module_head += "cores = %d\n" %jobPara['cores']
 
     # check cvmfs, db, queue, etc
     module_prepare =\
@@ -378,150 +585,153 @@ tmsg('Files from inputSandbox:')
 os.system('ls -l')
 
 tmsg('Determine which mirror DB to use')
-if siteName in ['CLOUD.IHEP-OPENSTACK.cn', 'CLOUD.IHEP-OPENNEBULA.cn']:
-    os.system("sed -i 's/202.114.78.211/202.122.37.75/g' simu.macro")
-    print 'Use site local DB 202.122.37.75'
-else:
-    print 'Use default DB 202.114.78.211'
+dbDeadline = time.time() + dbMaxWait
+admitDB(dbMaxWait)
 
 tmsg('Determin random seed')
 setRandomSeed()
+
+tmsg('Fill in job parameters')
+pprint(jobArgs)
+setJobFiles()
 """
-    # detemine queue
-    if jobPara['totalJobs'] < 50 or jobPara['evtmax'] < 30 :
-        module_prepare += 'max_q_time = 0\n'
-    elif jobPara['evtmax'] < 60:
-        module_prepare += 'max_q_time = 60 * 3\n'
-    elif jobPara['evtmax'] < 120:
-        module_prepare += 'max_q_time = 60 * 6\n'
-    else:
-        module_prepare += 'max_q_time = 60 * 15\n'
-    module_prepare +=\
-"""
-if siteName.startswith('CLOUD'):
-    max_q_time = 0
-if max_q_time != 0:
-    q_time = max_q_time * random.random()
-    q_msg = 'Queue for %.2f seconds' %q_time
-    tmsg(q_msg)
-    setJobStatus(q_msg)
-    q_cmd = 'sleep %f' %q_time
-    os.system(q_cmd)
-    tmsg('End queue.')
+
+    module_scripts =\
+"""\
+tmsg('Generate shell scripts for simulation and reconstruction')
+writeScript('simu.sh', '(time Mokka -U simu.macro) &> simu.log')
+writeScript('reco.sh', '(time Marlin reco.xml) &> reco.log')
 """
 
     module_sim =\
 """\
-tmsg('Generate shell script for simulation')
-simu_sh=\
-'''\
-#!/bin/bash
-unset MARLIN_DLL
-export ILC_HOME=/cvmfs/cepc.ihep.ac.cn/cepcsoft/x64_SL6/xuyin/ilcsoft/v01-17-05
-source $ILC_HOME/init_ilcsoft_150612.sh
-(time Mokka -U simu.macro) &> simu.log
-'''
-simu_f = open("simu.sh", 'w')
-simu_f.write(simu_sh)
-simu_f.close()
-os.system('chmod 755 simu.sh')
 # execute simu.
 setJobStatus('Mokka Simulation')
 tmsg('Start simulation')
-rzt = os.system('./simu.sh')
+while True:
+    rzt, stalled = joblog.run(['./simu.sh'], 'simu.log', 'Mokka Simulation', setJobStatus, evtmax,\\
+                                stallTimeout, statusInterval)
+    if rzt == 0 or stalled or time.time() > dbDeadline:
+        break
+    if joblog.analyzeSimu('simu.log', batchEvtStart)['exitCode'] != 21:
+        break
+    # the DB refused the connection, wait for a mirror and start again
+    if not readmitDB():
+        break
+    setJobStatus('Mokka Simulation')
+if stalled:
+    setJobStatus('Simulation stalled')
+    sys.exit(joblog.simuStallCode)
 last_evt = 0
 if rzt != 0:
-    if is_found('Database connection failed', 'simu.log'):
-        setJobStatus('DB connection failed')
-        sys.exit(21)
-    elif is_found('Convergence is requiring too many substeps', 'simu.log'):
-        setJobStatus('Too many substeps')
-        sys.exit(22)
-    elif is_found('Error when reading hep file; probably ran out of events', 'simu.log'):
-        print commands.getoutput('tail -n 20 simu.log|grep Error')
-        print commands.getoutput('tail -n 20 simu.log|grep Event')
-        last_evt = int(commands.getoutput("tail -n 20 simu.log|grep Event|awk '{print $5}'"))
-        setJobStatus('Run out of events: %d' %last_evt)
-        if (last_evt == batchEvtStart):
-            setJobStatus('No events in stdhep')
-            sys.exit(23)
-    else:
-        setJobStatus('Simulation Error')
-        sys.exit(20)
+    simuResult = joblog.analyzeSimu('simu.log', batchEvtStart)
+    for line in simuResult['tail']:
+        print line
+    last_evt = simuResult['lastEvent']
+    for status in simuResult['statuses']:
+        setJobStatus(status)
+    if simuResult['exitCode']:
+        sys.exit(simuResult['exitCode'])
 """
 
     module_rec =\
 """
-tmsg('Generate shell script for reconstruction')
-reco_sh=\
-'''\
-#!/bin/bash
-unset MARLIN_DLL
-export ILC_HOME=/cvmfs/cepc.ihep.ac.cn/cepcsoft/x64_SL6/xuyin/ilcsoft/v01-17-05
-source $ILC_HOME/init_ilcsoft_150612.sh
-(time Marlin reco.xml) &> reco.log
-'''
-reco_f = open("reco.sh", 'w')
-reco_f.write(reco_sh)
-reco_f.close()
-os.system('chmod 755 reco.sh')
-#
 setJobStatus('Marlin Reconstruction')
 tmsg('Start reconstruction')
-os.system('./reco.sh')
+rzt, stalled = joblog.run(['./reco.sh'], 'reco.log', 'Marlin Reconstruction', setJobStatus, evtmax,\\
+                            recoStallTimeout, statusInterval)
+if stalled:
+    setJobStatus('Reconstruction stalled')
+    sys.exit(joblog.recoStallCode)
 """
-    sucInfo = 'MyLCIOOutputProcessor: %d events in 1 runs written to file' %jobPara['evtmax']
-    sucInfo2 = 'MyLCIOOutputProcessor: +%d events in +1 runs written to file' %jobPara['evtmax']
-    module_rec += "sInfo = \'%s\'\n" %sucInfo
-    module_rec += "sInfo2 = \'%s\'\n" %sucInfo2
     module_rec +=\
 """\
 # check reco log
+nEvents = evtmax
 print "Last_evt: %d" %last_evt
 if last_evt:
-    sInfo = 'MyLCIOOutputProcessor: %d events in 1 runs written to file' %(last_evt - batchEvtStart)
-    sInfo2 = 'MyLCIOOutputProcessor: +%d events in +1 runs written to file' %(last_evt - batchEvtStart)
-    print 'New sInfo: %s' %(sInfo)
-    print 'New sInfo2: %s' %(sInfo2)
-recoLog = open('reco.log')
-recoLogfind = False
-for line in recoLog:
-    if (line.find(sInfo) != -1) or (line.find(sInfo2) != -1):
-        recoLogfind = True
-        break
-    else:
-        continue
-if not recoLogfind:
-#    if last_evt:
-#        pass
-#    else:
-    setJobStatus('Reconstruction Error')
-    sys.exit(30)
+    nEvents = last_evt - batchEvtStart
+    print 'Expect %d events in reco.log' %nEvents
+recoResult = joblog.analyzeReco('reco.log', nEvents)
+if recoResult['exitCode']:
+    for status in recoResult['statuses']:
+        setJobStatus(status)
+    sys.exit(recoResult['exitCode'])
+"""
+
+    # one Mokka and Marlin per core, see multicore.py
+    module_multicore =\
+"""\
+writeScript('merge.sh', '(time Marlin $1) &> $2')
+parts = [multicore.Part(i + 1, start, n) for i, (start, n) in\\
+            enumerate(multicore.splitRange(batchEvtStart, evtmax, min(cores, multicore.cpuCount())))]
+links = [jobArgs['inputFile'], 'PandoraSettingsDefault.xml', 'PandoraLikelihoodData9EBin.xml']
+for part in parts:
+    part.prepare(links)
+setJobStatus('Mokka Simulation')
+tmsg('Start %d simulations and reconstructions' %len(parts))
+multicore.run(parts, setJobStatus, stallTimeout, recoStallTimeout, statusInterval, readmitDB)
+multicore.collectLogs(parts, 'simu.log')
+multicore.collectLogs(parts, 'reco.log')
+exitCode, statuses, done = multicore.combine(parts)
+for status in statuses:
+    setJobStatus(status)
+if exitCode:
+    sys.exit(exitCode)
+tmsg('Merge the outputs of %d parts' %len(done))
+setJobStatus('Merge outputs')
+events = sum([part.events for part in done])
+for lfn in [jobArgs['sim'], jobArgs['rec']]:
+    output = os.path.basename(lfn)
+    if not multicore.merge([os.path.join(part.path, output) for part in done], output, events):
+        setJobStatus('Merge Error')
+        sys.exit(multicore.mergeErrorCode)
 """
 
     module_tail =\
 """
 tmsg('Check if output data is already registed.')
-sim_dfc = checkOutputData('%s')
-rec_dfc = checkOutputData('%s')
-if (sim_dfc['is_removed'] or rec_dfc['is_removed']):
+outputData = [jobArgs['sim'], jobArgs['rec']]
+dfc = checkOutputData(outputData)
+if dfc['removed']:
     print 'Redundant DFC record cleaned'
     setJobStatus('Redundant DFC cleaned')
+print >> logFile, 'DFC retries:'
+pprint(retry.summary(), logFile)
 tmsg('Job Completed. Files in current dir:')
 os.system('ls -l')
 setJobStatus('Done')
 tmsg('Job Done')
 logFile.close()
 errFile.close()
-""" % tuple(jobPara['outputData'])
-
-    f = open(os.path.join(subdir, 'job.py'), 'w')
-    print >> f, module_head
-    print >> f, module_prepare
-    print >> f, module_sim
-    print >> f, module_rec
-    print >> f, module_tail
-    f.close()
+"""
+
+    if jobPara['cores'] > 1:
+        return '\n'.join([module_head, module_prepare, module_scripts, module_multicore, module_tail, ''])
+    return '\n'.join([module_head, module_prepare, module_scripts, module_sim, module_rec, module_tail, ''])
+
+def getTemplates(work_dir):
+    # (event.macro, simu.macro, reco.xml) compiled once per work_dir and run
+    key = os.path.abspath(work_dir)
+    if not templateCache.has_key(key):
+        templateCache[key] = (prepareEvtMacro(work_dir), prepareSimuMacro(work_dir), prepareRecoXML(work_dir))
+    return templateCache[key]
+
+@stats.timed('generateJobScript')
+def generateJobScript(subdir, jobPara, jobArgs):
+    templates.writeFiles([(os.path.join(subdir, 'job.py'), renderJobScript(jobPara, jobArgs))])
+
+def prepareSharedSandbox(masterDir, jobPara, evtMacroTemp, simuMacroTemp, recoXML, userPara):
+    # one generic job.py and one copy of each template for the whole production,
+    # -> [(inputSandbox index, path)]
+    files = [(0, 'job.py', renderJobScript(jobPara, {})),
+             (3, 'event.macro', renderEvtMacro(evtMacroTemp, '@evtmax@', '@inputFile@')),
+             (4, 'simu.macro', renderSimuMacro(simuMacroTemp, '@name@', '@batchStr@', '@evtStart@')),
+             (5, 'reco.xml', renderRecoXML(recoXML, '@name@', '@batchStr@'))]
+    return [(i, sandbox.storeShared(masterDir, name, content)) for i, name, content in files]
+
+def jobArguments(jobArgs):
+    return ' '.join(['%s=%s' %(key, jobArgs[key]) for key in sorted(jobArgs)])
 
 def prepareEvtMacro(work_dir):
     template = []
@@ -533,18 +743,10 @@ def prepareEvtMacro(work_dir):
         else:
             template.append(line)
     f.close()
-    return template
+    return templates.compileMacro(template, [('/generator/generator', 'inputFile'), ('/run/beamOn', 'evtmax')])
 
-def generateEvtMacro(subdir, template, userPara, inputFilepath):
-    f = open(os.path.join(subdir, 'event.macro'), 'w')
-    for line in template:
-        if line.startswith('/generator/generator'):
-            f.write('/generator/generator ' + inputFilepath + '\n')
-        elif line.startswith('/run/beamOn'):
-            f.write('/run/beamOn ' + repr(userPara['evtmax']) + '\n')
-        else:
-            f.write(line)
-    f.close()
+def renderEvtMacro(template, evtmax, inputFilepath):
+    return template.render({'inputFile': inputFilepath, 'evtmax': str(evtmax)})
 
 def prepareSimuMacro(work_dir):
     template = []
@@ -565,54 +767,138 @@ def prepareSimuMacro(work_dir):
     f.close()
     if not '/Mokka/init/startEventNumber 0\n' in template:
         template.insert(idx, '/Mokka/init/startEventNumber 0\n')
-    return template
+    return templates.compileMacro(template, [('/Mokka/init/lcioFilename', 'simFile'),\
+                                    ('/Mokka/init/startEventNumber', 'evtStart')])
 
-def generateSimuMacro(subdir, template, inputFilename, batchStr, batchEvtStart):
-    f = open(os.path.join(subdir, 'simu.macro'), 'w')
-    for line in template:
-        if line.startswith('/Mokka/init/lcioFilename'):
-            f.write('/Mokka/init/lcioFilename ' + inputFilename + '_sim' + batchStr + '.slcio\n')
-        elif line.startswith('/Mokka/init/startEventNumber'):
-            f.write('/Mokka/init/startEventNumber ' + batchEvtStart +'\n')
-        else:
-            f.write(line)
-    f.close()
+def renderSimuMacro(template, inputFilename, batchStr, batchEvtStart):
+    return template.render({'simFile': inputFilename + '_sim' + batchStr + '.slcio', 'evtStart': batchEvtStart})
 
-def prepareRecoXML(work_dir, masterDir):
+def preparePandora(work_dir, masterDir):
     shutil.copy(os.path.join(work_dir, 'PandoraLikelihoodData9EBin.xml'), masterDir)
     pandoraSD = ET.parse(os.path.join(work_dir, 'PandoraSettingsDefault.xml'))
     for element in pandoraSD.findall('algorithm/HistogramFile'):
         element.text = 'PandoraLikelihoodData9EBin.xml'
     pandoraSD.write(os.path.join(masterDir, 'PandoraSettingsDefault.xml'))
+
+def prepareRecoXML(work_dir):
     recoXML = ET.parse(os.path.join(work_dir, 'reco.xml'))
     for element in recoXML.findall('processor/parameter[@name="PandoraSettingsXmlFile"]'):
         element.text = 'PandoraSettingsDefault.xml'
-    return recoXML
-
-def generateRecoXML(subdir, recoXML, inputFilename, batchStr):
-    for element in recoXML.findall('global/parameter[@name="LCIOInputFiles"]'):
-        element.text = inputFilename + '_sim' + batchStr + '.slcio'
-    for element in recoXML.findall('processor[@name="MyLCIOOutputProcessor"]/parameter[@name="LCIOOutputFile"]'):
-        element.text = inputFilename + '_rec' + batchStr + '.slcio'
-    recoXML.write(os.path.join(subdir, 'reco.xml'))
-
-def submitJob(jobPara):
-    dirac = Dirac()
-    j = Job()
+    return templates.compileXML(recoXML, [('global/parameter[@name="LCIOInputFiles"]', 'simFile'),\
+        ('processor[@name="MyLCIOOutputProcessor"]/parameter[@name="LCIOOutputFile"]', 'recFile')])
+
+def renderRecoXML(recoXML, inputFilename, batchStr):
+    return recoXML.render({'simFile': inputFilename + '_sim' + batchStr + '.slcio',\
+                            'recFile': inputFilename + '_rec' + batchStr + '.slcio'})
+
+@stats.timed('generateJobFiles')
+def generateJobFiles(subdir, evtMacroTemp, simuMacroTemp, recoXML, filename, batchStr, batchEvtStart, evtmax,\
+                        inputFile=None):
+    name_wo_ext = os.path.splitext(filename)[0]
+    templates.writeFiles([
+        (os.path.join(subdir, 'event.macro'), renderEvtMacro(evtMacroTemp, evtmax, inputFile or filename)),
+        (os.path.join(subdir, 'simu.macro'), renderSimuMacro(simuMacroTemp, name_wo_ext, batchStr, batchEvtStart)),
+        (os.path.join(subdir, 'reco.xml'), renderRecoXML(recoXML, name_wo_ext, batchStr))])
+
+@stats.timed('submitJob')
+def submitJob(jobPara, dirac=None):
+    if dirac is None:
+        dirac = backend.get().Dirac()
+    if not catalog.dfcBreaker.pause(time.time() + catalog.dfcPolicy.deadline):
+        # the jobs could not store their output anyway
+        return {'OK': False, 'Message': 'DFC is failing, submission paused too long'}
+    j = backend.get().Job()
     j.setName(jobPara['jobName'])
     j.setJobGroup(jobPara['jobGroup'])
-    j.setExecutable(jobPara['jobScript'], logFile = jobPara['jobScriptLog'])
+    if jobPara.has_key('parameters'):
+        # DIRAC fills each parameter in for %s in the JDL, including the arguments
+        j.setGenericParametricInput(jobPara['parameters'])
+    j.setExecutable(jobPara['jobScript'], arguments = jobPara.get('arguments', ''), logFile = jobPara['jobScriptLog'])
     j.setInputSandbox(jobPara['inputSandbox'])
     j.setOutputSandbox(jobPara['outputSandbox'])
     j.setOutputData(jobPara['outputData'], jobPara['SE'])
     j.setDestination(jobPara['sites'])
     j.setCPUTime(jobPara['CPUTime'])
-    result = dirac.submit(j)
-    if result['OK']:
+    if jobPara.get('cores', 1) > 1:
+        setProcessors(j, jobPara['cores'])
+    return dirac.submit(j)
+
+def setProcessors(j, cores):
+    # a multi-core job asks for a slot with all its cores
+    if hasattr(j, 'setNumberOfProcessors'):
+        j.setNumberOfProcessors(cores)
+    else:
+        # DIRAC releases without setNumberOfProcessors() match these in the JDL
+        j._addParameter(j.workflow, 'NumberOfProcessors', 'JDL', cores, 'Number of processors requested')
+        j._addParameter(j.workflow, 'Tags', 'JDL', 'MultiProcessor;%dProcessors' %cores, 'Required tags')
+
+def reportSubmit(jobPara, result):
+    if result['OK'] and jobPara.has_key('parameters'):
+        print 'Parametric job %s submitted successfully. %d jobs, IDs = %s' %(jobPara['jobName'],\
+                len(result['Value']), result['Value'])
+    elif result['OK']:
         print 'Job %s submitted successfully. ID = %d' %(jobPara['jobName'],result['Value'])
     else:
-        print 'Job %s submitted failed' %jobPara['jobName']
-    return result
+        print 'Job %s submitted failed. %s' %(jobPara['jobName'], result.get('Message', ''))
+
+@stats.timed('getSiteScheduler')
+def getSiteScheduler(userPara, masterDir, username=None):
+    # weights the sites by their recent throughput, see sitestats.py. Productions
+    # of one run with the same sites and statistics share a scheduler, so the
+    # jobs assigned by one count as pending for the others. The WMS is scanned
+    # at most once an hour, in the background: the jobs submitted before it is
+    # done go to all sites.
+    key = (tuple(userPara['sites']), userPara['site_stats'], userPara['site_choices'], userPara['site_stats_hours'])
+    schedulerLock.acquire()
+    try:
+        if schedulerCache.has_key(key):
+            scheduler, masterDirs, statsBySite = schedulerCache[key]
+            masterDirs.append(masterDir)
+            if scheduler.stats:
+                sitestats.save(statsBySite, os.path.join(masterDir, 'sites.json'))
+            return scheduler
+        scheduler = sitestats.Scheduler(userPara['sites'], {}, userPara['site_choices'])
+        schedulerCache[key] = [scheduler, [masterDir], {}]
+    finally:
+        schedulerLock.release()
+    source = sitestats.getSource(userPara['site_stats'], username, userPara['site_stats_hours'])
+    def done(statsBySite, error):
+        if error:
+            print 'WARNNING: no site statistics, jobs go to all sites. %s' %error
+        schedulerLock.acquire()
+        try:
+            scheduler.update(statsBySite)
+            schedulerCache[key][2] = statsBySite
+            if scheduler.stats:
+                for path in schedulerCache[key][1]:
+                    sitestats.save(statsBySite, os.path.join(path, 'sites.json'))
+        finally:
+            schedulerLock.release()
+        if scheduler.stats:
+            showSiteWeights(userPara['sites'], scheduler)
+    if userPara['site_stats'] == 'jobs':
+        source = sitestats.CachedSource(source, os.path.join(userPara['index_dir'],\
+                        'sites-%s-%dh.json' %(username, userPara['site_stats_hours'])))
+        statsBySite = source.cached(userPara['sites'])
+        if statsBySite is None:
+            print 'Loading the site statistics from the WMS, jobs go to all sites until they are in.'
+            sitestats.loadInBackground(source, userPara['sites'], done)
+        else:
+            done(statsBySite, None)
+        return scheduler
+    try:
+        done(source.load(userPara['sites']), None)
+    except (IOError, OSError, ValueError), e:
+        done({}, e)
+    return scheduler
+
+def showSiteWeights(sites, scheduler):
+    weights = scheduler.weights()
+    total = sum(weights.values())
+    for site in sites:
+        s = scheduler.stats[site]
+        print '%-28s %8.1f jobs/h %6.1f%% failed %6.0f pending  weight %5.1f%%' %(site, s.rate(),\
+                100.0 * s.failed / max(s.completed + s.failed, 1), s.pending, 100.0 * weights[site] / total)
 
 def getBatchPara(userPara, batch):
     if (userPara['batch'] == 1 and userPara['evtstart'] == 0):
@@ -621,49 +907,604 @@ def getBatchPara(userPara, batch):
     batchEvtStart = str( userPara['evtstart'] + userPara['evtmax'] * batch )
     return (batchStr, batchEvtStart)
 
-def splitAndSubmit(userPara):
+def getEventsPerJob(userPara):
+    return max(1, int(userPara['target_walltime'] / userPara['seconds_per_event']))
+
+@stats.timed('getEventCounts')
+def getEventCounts(userPara, inputDataList):
+    # {filepath: (events, source)} when jobs are sized by target_walltime, else None
+    if not userPara.get('target_walltime'):
+        return None
+    eventCounts = stdhep.countEvents(inputDataList, userPara['index_dir'], userPara['discovery_threads'],\
+                                        userPara.get('bytes_per_event'))
+    fromHeader = len([1 for n, source in eventCounts.values() if source == 'header'])
+    print '%d events in %d input files, %d counted from headers, %d estimated from size.' %(\
+            sum([n for n, source in eventCounts.values()]), len(eventCounts), fromHeader,\
+            len(eventCounts) - fromHeader)
+    return eventCounts
+
+def getFileBatches(userPara, filepath, eventCounts=None):
+    # -> [(batch, batchStr, batchEvtStart, evtmax)] of the jobs of one input file
+    if eventCounts is None:
+        return [(batch,) + getBatchPara(userPara, batch) + (userPara['evtmax'],)\
+                for batch in range(userPara['batch'])]
+    slices = stdhep.splitEvents(eventCounts[filepath][0], userPara['evtstart'], getEventsPerJob(userPara))
+    batches = []
+    for batch, (evtStart, nEvents) in enumerate(slices):
+        if len(slices) == 1 and userPara['evtstart'] == 0:
+            batchStr = ''
+        else:
+            batchStr = '_%05d' %(batch + 1)
+        batches.append((batch, batchStr, str(evtStart), nEvents))
+    return batches
+
+def getJobBatches(userPara, filepath, eventCounts=None, parameters=None):
+    if parameters:
+        # DIRAC fills the batch number in for %s, job.py puts it into the files
+        return [(None, '_%s', '@evtStart@', userPara['evtmax'])]
+    return getFileBatches(userPara, filepath, eventCounts)
+
+def planOutputData(userPara, dfcprefix, inputDataList, eventCounts=None, parameters=None, submitted={}):
+    # the output LFNs setVarPara gives the jobs that are not submitted yet
+    lfns = []
+    for filepath, filesize, filename in inputDataList:
+        name_wo_ext = os.path.splitext(filename)[0]
+        for batch, batchStr, batchEvtStart, evtmax in getJobBatches(userPara, filepath, eventCounts, parameters):
+            if submitted.has_key(journal.jobKey(filepath, batch)):
+                continue
+            for lfn in getOutputData(userPara, dfcprefix, name_wo_ext, batchStr):
+                if parameters:
+                    lfns.extend([lfn[4:].replace('%s', value) for value in parameters])
+                else:
+                    lfns.append(lfn[4:])
+    return lfns
+
+@stats.timed('cleanOutputData')
+def cleanOutputData(outputLFNs, listing=None):
+    # outputs left in the DFC by an earlier production would fail the upload of the new jobs
+    clients = getCatalogClients()
+    fcc, rm = clients.acquire()
+    try:
+        result = catalog.cleanOutputData(outputLFNs, fcc, rm, listing=listing)
+    finally:
+        clients.release((fcc, rm))
+    print '%d of %d output files are already registered in DFC, %d removed.' %(len(result['stale']),\
+            len(outputLFNs), len(result['removed']))
+    for path in result['unlisted']:
+        print 'WARNNING: failed to list %s, its jobs will check their output files themselves.' %path
+    stats.count('outputs_removed', len(result['removed']))
+    return result
+
+def getSlicePath(userPara, filepath, evtStart, nEvents):
+    # the range is in the name, so a slice is only reused for the same events
+    name_wo_ext = os.path.splitext(os.path.basename(filepath))[0]
+    return os.path.join(userPara['slice_dir'], os.path.dirname(filepath).lstrip('/'),\
+                        '%s.%s-%d.stdhep' %(name_wo_ext, evtStart, nEvents))
+
+@stats.timed('sliceInputData')
+def sliceInputData(userPara, inputDataList, eventCounts=None, state=None):
+    # -> {filepath: {batch: (slice path, size, slice filename, events)}} for
+    # the jobs to generate of the files with several jobs, so that each job
+    # transfers only its own events instead of the whole file. A batch past
+    # the last event of its file maps to None, it has nothing to simulate.
+    done = {}
+    if state:
+        done.update(state['submitted'])
+        done.update(state['generated'])
+    plans = {}
+    tasks = []
+    reused = {}
+    for filepath, filesize, filename in inputDataList:
+        batches = getFileBatches(userPara, filepath, eventCounts)
+        if len(batches) < 2:
+            continue
+        try:
+            mtime = os.stat(filepath).st_mtime
+        except OSError, e:
+            print 'WARNNING: %s is not sliced, its jobs read the whole file. %s' %(filepath, e)
+            continue
+        plan = []
+        toWrite = []
+        for batch, batchStr, batchEvtStart, evtmax in batches:
+            if done.has_key(journal.jobKey(filepath, batch)):
+                continue
+            path = getSlicePath(userPara, filepath, batchEvtStart, evtmax)
+            plan.append((batch, path))
+            counts = None
+            if os.path.isfile(path) and os.path.getmtime(path) >= mtime:
+                counts = stdhep.readHeader(path)
+            if counts:
+                reused[path] = counts[1]
+            else:
+                toWrite.append(((int(batchEvtStart), evtmax), path))
+        if plan:
+            plans[filepath] = (filesize, plan)
+        if toWrite:
+            tasks.append((filepath, [r for r, path in toWrite], [path for r, path in toWrite]))
+    results = stdhep.sliceFiles(tasks, userPara['discovery_threads'])
+    events = dict(reused)
+    for filepath, ranges, outputs in tasks:
+        if not isinstance(results[filepath], str):
+            events.update(zip(outputs, results[filepath]))
+    slices = {}
+    wholeBytes = 0
+    sliceBytes = 0
+    empty = 0
+    for filepath, (filesize, plan) in plans.items():
+        if isinstance(results.get(filepath), str):
+            print 'WARNNING: %s is not sliced, its jobs read the whole file. %s' %(filepath, results[filepath])
+            continue
+        slices[filepath] = {}
+        for batch, path in plan:
+            if not events[path]:
+                slices[filepath][batch] = None
+                empty += 1
+                continue
+            size = os.path.getsize(path)
+            slices[filepath][batch] = (path, size, os.path.basename(path), events[path])
+            wholeBytes += filesize
+            sliceBytes += size
+    written = sum([len(outputs) for filepath, ranges, outputs in tasks if not isinstance(results[filepath], str)])
+    stats.count('slices_written', written)
+    stats.count('jobs_empty', empty)
+    print '%d input files sliced for %d jobs, %d slices written. %.1f MB to transfer instead of %.1f MB.' %(\
+            len(slices), sum([len(s) for s in slices.values()]) - empty, written, sliceBytes / 1e6, wholeBytes / 1e6)
+    if empty:
+        print '%d jobs start past the last event of their input file, they are not submitted.' %empty
+    return slices
+
+def getBulkBatchPara(userPara):
+    # batch numbers become the parameters of one parametric job per file,
+    # job.py derives its first event from the number it is started with
+    firstBatch = userPara['evtstart'] // userPara['evtmax'] + 1
+    parameters = ['%05d' %(firstBatch + batch) for batch in range(userPara['batch'])]
+    paraEvtStart = "%d + %d * (int(jobArgs['batchStr'][1:]) - %d)" %(userPara['evtstart'], userPara['evtmax'],\
+                    firstBatch)
+    return (parameters, paraEvtStart)
+
+def startProduction(userPara, resumeDir=None):
+    # a production is a pipeline: discovery -> registration (prepareInputs)
+    # -> generation (generateJobs) -> the submit pool of runProductions, each
+    # stage at most a few chunks of files ahead of the next one.
+    # -> production dict for runProductions
     jobPara = {}
     jobPara['evtmax'] = userPara['evtmax']
-    inputDataList = getInputDataList(userPara)
-    jobPara['totalFiles'] = len(inputDataList)
-    jobPara['totalJobs'] = jobPara['totalFiles'] * userPara['batch']
-    print 'There are %d input .stdhep files to be processed.' %jobPara['totalFiles']
+    # the stats.json of the production, counted in the stats of the run too
+    prodStats = stats.Stats(stats.get())
+    if resumeDir:
+        # inputs, registration and generated jobs come from the journal
+        masterDir = resumeDir
+        state = journal.load(masterDir)
+        inputs = state['inputs']
+        known = set([item[0] for item in inputs])
+        if not state['discovered']:
+            # the earlier run stopped while files were still being found
+            inputs = itertools.chain(inputs, (item for item in iterInputData(userPara) if not item[0] in known))
+    else:
+        state = None
+        inputs = iterInputData(userPara)
+        known = set()
+    chunkSize = userPara['pipeline_chunk']
+    chunks = iter(pipeline.Stage(pipeline.timed('discoverInputData', pipeline.chunks(inputs, chunkSize,\
+                    min(chunkSize, firstChunkSize))), pipeline.defaultDepth, 'discovery', prodStats))
+    # no master directory when there is nothing to submit
+    chunks = itertools.chain(list(itertools.islice(chunks, 1)), chunks)
 
-    masterDir = createMasterRepoDir(userPara['repo_dir'])
+    if not resumeDir:
+        masterDir = createMasterRepoDir(userPara['repo_dir'])
+    jrnl = journal.Journal(masterDir)
+    manifest = repository.Manifest(masterDir)
+    if not resumeDir:
+        userPara['dirac_job_group'] = getJobGroup(userPara)
+        jrnl.record('userPara', userPara)
+        jrnl.record('discovering')
+        state = journal.load(masterDir)
     work_dir = userPara['work_dir']
     dfcprefix = getDFCprefix()
-    evtMacroTemp = prepareEvtMacro(work_dir)
-    simuMacroTemp = prepareSimuMacro(work_dir)
-    recoXML = prepareRecoXML(work_dir, masterDir)
+    compiled = getTemplates(work_dir)
+    preparePandora(work_dir, masterDir)
     jobPara = setFixedPara(jobPara, userPara, masterDir)
+    previous = stats.use(prodStats)
+    try:
+        scheduler = getSiteScheduler(userPara, masterDir, getUsername())
+    finally:
+        stats.use(previous)
+    # job.py imports the retry policy, the log analysis and the DB selection from its sandbox
+    for module in getJobModules(jobPara):
+        jobPara['inputSandbox'].append(sandbox.storeModule(masterDir, module))
 
+    parameters = None
+    if userPara['parametric'] and userPara['batch'] > 1:
+        parameters, jobPara['paraEvtStart'] = getBulkBatchPara(userPara)
+        jobPara['parameters'] = parameters
+    sharedFiles = None
+    if userPara['sandbox'] == 'shared':
+        sharedFiles = prepareSharedSandbox(masterDir, jobPara, compiled[0], compiled[1], compiled[2], userPara)
+
+    prepared = pipeline.Stage(prepareInputs(userPara, jrnl, state, known, chunks, dfcprefix, parameters),\
+                                pipeline.defaultDepth, 'registration', prodStats)
+    # the totals are counted as the jobs go by
+    prod = {'userPara': userPara, 'masterDir': masterDir, 'jrnl': jrnl, 'manifest': manifest, 'stats': prodStats,\
+            'prepared': prepared,\
+            'totalFiles': 0, 'totalJobs': 0, 'jobsOK': 0, 'filesFailed': set(), 'issued': 0}
+    prod['jobs'] = generateJobs(prod, jobPara, prepared, state, parameters, dfcprefix, compiled, sharedFiles, scheduler)
+    return prod
+
+def prepareInputs(userPara, jrnl, state, known, chunks, dfcprefix, parameters):
+    # records, counts, slices and registers every chunk of input files and
+    # removes the stale outputs of its jobs, in a thread of its own;
+    # -> (chunk, eventCounts, slices, registered) per chunk
+    regCache = openRegisteredCache(userPara)
+    listing = {}
+    nfiles = 0
+    for chunk in chunks:
+        for item in chunk:
+            if not item[0] in known:
+                jrnl.record('input', *item)
+        nfiles += len(chunk)
+        eventCounts = getEventCounts(userPara, chunk)
+        slices = {}
+        if userPara['slice_inputs']:
+            slices = sliceInputData(userPara, chunk, eventCounts, state)
+        # a file is not registered when all its jobs to generate read slices of it
+        items = [item for item in chunk if not slices.has_key(item[0])]
+        for fileSlices in slices.values():
+            items.extend([item for item in fileSlices.values() if item])
+        registered = dict((item[0], state['registered'][item[0]]) for item in items\
+                            if state['registered'].has_key(item[0]))
+        toRegister = [item for item in items if not registered.has_key(item[0])]
+        if toRegister:
+            for filepath, rzt in registerInputData(toRegister, userPara, regCache).items():
+                registered[filepath] = rzt
+                jrnl.record('registered', filepath, rzt)
+        cleanOutputData(planOutputData(userPara, dfcprefix, chunk, eventCounts, parameters, state['submitted']), listing)
+        yield chunk, eventCounts, slices, registered
+    if regCache:
+        saveRegisteredCache(regCache)
+    jrnl.record('discovered', nfiles)
+
+def generateJobs(prod, jobPara, prepared, state, parameters, dfcprefix, compiled, sharedFiles, scheduler):
+    # yields the jobs of a production to submit, generating their files on the
+    # way, and None while its next chunk of files is still being registered
+    userPara = prod['userPara']
+    masterDir = prod['masterDir']
+    evtMacroTemp, simuMacroTemp, recoXML = compiled
     job_count = 1
-    file_count = 0
-    for filepath, filesize, filename in inputDataList:        
-        rzt = registerInputData(filepath, filesize)
-        name_wo_ext = os.path.splitext(filename)[0]
-        for batch in range(userPara['batch']):
-            batchStr, batchEvtStart = getBatchPara(userPara, batch)
-            subdir = os.path.join(masterDir, repr(job_count))
-            os.mkdir(subdir)
-            generateEvtMacro(subdir, evtMacroTemp, userPara, filename) 
-            generateSimuMacro(subdir, simuMacroTemp, name_wo_ext, batchStr, batchEvtStart)
-            generateRecoXML(subdir, recoXML, name_wo_ext, batchStr)
-            setVarPara(jobPara, dfcprefix, masterDir, subdir, name_wo_ext, rzt['lfn'], batchStr)
-            generateJobScript(subdir,jobPara,batchEvtStart)
-            submitJob(jobPara)
-            job_count += 1
-        file_count += 1
-    
+    chunks = iter(prepared)
+    while True:
+        if not prepared.ready():
+            yield None
+            continue
+        try:
+            chunk, eventCounts, slices, registered = chunks.next()
+        except StopIteration:
+            return
+        for filepath, filesize, filename in chunk:
+            prod['totalFiles'] += 1
+            name_wo_ext = os.path.splitext(filename)[0]
+            fileSlices = slices.get(filepath, {})
+            for batch, batchStr, batchEvtStart, evtmax in getJobBatches(userPara, filepath, eventCounts, parameters):
+                if fileSlices.has_key(batch) and not fileSlices[batch]:
+                    # past the last event of the file, see sliceInputData
+                    job_count += 1
+                    continue
+                prod['totalJobs'] += len(parameters or [None])
+                key = journal.jobKey(filepath, batch)
+                if state['submitted'].has_key(key):
+                    # done in an earlier run of this master directory
+                    prod['jobsOK'] += len(parameters or [None])
+                    stats.count('jobs_skipped', len(parameters or [None]))
+                    job_count += 1
+                    continue
+                if state['generated'].has_key(key):
+                    stats.count('jobs_resubmitted', len(parameters or [None]))
+                    prod['manifest'].addJob(job_count, key, filepath, batch, state['generated'][key]['outputData'])
+                    state['generated'][key]['masterDir'] = masterDir
+                    yield state['generated'][key]
+                    job_count += 1
+                    continue
+                fileSlice = fileSlices.get(batch)
+                if fileSlice:
+                    # the slice starts with the first event of the job and may hold fewer than asked
+                    inputPath, inputName, inputEvtStart = fileSlice[0], fileSlice[2], '0'
+                    evtmax = fileSlice[3]
+                else:
+                    inputPath, inputName, inputEvtStart = filepath, filename, batchEvtStart
+                rzt = registered.get(inputPath)
+                if not (rzt and rzt['OK']):
+                    # its input is not in the DFC, the job is lost until a resume registers it
+                    if not filepath in prod['filesFailed']:
+                        print 'ERROR: %s is not registered in DFC, its jobs are not submitted. %s' %(inputPath,\
+                                rzt and rzt.get('Message', '') or '')
+                    prod['filesFailed'].add(filepath)
+                    stats.count('jobs_unregistered', len(parameters or [None]))
+                    job_count += 1
+                    continue
+                if parameters:
+                    fileBatchStr = '@batchStr@'
+                else:
+                    fileBatchStr = batchStr
+                subdir = repository.jobDir(masterDir, job_count)
+                # every job in flight needs its own copy of the variable parameters
+                thisJobPara = dict(jobPara)
+                thisJobPara['inputSandbox'] = list(jobPara['inputSandbox'])
+                thisJobPara['masterDir'] = masterDir
+                thisJobPara['inputFile'] = filepath
+                thisJobPara['jobKey'] = key
+                thisJobPara['sites'] = scheduler.assign(len(parameters or [None]))
+                setVarPara(thisJobPara, userPara, dfcprefix, masterDir, subdir, name_wo_ext, rzt['lfn'], batchStr)
+                jobArgs = {'inputFile': inputName, 'batchStr': batchStr, 'evtStart': inputEvtStart,\
+                            'evtmax': str(evtmax), 'sim': thisJobPara['outputData'][0],\
+                            'rec': thisJobPara['outputData'][1]}
+                if fileSlice:
+                    jobArgs['name'] = name_wo_ext
+                if parameters:
+                    del jobArgs['evtStart']
+                if sharedFiles:
+                    # nothing is written per job, the parameters go in as arguments
+                    baked = {}
+                    for i, path in sharedFiles:
+                        thisJobPara['inputSandbox'][i] = path
+                else:
+                    if not os.path.isdir(subdir):
+                        os.makedirs(subdir)
+                    generateJobFiles(subdir, evtMacroTemp, simuMacroTemp, recoXML, filename,\
+                                        fileBatchStr, inputEvtStart, evtmax, inputName)
+                    if parameters:
+                        baked = {'inputFile': filename}
+                    else:
+                        baked = jobArgs
+                    generateJobScript(subdir, thisJobPara, baked)
+                arguments = dict((k, v) for k, v in jobArgs.items() if not baked.has_key(k))
+                if arguments:
+                    thisJobPara['arguments'] = jobArguments(arguments)
+                prod['jrnl'].record('generated', key, thisJobPara)
+                prod['manifest'].addJob(job_count, key, filepath, batch, thisJobPara['outputData'])
+                yield thisJobPara
+                job_count += 1
+
+def runProductions(prods, workers=1, inflight=0):
+    # generation happens here while up to inflight jobs are submitted by
+    # workers threads, each reusing its own Dirac() client for all productions.
+    # The next job always comes from the production with the fewest jobs
+    # handed to the pool so far among those with a job ready, so neither a
+    # large one nor one with a slow registration holds the others back.
+    byMasterDir = dict((prod['masterDir'], prod) for prod in prods)
+    def submit(jobPara, dirac):
+        stats.use(byMasterDir[jobPara['masterDir']]['stats'])
+        return submitJob(jobPara, dirac)
+    pool = submitpool.SubmitPool(submit, backend.get().Dirac, workers, inflight)
+    progress = stats.Progress()
+    def collect(results):
+        for submittedPara, result in results:
+            prod = byMasterDir[submittedPara['masterDir']]
+            reportSubmit(submittedPara, result)
+            njobs = len(submittedPara.get('parameters', [None]))
+            if result['OK']:
+                prod['jobsOK'] += njobs
+                prod['stats'].count('jobs_submitted', njobs)
+                prod['jrnl'].record('submitted', submittedPara['jobKey'], result['Value'])
+                prod['manifest'].setJobIDs(submittedPara['jobKey'], result['Value'], submittedPara.get('parameters'))
+            else:
+                prod['stats'].count('jobs_failed', njobs)
+                prod['filesFailed'].add(submittedPara['inputFile'])
+        progress.update(sum([prod['jobsOK'] for prod in prods]),\
+                        sum([prod['stats'].counters.get('jobs_failed', 0) for prod in prods]))
+
+    active = list(prods)
+    prepared = threading.Event()
+    for prod in prods:
+        prod['prepared'].notify = prepared
+    try:
+        while active:
+            prepared.clear()
+            waiting = True
+            for prod in sorted(active, key=lambda p: p['issued']):
+                # the jobs are generated here, into the stats of their production
+                stats.use(prod['stats'])
+                try:
+                    thisJobPara = prod['jobs'].next()
+                except StopIteration:
+                    active.remove(prod)
+                    waiting = False
+                    break
+                if thisJobPara is not None:
+                    prod['issued'] += len(thisJobPara.get('parameters', [None]))
+                    pool.submit(thisJobPara)
+                    waiting = False
+                    break
+            if waiting:
+                # every production waits for its registration
+                prepared.wait(0.1)
+            collect(pool.ready())
+    finally:
+        stats.use(None)
+    collect(pool.close())
+    return [finishProduction(prod, len(prods) > 1) for prod in prods]
+
+def finishProduction(prod, named=False):
+    masterDir = prod['masterDir']
+    prod['jrnl'].close()
+    prod['manifest'].close()
+    # the retry counters are the ones of the DFC policy all productions share
+    prod['stats'].write(os.path.join(masterDir, 'stats.json'), {'retry': retry.summary()})
+
+    if named:
+        print '%s:' %masterDir
+    file_count = prod['totalFiles'] - len(prod['filesFailed'])
     print '%d of %d input files are successfully processed. %d lost.' %(file_count, \
-                                jobPara['totalFiles'], (jobPara['totalFiles'] - file_count)) 
-    print '%d of %d jobs are successfully processed. %d lost.' %(job_count -1, \
-                                jobPara['totalJobs'], (jobPara['totalJobs'] - (job_count-1))) 
+                                prod['totalFiles'], (prod['totalFiles'] - file_count)) 
+    print '%d of %d jobs are successfully processed. %d lost.' %(prod['jobsOK'], \
+                                prod['totalJobs'], (prod['totalJobs'] - prod['jobsOK'])) 
+    if prod['jobsOK'] < prod['totalJobs']:
+        print 'Run "dsub --resume %s" to submit the lost jobs.' %masterDir
+    return {'masterDir': masterDir, 'totalFiles': prod['totalFiles'], 'filesOK': file_count,\
+            'totalJobs': prod['totalJobs'], 'jobsOK': prod['jobsOK']}
+
+def splitAndSubmit(userPara, resumeDir=None):
+    selectBackend(userPara)
+    prod = startProduction(userPara, resumeDir)
+    return runProductions([prod], userPara['submit_workers'], userPara['submit_inflight'])[0]
+
+def submitProductions(userParaList):
+    # several productions in one process: the proxy, the catalog clients, the
+    # templates of a work_dir and the site statistics are loaded once, and all
+    # jobs go through one submit pool as large as the largest one asked for
+    selectBackend(userParaList[0])
+    prods = [startProduction(userPara) for userPara in userParaList]
+    return runProductions(prods, max([userPara['submit_workers'] for userPara in userParaList]),\
+                            max([userPara['submit_inflight'] for userPara in userParaList]))
+
+def resumeUserPara(masterDir):
+    state = journal.load(masterDir)
+    if not (state and state['userPara']):
+        print 'ERROR: %s has no dsub journal to resume from.' %masterDir
+        sys.exit(1)
+    userPara = state['userPara']
+    if not userPara.has_key('dirac_job_group'):
+        # journals written before job_group was resolved at submission
+        userPara['dirac_job_group'] = userPara['job_group']
+    selectBackend(userPara)
+    return userPara
+
+@stats.timed('queryStatus')
+def queryStatus(masterDir):
+    # -> userPara, journal state, {jobID: (jobKey, position)}, {jobID: summary}
+    userPara = resumeUserPara(masterDir)
+    state = journal.load(masterDir)
+    ids = monitor.jobIDs(state)
+    print 'Query the status of %d jobs of %s.' %(len(ids), masterDir)
+    return userPara, state, ids, monitor.querySummaries(ids.keys())
+
+def showStatus(masterDir, codes=monitor.retryableCodes):
+    userPara, state, ids, summaries = queryStatus(masterDir)
+    byStatus, byCode = monitor.aggregate(summaries)
+    monitor.report(byStatus, byCode, len(ids), codes)
+    unsubmitted = len([key for key in state['generated'] if not state['submitted'].has_key(key)])
+    if unsubmitted:
+        print '%d generated jobs were never submitted. Run "dsub --resume %s" to submit them.' %(unsubmitted,\
+                masterDir)
+    return byStatus, byCode
+
+def resubmitFailed(masterDir, codes=monitor.retryableCodes, maxResubmit=3, dryRun=False):
+    userPara, state, ids, summaries = queryStatus(masterDir)
+    byStatus, byCode = monitor.aggregate(summaries)
+    monitor.report(byStatus, byCode, len(ids), codes)
+    # the failed jobs of a parametric job go out again as one job with their parameters
+    groups = {}
+    exhausted = 0
+    for jobID in monitor.retryable(summaries, codes):
+        if state['resubmits'].get(jobID, 0) >= maxResubmit:
+            exhausted += 1
+            continue
+        key, position = ids[jobID]
+        groups.setdefault(key, []).append((position, jobID))
+    total = sum([len(jobs) for jobs in groups.values()])
+    print '%d failed jobs to resubmit, %d given up after %d resubmissions.' %(total, exhausted, maxResubmit)
+    if dryRun or not total:
+        return 0
+
+    jrnl = journal.Journal(masterDir)
+    manifest = repository.Manifest(masterDir)
+    pool = submitpool.SubmitPool(submitJob, backend.get().Dirac, userPara['submit_workers'], userPara['submit_inflight'])
+    def collect(results):
+        ok = 0
+        for jobPara, result in results:
+            reportSubmit(jobPara, result)
+            if not result['OK']:
+                stats.count('jobs_failed', len(jobPara['oldIDs']))
+                continue
+            newIDs = result['Value']
+            if not isinstance(newIDs, list):
+                newIDs = [newIDs]
+            for oldID, newID in zip(jobPara['oldIDs'], newIDs):
+                jrnl.record('resubmitted', jobPara['jobKey'], oldID, newID)
+                manifest.replaceJobID(oldID, newID)
+            ok += len(newIDs)
+            stats.count('jobs_resubmitted', len(newIDs))
+        return ok
+    jobs_ok = 0
+    for key, jobs in sorted(groups.items()):
+        # the job files generated in the subdirectory are submitted as they are
+        jobPara = dict(state['generated'][key])
+        jobPara['oldIDs'] = [jobID for position, jobID in jobs]
+        if jobPara.has_key('parameters'):
+            jobPara['parameters'] = [jobPara['parameters'][position] for position, jobID in jobs]
+        pool.submit(jobPara)
+        jobs_ok += collect(pool.ready())
+    jobs_ok += collect(pool.close())
+    jrnl.close()
+    manifest.close()
+    print '%d of %d failed jobs are resubmitted.' %(jobs_ok, total)
+    return jobs_ok
+
+def parseExitCodes(value):
+    # '11,21,grid' -> [11, 21, None]
+    codes = []
+    for item in value.split(','):
+        item = item.strip()
+        if item == 'grid':
+            codes.append(None)
+        elif item:
+            codes.append(int(item))
+    return codes
+
+def parseCommandLine():
+    # -> ([(switch, value)], [positional args])
+    try:
+        Script = backend.initDIRAC(dsubSwitches, ignoreErrors = False)
+        return Script.getUnprocessedSwitches(), Script.getPositionalArgs()
+    except ImportError:
+        # no DIRAC client here, only a 'backend = local' dry run will work
+        opts, args = getopt.gnu_getopt(sys.argv[1:], '', [switch[1] for switch in dsubSwitches])
+        return [(key.lstrip('-'), value) for key, value in opts], args
 
 if __name__ == '__main__':
-    cfg_file = sys.argv[1]
-    userPara = getUserPara(cfg_file)
-    checkUserPara(userPara)
-    splitAndSubmit(userPara)
+    switches, args = parseCommandLine()
+    resumeDir = None
+    clearCache = False
+    codes = monitor.retryableCodes
+    maxResubmit = 3
+    dryRun = False
+    productionList = None
+    for switch, value in switches:
+        if switch == 'resume':
+            resumeDir = os.path.abspath(value)
+        elif switch == 'clear-cache':
+            clearCache = True
+        elif switch == 'exit-codes':
+            codes = parseExitCodes(value)
+        elif switch == 'max-resubmit':
+            maxResubmit = int(value)
+        elif switch == 'dry-run':
+            dryRun = True
+        elif switch == 'productions':
+            productionList = value
+    if args and args[0] in ['status', 'resubmit']:
+        if len(args) != 2:
+            print 'Usage: dsub status|resubmit <masterDir>'
+            sys.exit(1)
+        if args[0] == 'status':
+            showStatus(os.path.abspath(args[1]), codes)
+        else:
+            resubmitFailed(os.path.abspath(args[1]), codes, maxResubmit, dryRun)
+        sys.exit(0)
+    if resumeDir:
+        userParaList = [resumeUserPara(resumeDir)]
+    else:
+        cfgFiles = args + (productionList and readProductionList(productionList) or [])
+        if not cfgFiles:
+            print 'Usage: dsub job.cfg [job2.cfg ...] | --productions=<list> | --resume <masterDir>'
+            sys.exit(1)
+        userParaList = checkProductions(cfgFiles)
+    for userPara in userParaList:
+        regCache = clearCache and openRegisteredCache(userPara)
+        if regCache:
+            regCache.invalidate()
+            regCache.save()
+    if resumeDir:
+        splitAndSubmit(userParaList[0], resumeDir)
+    else:
+        submitProductions(userParaList)
 
 ## << END OF FILE >> ##
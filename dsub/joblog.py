@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# title: simu.log and reco.log analysis for job.py
+#
+# Shipped in the input sandbox with job.py. A log is read once, in large
+# blocks, looking for every known signature at the same time, and the last
+# event is taken from a few blocks read backwards from the end of the file,
+# instead of a grep per signature and tail | grep | awk pipes over logs that
+# can be several GB.
+#
+# While Mokka and Marlin run, run() follows their log for event numbers,
+# reports the event rate through setApplicationStatus at most every few
+# minutes and kills a run that has not made progress for stallTimeout. Only
+# Mokka is watched by default: the event lines of Marlin depend on its
+# processors, so its stall timeout is 0 unless reco_stall_timeout is set.
+import os, re, time, signal, subprocess
+
+blockSize = 1 << 20
+
+# (exit code, job status, signature) in order of precedence
+simuErrors = [(21, 'DB connection failed', 'Database connection failed'),
+              (22, 'Too many substeps', 'Convergence is requiring too many substeps'),
+              (23, 'No events in stdhep', 'Error when reading hep file; probably ran out of events')]
+simuErrorCode = 20
+recoErrorCode = 30
+
+
+def scan(path, patterns):
+    """Return the set of patterns that occur in the file, in one read."""
+    found = set()
+    overlap = max([len(p) for p in patterns] + [1]) - 1
+    f = open(path, 'rb')
+    try:
+        previous = ''
+        while len(found) < len(patterns):
+            block = f.read(blockSize)
+            if not block:
+                break
+            text = previous + block
+            for pattern in patterns:
+                if pattern not in found and text.find(pattern) != -1:
+                    found.add(pattern)
+            previous = text[-overlap:] if overlap else ''
+    finally:
+        f.close()
+    return found
+
+def tailLines(path, n=20):
+    """Return the last n lines of the file, reading backwards from its end."""
+    f = open(path, 'rb')
+    try:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = ''
+        while pos > 0 and data.count('\n') <= n:
+            size = min(blockSize, pos)
+            pos -= size
+            f.seek(pos)
+            data = f.read(size) + data
+    finally:
+        f.close()
+    return data.splitlines()[-n:]
+
+def lastEvent(lines):
+    # the 5th field of the last 'Event' line, as awk '{print $5}' gave it
+    for line in reversed(lines):
+        if line.find('Event') != -1:
+            fields = line.split()
+            if len(fields) >= 5 and fields[4].lstrip('-').isdigit():
+                return int(fields[4])
+    return 0
+
+def analyzeSimu(path, batchEvtStart):
+    """Classify a failed Mokka run. Returns a dict with 'exitCode' (0 when the
+    job can go on with the events simulated so far), the job 'statuses' to
+    report, 'lastEvent' and the 'tail' lines with errors and events.
+    """
+    result = {'exitCode': simuErrorCode, 'statuses': ['Simulation Error'], 'lastEvent': 0, 'tail': []}
+    found = scan(path, [signature for code, status, signature in simuErrors])
+    for code, status, signature in simuErrors:
+        if signature not in found:
+            continue
+        if code != 23:
+            result['exitCode'] = code
+            result['statuses'] = [status]
+            return result
+        lines = tailLines(path)
+        result['tail'] = [line for line in lines if line.find('Error') != -1 or line.find('Event') != -1]
+        result['lastEvent'] = lastEvent(lines)
+        result['statuses'] = ['Run out of events: %d' %result['lastEvent']]
+        result['exitCode'] = 0
+        if result['lastEvent'] == batchEvtStart:
+            result['statuses'].append(status)
+            result['exitCode'] = code
+        return result
+    return result
+
+def analyzeReco(path, nEvents):
+    """Check that Marlin wrote nEvents events. Returns a dict with 'exitCode'
+    (0 or 30), 'statuses' and the success line 'found'.
+    """
+    patterns = ['MyLCIOOutputProcessor: %d events in 1 runs written to file' %nEvents,
+                'MyLCIOOutputProcessor: +%d events in +1 runs written to file' %nEvents]
+    found = bool(scan(path, patterns))
+    if found:
+        return {'exitCode': 0, 'statuses': [], 'found': True}
+    return {'exitCode': recoErrorCode, 'statuses': ['Reconstruction Error'], 'found': False}
+
+
+# progress while Mokka and Marlin run, from the event numbers in their logs
+eventPattern = re.compile(r'\b[Ee]vent\b\D{0,20}?(\d+)')
+defaultStallTimeout = 3600
+defaultRecoStallTimeout = 0
+defaultStatusInterval = 300
+pollInterval = 10
+killGrace = 30
+simuStallCode = 24
+recoStallCode = 31
+
+
+class LogFollower(object):
+    # reads what was appended to a log since the last poll
+
+    def __init__(self, path, pattern=eventPattern):
+        self.path = path
+        self.pattern = pattern
+        self.offset = 0
+        self.partial = ''
+        self.first = None
+        self.last = None
+
+    def events(self):
+        if self.first is None:
+            return 0
+        return self.last - self.first + 1
+
+    def poll(self):
+        # True if the log shows a new event
+        try:
+            f = open(self.path, 'rb')
+        except IOError:
+            return False
+        try:
+            f.seek(self.offset)
+            data = f.read()
+        finally:
+            f.close()
+        if not data:
+            return False
+        self.offset += len(data)
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        before = self.last
+        for line in lines:
+            match = self.pattern.search(line)
+            if match:
+                number = int(match.group(1))
+                if self.first is None:
+                    self.first = number
+                if self.last is None or number > self.last:
+                    self.last = number
+        return self.last != before
+
+
+def run(cmd, logPath, stage, report, total=0, stallTimeout=defaultStallTimeout, statusInterval=defaultStatusInterval,\
+        cwd=None):
+    """Run cmd in cwd while following its log. report(message) gets the
+    event rate at most every statusInterval seconds. The run is killed when
+    no new event shows up for stallTimeout seconds (0 never). Returns
+    (exit code, stalled).
+    """
+    proc = subprocess.Popen(cmd, preexec_fn=os.setsid, cwd=cwd)
+    follower = LogFollower(logPath)
+    start = time.time()
+    lastProgress = start
+    lastReport = start
+    while proc.poll() is None:
+        time.sleep(min(pollInterval, statusInterval))
+        now = time.time()
+        if follower.poll():
+            lastProgress = now
+        if now - lastReport >= statusInterval:
+            lastReport = now
+            rate = follower.events() / max(now - start, 1e-6)
+            message = '%s: %d' %(stage, follower.events())
+            if total:
+                message += '/%d' %total
+            report(message + ' events, %.3f evt/s' %rate)
+        if stallTimeout and now - lastProgress > stallTimeout:
+            stop(proc)
+            return proc.returncode, True
+    follower.poll()
+    return proc.returncode, False
+
+def stop(proc, grace=None):
+    """Terminate the process group of proc, killing it only if some of it
+    is still alive after grace (killGrace) seconds.
+    """
+    if grace is None:
+        grace = killGrace
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except OSError:
+        pass
+    deadline = time.time() + grace
+    while True:
+        proc.poll()
+        try:
+            # fails once no process of the group is left
+            os.killpg(proc.pid, 0)
+        except OSError:
+            break
+        if time.time() > deadline:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            break
+        time.sleep(0.1)
+    proc.wait()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# title: append-only submission journal of a dsub master directory
+#
+# One JSON list per line: [state, key, values...]. Every record is flushed as
+# soon as it is written, so a killed dsub run leaves a journal describing the
+# work it finished, and 'dsub --resume <masterDir>' can pick up from there.
+# 'dsub resubmit' adds a record per job it replaced with a new one. The
+# inputs are recorded while they are found, between 'discovering' and
+# 'discovered'; a journal without the latter stopped before all were found.
+# A torn last line is ignored on loading.
+import os, os.path, json, threading
+
+journalName = 'journal'
+
+
+def jobKey(filepath, batch):
+    if batch is None:
+        return filepath + ':all'
+    return '%s:%d' %(filepath, batch)
+
+def _str(value):
+    # json gives back unicode, DIRAC and the job templates expect plain str
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_str(v) for v in value]
+    if isinstance(value, dict):
+        return dict((_str(k), _str(v)) for k, v in value.items())
+    return value
+
+
+class Journal(object):
+
+    def __init__(self, masterDir):
+        self.path = os.path.join(masterDir, journalName)
+        self.f = open(self.path, 'a')
+        self.lock = threading.Lock()
+
+    def record(self, state, *values):
+        # registration and generation record from different threads
+        line = json.dumps([state] + list(values)) + '\n'
+        self.lock.acquire()
+        try:
+            self.f.write(line)
+            self.f.flush()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+
+
+def load(masterDir):
+    path = os.path.join(masterDir, journalName)
+    if not os.path.isfile(path):
+        return None
+    state = {'userPara': None, 'inputs': [], 'discovered': True, 'registered': {}, 'generated': {},\
+                'submitted': {}, 'resubmits': {}}
+    f = open(path)
+    for line in f:
+        try:
+            record = _str(json.loads(line))
+        except ValueError:
+            continue
+        if record[0] == 'userPara':
+            state['userPara'] = record[1]
+        elif record[0] == 'input':
+            state['inputs'].append(tuple(record[1:4]))
+        elif record[0] in ['discovering', 'discovered']:
+            state['discovered'] = record[0] == 'discovered'
+        elif record[0] == 'registered':
+            # a failed registration is tried again on resume
+            if record[2].get('OK'):
+                state['registered'][record[1]] = record[2]
+            else:
+                state['registered'].pop(record[1], None)
+        elif record[0] == 'generated':
+            state['generated'][record[1]] = record[2]
+        elif record[0] == 'submitted':
+            state['submitted'][record[1]] = record[2]
+        elif record[0] == 'resubmitted':
+            # key, old job ID, new job ID; the new one takes the old one's place
+            key, oldID, newID = record[1:4]
+            value = state['submitted'].get(key)
+            if isinstance(value, list) and oldID in value:
+                value[value.index(oldID)] = newID
+            else:
+                state['submitted'][key] = newID
+            state['resubmits'][newID] = state['resubmits'].pop(oldID, 0) + 1
+    f.close()
+    return state
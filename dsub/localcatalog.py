@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# title: in-memory stand-in for the DIRAC File Catalog
+# usage: python localcatalog.py [nfiles] [latency]
+#
+# Mimics the return values of FileCatalogClient and ReplicaManager closely
+# enough for dsub, with a fixed latency and an optional failure rate per call,
+# so catalog access can be exercised and benchmarked without a DIRAC
+# installation.
+import sys, time, random, threading
+
+
+def S_OK(value=None):
+    return {'OK': True, 'Value': value}
+
+def S_ERROR(message=''):
+    return {'OK': False, 'Message': message}
+
+def _asList(lfns):
+    if isinstance(lfns, basestring):
+        return [lfns]
+    return list(lfns)
+
+
+class LocalFileCatalog(object):
+
+    def __init__(self, latency=0.0, failureRate=0.0, seed=None):
+        self.latency = latency
+        self.failureRate = failureRate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.files = {}
+        self.calls = 0
+        self.failures = 0
+
+    def _call(self):
+        # True if this call should fail
+        self.lock.acquire()
+        self.calls += 1
+        failed = self.failureRate and self.random.random() < self.failureRate
+        if failed:
+            self.failures += 1
+        self.lock.release()
+        if self.latency:
+            time.sleep(self.latency)
+        return failed
+
+    def isFile(self, lfns):
+        if self._call():
+            return S_ERROR('Injected catalog failure')
+        successful = dict((lfn, lfn in self.files) for lfn in _asList(lfns))
+        return S_OK({'Successful': successful, 'Failed': {}})
+
+    def addFile(self, fileDict):
+        if self._call():
+            return S_ERROR('Injected catalog failure')
+        successful = {}
+        for lfn, info in fileDict.items():
+            self.files[lfn] = dict(info)
+            successful[lfn] = True
+        return S_OK({'Successful': successful, 'Failed': {}})
+
+    def listDirectory(self, paths):
+        if self._call():
+            return S_ERROR('Injected catalog failure')
+        successful = {}
+        failed = {}
+        for path in _asList(paths):
+            prefix = path.rstrip('/') + '/'
+            files = dict((lfn, {}) for lfn in self.files if lfn.startswith(prefix) and lfn.find('/', len(prefix)) == -1)
+            if files:
+                successful[path] = {'Files': files, 'SubDirs': {}, 'Links': {}}
+            else:
+                failed[path] = 'No such file or directory'
+        return S_OK({'Successful': successful, 'Failed': failed})
+
+    def removeFile(self, lfns):
+        if self._call():
+            return S_ERROR('Injected catalog failure')
+        successful = {}
+        for lfn in _asList(lfns):
+            self.files.pop(lfn, None)
+            successful[lfn] = True
+        return S_OK({'Successful': successful, 'Failed': {}})
+
+
+class LocalReplicaManager(object):
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+    def removeCatalogFile(self, lfns):
+        result = self.catalog.removeFile(lfns)
+        if not result['OK']:
+            return result
+        successful = dict((lfn, {'FileCatalog': True}) for lfn in result['Value']['Successful'])
+        return S_OK({'Successful': successful, 'Failed': result['Value']['Failed']})
+
+
+if __name__ == '__main__':
+    import catalog
+    nfiles = 2000
+    latency = 0.001
+    if len(sys.argv) > 1:
+        nfiles = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        latency = float(sys.argv[2])
+    inputDataList = [('/cefs/bench/%06d.stdhep' %i, 1024, '%06d.stdhep' %i) for i in range(nfiles)]
+    fcc = LocalFileCatalog(latency)
+    rm = LocalReplicaManager(fcc)
+    # register half of the sample first so the bulk path also removes entries
+    catalog.registerInputDataBulk(inputDataList[::2], fcc, rm)
+    fcc.calls = 0
+    start = time.time()
+    results = catalog.registerInputDataBulk(inputDataList, fcc, rm)
+    elapsed = time.time() - start
+    ok = len([r for r in results.values() if r.get('OK')])
+    print '%d of %d files registered in %.3f s with %d catalog calls (%.0f files/s).' %(ok, nfiles,\
+            elapsed, fcc.calls, nfiles / max(elapsed, 1e-6))
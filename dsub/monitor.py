@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# title: bulk status of the jobs of a dsub master directory
+#
+# The job IDs of a production come from its journal, and their summaries are
+# fetched from the WMS in chunks of statusChunk IDs per call instead of one
+# call per job. job.py reports a distinctive application status right before
+# it exits, which gives back the exit code of a failed job:
+#   11 cvmfs, 20-24 simulation, 30-32 reconstruction
+# Failures of the grid itself (no exit code of job.py) and the classes in
+# retryableCodes are worth resubmitting, the others fail again the same way.
+import retry, backend
+
+statusChunk = 500
+
+# (exit code, application status set by job.py before exiting)
+exitStatuses = [(11, 'cvmfs not found'),
+                (20, 'Simulation Error'),
+                (21, 'DB connection failed'),
+                (22, 'Too many substeps'),
+                (23, 'No events in stdhep'),
+                (24, 'Simulation stalled'),
+                (30, 'Reconstruction Error'),
+                (31, 'Reconstruction stalled'),
+                (32, 'Merge Error')]
+retryableCodes = [11, 21, 24, 31, None]
+failedStatuses = ['Failed', 'Stalled']
+wmsPolicy = retry.RetryPolicy('wms', attempts=5, base=1.0, maxDelay=30.0, deadline=300.0)
+
+
+def exitCode(summary):
+    """Return the exit code of job.py for a failed job's summary, None if the
+    job did not fail in job.py.
+    """
+    applicationStatus = summary.get('ApplicationStatus', '')
+    for code, status in exitStatuses:
+        if applicationStatus == status:
+            return code
+    return None
+
+def describe(code):
+    for c, status in exitStatuses:
+        if c == code:
+            return status
+    return 'grid failure'
+
+def jobIDs(state):
+    """Return {jobID: (jobKey, position)} of the submitted jobs in a journal
+    state, position being the index of a parametric job, else None.
+    """
+    ids = {}
+    for key, value in state['submitted'].items():
+        if isinstance(value, list):
+            for position, jobID in enumerate(value):
+                ids[int(jobID)] = (key, position)
+        else:
+            ids[int(value)] = (key, None)
+    return ids
+
+def querySummaries(ids, chunk=statusChunk, dirac=None):
+    """Return {jobID: summary} for the IDs, chunk at a time. A chunk that
+    keeps failing is left out and reported.
+    """
+    if dirac is None:
+        dirac = backend.get().Dirac()
+    ids = sorted(ids)
+    summaries = {}
+    for i in range(0, len(ids), chunk):
+        part = ids[i:i + chunk]
+        result = wmsPolicy.call(lambda: dirac.getJobSummary(part))
+        if not result['OK']:
+            print 'WARNNING: no status of jobs %d to %d. %s' %(part[0], part[-1], result['Message'])
+            continue
+        for jobID, summary in result['Value'].items():
+            summaries[int(jobID)] = summary
+    return summaries
+
+def aggregate(summaries):
+    """Count the jobs by status and the failed ones by exit code."""
+    byStatus = {}
+    byCode = {}
+    for jobID, summary in summaries.items():
+        status = summary.get('Status', 'Unknown')
+        byStatus[status] = byStatus.get(status, 0) + 1
+        if status in failedStatuses:
+            code = exitCode(summary)
+            byCode[code] = byCode.get(code, 0) + 1
+    return byStatus, byCode
+
+def retryable(summaries, codes=retryableCodes):
+    """Return the sorted IDs of failed jobs with an exit code in codes."""
+    return sorted([jobID for jobID, summary in summaries.items()\
+                    if summary.get('Status') in failedStatuses and exitCode(summary) in codes])
+
+def report(byStatus, byCode, total, codes=retryableCodes):
+    print '%d jobs, %d with a status.' %(total, sum(byStatus.values()))
+    for status, n in sorted(byStatus.items(), key=lambda item: -item[1]):
+        print '    %-24s %8d' %(status, n)
+    if byCode:
+        print 'Failed jobs by exit code:'
+    for code, n in sorted(byCode.items()):
+        print '    %-4s %-22s %6d%s' %(code is None and '-' or code, describe(code), n,\
+                code in codes and '  retryable' or '')
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# title: parallel Mokka runs within one job for job.py
+#
+# Shipped in the input sandbox with job.py when cores > 1. The event range of
+# the job is split into one part per core, each simulated by its own Mokka in
+# a part_<n> directory with its own startEventNumber and random seed, and
+# reconstructed by its own Marlin as soon as its simulation is done. The
+# sim and rec files of the parts are then merged by Marlin into the outputs
+# named in the job's output data.
+import os, os.path, re, random, threading
+import joblog
+
+partPrefix = 'part_'
+mergeErrorCode = 32
+logTailLines = 500
+mergedPattern = re.compile(r'MyLCIOOutputProcessor: +(\d+) events in')
+
+mergeXML = """\
+<marlin>
+ <execute>
+  <processor name="MyLCIOOutputProcessor"/>
+ </execute>
+ <global>
+  <parameter name="LCIOInputFiles"> %s </parameter>
+  <parameter name="SupressCheck" value="false"/>
+ </global>
+ <processor name="MyLCIOOutputProcessor" type="LCIOOutputProcessor">
+  <parameter name="LCIOOutputFile" type="string"> %s </parameter>
+  <parameter name="LCIOWriteMode" type="string"> WRITE_NEW </parameter>
+ </processor>
+</marlin>
+"""
+
+
+# processors the batch system gave the job, by the variable it tells them in
+slotVariables = ['NSLOTS', 'SLURM_CPUS_PER_TASK', 'PBS_NUM_PPN', 'OMP_NUM_THREADS']
+
+def _affinityCount(status='/proc/self/status'):
+    # CPUs in the affinity mask of this process, None if unknown
+    try:
+        f = open(status)
+        try:
+            for line in f:
+                if line.startswith('Cpus_allowed_list:'):
+                    count = 0
+                    for item in line.split(':', 1)[1].strip().split(','):
+                        first, sep, last = item.partition('-')
+                        count += int(last or first) - int(first) + 1
+                    return count
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        pass
+    return None
+
+def cpuCount(environ=os.environ):
+    """Return the processors of the job's slot: the fewest of the host's, the
+    affinity mask's and the ones a batch system variable grants.
+    """
+    try:
+        import multiprocessing
+        counts = [multiprocessing.cpu_count()]
+    except (ImportError, NotImplementedError):
+        counts = []
+    counts.append(_affinityCount())
+    for name in slotVariables:
+        try:
+            counts.append(int(environ[name]))
+        except (KeyError, ValueError):
+            pass
+    counts = [n for n in counts if n and n > 0]
+    return counts and min(counts) or 1
+
+def splitRange(evtStart, nEvents, parts):
+    """Split nEvents from evtStart into at most parts balanced [(start, n)]."""
+    parts = max(1, min(parts, nEvents))
+    size, extra = divmod(nEvents, parts)
+    ranges = []
+    start = evtStart
+    for i in range(parts):
+        n = size + (i < extra and 1 or 0)
+        ranges.append((start, n))
+        start += n
+    return ranges
+
+def setMacro(path, settings, before=None):
+    # replace the lines of the [(command, value)] settings, a missing one goes
+    # in front of the 'before' command, or at the end
+    f = open(path)
+    lines = f.readlines()
+    f.close()
+    missing = [command for command, value in settings]
+    values = dict(settings)
+    result = []
+    for line in lines:
+        words = line.split()
+        if before and words and words[0] == before:
+            result.extend(['%s %s\n' %(command, values[command]) for command in missing])
+            missing = []
+        if words and values.has_key(words[0]):
+            line = '%s %s\n' %(words[0], values[words[0]])
+            if words[0] in missing:
+                missing.remove(words[0])
+        result.append(line)
+    result.extend(['%s %s\n' %(command, values[command]) for command in missing])
+    f = open(path, 'w')
+    f.writelines(result)
+    f.close()
+
+
+class Part(object):
+
+    def __init__(self, index, evtStart, nEvents):
+        self.index = index
+        self.evtStart = evtStart
+        self.nEvents = nEvents
+        self.path = '%s%d' %(partPrefix, index)
+        self.events = 0
+        self.exitCode = 0
+        self.statuses = []
+
+    def prepare(self, links):
+        # the job's macros with this part's range and seed, the inputs linked
+        if not os.path.isdir(self.path):
+            os.mkdir(self.path)
+        for name in links + ['event.macro', 'simu.macro', 'reco.xml']:
+            target = os.path.join(self.path, name)
+            if os.path.lexists(target):
+                os.remove(target)
+            if name in links:
+                os.symlink(os.path.abspath(name), target)
+            else:
+                f = open(name)
+                content = f.read()
+                f.close()
+                f = open(target, 'w')
+                f.write(content)
+                f.close()
+        setMacro(os.path.join(self.path, 'event.macro'), [('/run/beamOn', self.nEvents)])
+        setMacro(os.path.join(self.path, 'simu.macro'), [('/Mokka/init/startEventNumber', self.evtStart),\
+                    ('/Mokka/init/randomSeed', random.randint(1, 2**32 - 10))], '/Mokka/init/dbHost')
+
+    def run(self, report, stallTimeout, recoStallTimeout, statusInterval, readmit, nParts):
+        stage = 'part %d/%d' %(self.index, nParts)
+        simuLog = os.path.join(self.path, 'simu.log')
+        while True:
+            rzt, stalled = joblog.run(['../simu.sh'], simuLog, 'Mokka Simulation ' + stage, report,\
+                                        self.nEvents, stallTimeout, statusInterval, self.path)
+            if rzt == 0 or stalled:
+                break
+            if joblog.analyzeSimu(simuLog, self.evtStart)['exitCode'] != 21:
+                break
+            # the DB refused the connection, wait for a mirror and start again
+            mirror = readmit()
+            if not mirror:
+                break
+            setMacro(os.path.join(self.path, 'simu.macro'), [('/Mokka/init/dbHost', mirror)])
+        if stalled:
+            self.exitCode, self.statuses = joblog.simuStallCode, ['Simulation stalled']
+            return
+        self.events = self.nEvents
+        if rzt != 0:
+            result = joblog.analyzeSimu(simuLog, self.evtStart)
+            self.statuses = result['statuses']
+            if result['exitCode']:
+                self.exitCode = result['exitCode']
+                return
+            self.events = result['lastEvent'] - self.evtStart
+            if self.events <= 0:
+                # started beyond the last event of the input
+                self.exitCode, self.statuses = 23, ['No events in stdhep']
+                return
+        rzt, stalled = joblog.run(['../reco.sh'], os.path.join(self.path, 'reco.log'),\
+                                    'Marlin Reconstruction ' + stage, report, self.events, recoStallTimeout,\
+                                    statusInterval, self.path)
+        if stalled:
+            self.exitCode, self.statuses = joblog.recoStallCode, ['Reconstruction stalled']
+            return
+        result = joblog.analyzeReco(os.path.join(self.path, 'reco.log'), self.events)
+        self.exitCode = result['exitCode']
+        self.statuses += result['statuses']
+
+
+def run(parts, report, stallTimeout, recoStallTimeout, statusInterval, readmit):
+    """Simulate and reconstruct all parts at the same time."""
+    threads = [threading.Thread(target=part.run, args=(report, stallTimeout, recoStallTimeout, statusInterval, readmit,\
+                len(parts))) for part in parts]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+def combine(parts):
+    """Return (exit code, statuses, parts with events) of the job. Parts
+    beyond the end of the input have no events, which is only an error when
+    the first part has none either.
+    """
+    done = []
+    for part in parts:
+        if part.exitCode == 23 and part.index > 1 and parts[0].exitCode == 0:
+            continue
+        if part.exitCode:
+            return part.exitCode, part.statuses, []
+        done.append(part)
+    statuses = []
+    for part in done:
+        statuses += ['Part %d: %s' %(part.index, status) for status in part.statuses]
+    return 0, statuses, done
+
+def collectLogs(parts, name):
+    # the tails of the parts' logs as one log for the output sandbox
+    f = open(name, 'w')
+    for part in parts:
+        path = os.path.join(part.path, name)
+        f.write('==== %s, events %d to %d ====\n' %(path, part.evtStart, part.evtStart + part.nEvents - 1))
+        if os.path.isfile(path):
+            f.write('\n'.join(joblog.tailLines(path, logTailLines)) + '\n')
+    f.close()
+
+def merge(inputs, output, events, script='./merge.sh'):
+    """Merge the LCIO files into output with Marlin. True if output has all
+    events.
+    """
+    if len(inputs) == 1:
+        os.rename(inputs[0], output)
+        return True
+    steering = output + '.merge.xml'
+    logPath = output + '.merge.log'
+    f = open(steering, 'w')
+    f.write(mergeXML %(' '.join(inputs), output))
+    f.close()
+    if os.system('%s %s %s' %(script, steering, logPath)):
+        return False
+    for line in reversed(joblog.tailLines(logPath, 200)):
+        match = mergedPattern.search(line)
+        if match:
+            return int(match.group(1)) == events
+    return False
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# title: bounded stages between input discovery and submission for dsub
+#
+# A Stage runs an iterator in a thread of its own and hands its items to the
+# next stage through a queue of at most depth items. Discovery, registration
+# and submission thus overlap, the first job goes out as soon as the first
+# chunk of files is registered, and no stage gets more than depth items
+# ahead of the next one whatever the size of the sample. An exception in a
+# stage, sys.exit included, is raised again where its items are consumed.
+# The thread records its stats into the Stats it is given, if any, and sets
+# the notify event, if any, whenever an item is ready to be consumed.
+import sys, time, threading, Queue
+import stats
+
+defaultDepth = 2
+_end = object()
+
+
+class Stage(object):
+
+    def __init__(self, iterable, depth=defaultDepth, name='stage', runStats=None):
+        self.queue = Queue.Queue(max(1, depth))
+        self.notify = None
+        self.thread = threading.Thread(target=self._run, args=(iterable, runStats), name=name)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _run(self, iterable, runStats):
+        stats.use(runStats)
+        try:
+            for item in iterable:
+                self._put((None, item))
+        except:
+            self._put((sys.exc_info(), None))
+            return
+        self._put((None, _end))
+
+    def _put(self, item):
+        self.queue.put(item)
+        if self.notify:
+            self.notify.set()
+
+    def ready(self):
+        # True when the next item, the end or an error, can be had without waiting
+        return not self.queue.empty()
+
+    def __iter__(self):
+        while True:
+            error, item = self.queue.get()
+            if error:
+                raise error[0], error[1], error[2]
+            if item is _end:
+                return
+            yield item
+
+
+def chunks(iterable, size, first=None):
+    # lists of up to size items of iterable, the first one of up to first
+    # items, without reading further ahead
+    chunk = []
+    limit = first or size
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= limit:
+            yield chunk
+            chunk = []
+            limit = size
+    if chunk:
+        yield chunk
+
+def timed(name, iterable):
+    # like stats.timed for a generator, the time to produce each item
+    iterator = iter(iterable)
+    while True:
+        start = time.time()
+        try:
+            item = iterator.next()
+        except StopIteration:
+            return
+        stats.get().record(name, time.time() - start)
+        yield item
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# title: layout and manifest of the dsub repository
+#
+# repo_dir/repository/<N> is a master directory, one per production. N is
+# taken with mkdir, which fails instead of sharing the directory when two dsub
+# runs pick the same number at once. The files generated for job n go to
+# jobs/<n // shardSize>/<n> in it, so no directory holds more than shardSize
+# entries however large the production.
+#
+# manifest.sqlite maps every job number to its input file, batch, output
+# LFNs and DIRAC job IDs, to look jobs up without walking the directories.
+# The journal stays the record resume works from, the manifest is an index.
+import os, os.path, errno, sqlite3
+
+repositoryName = 'repository'
+jobsDirName = 'jobs'
+shardSize = 1000
+manifestName = 'manifest.sqlite'
+commitEvery = 500
+
+schema = """
+create table if not exists jobs (
+    job integer primary key,
+    jobKey text unique,
+    inputFile text,
+    batch integer,
+    sim text,
+    rec text
+);
+create index if not exists jobsByInput on jobs (inputFile);
+create table if not exists ids (
+    jobID integer primary key,
+    job integer,
+    position integer,
+    parameter text
+);
+create index if not exists idsByJob on ids (job);
+"""
+
+
+def allocateMasterDir(repoDirRoot):
+    """Create and return the next free repo_dir/repository/<N>."""
+    repoDir = os.path.join(repoDirRoot, repositoryName)
+    if not os.path.isdir(repoDir):
+        try:
+            os.makedirs(repoDir)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+    numbers = [int(name) for name in os.listdir(repoDir) if name.isdigit()]
+    n = max(numbers + [-1]) + 1
+    while True:
+        masterDir = os.path.join(repoDir, repr(n))
+        try:
+            os.mkdir(masterDir)
+            return masterDir
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            n += 1
+
+def jobDir(masterDir, jobNumber):
+    return os.path.join(masterDir, jobsDirName, '%03d' %(jobNumber // shardSize), repr(jobNumber))
+
+
+class Manifest(object):
+
+    def __init__(self, masterDir, readOnly=False):
+        # readOnly opens an existing manifest for lookups, without creating it
+        self.path = os.path.join(masterDir, manifestName)
+        self.readOnly = readOnly
+        if readOnly and not os.path.isfile(self.path):
+            raise IOError(errno.ENOENT, 'no manifest', self.path)
+        self.db = sqlite3.connect(self.path)
+        if not readOnly:
+            self.db.executescript(schema)
+        self.pending = 0
+
+    def _changed(self):
+        self.pending += 1
+        if self.pending >= commitEvery:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.pending = 0
+
+    def addJob(self, jobNumber, jobKey, inputFile, batch, outputData):
+        self.db.execute('insert or replace into jobs values (?, ?, ?, ?, ?, ?)', (jobNumber,\
+                        jobKey.decode('utf-8'), inputFile.decode('utf-8'), batch, outputData[0], outputData[1]))
+        self._changed()
+
+    def setJobIDs(self, jobKey, jobIDs, parameters=None):
+        # the IDs DIRAC gave the job, a list for a parametric one
+        row = self.db.execute('select job from jobs where jobKey = ?', (jobKey.decode('utf-8'),)).fetchone()
+        if row is None:
+            return
+        if not isinstance(jobIDs, list):
+            jobIDs = [jobIDs]
+        parameters = parameters or [None] * len(jobIDs)
+        self.db.executemany('insert or replace into ids values (?, ?, ?, ?)', [(int(jobID), row[0], position,\
+                            parameters[position]) for position, jobID in enumerate(jobIDs)])
+        self._changed()
+
+    def replaceJobID(self, oldID, newID):
+        self.db.execute('update ids set jobID = ? where jobID = ?', (int(newID), int(oldID)))
+        self._changed()
+
+    def _rows(self, where, args):
+        cursor = self.db.execute('select jobs.job, jobKey, inputFile, batch, sim, rec, jobID, position, parameter'\
+                                ' from jobs left join ids on ids.job = jobs.job ' + where, args)
+        keys = ['job', 'jobKey', 'inputFile', 'batch', 'sim', 'rec', 'jobID', 'position', 'parameter']
+        rows = []
+        for row in cursor:
+            row = dict(zip(keys, [isinstance(value, unicode) and value.encode('utf-8') or value for value in row]))
+            if row['parameter'] is not None:
+                # the LFNs DIRAC gave this job of a parametric one
+                row['sim'] = row['sim'].replace('%s', row['parameter'])
+                row['rec'] = row['rec'].replace('%s', row['parameter'])
+            rows.append(row)
+        return rows
+
+    def lookup(self, jobID):
+        """The job with DIRAC job ID jobID, None if unknown."""
+        rows = self._rows('where jobID = ?', (int(jobID),))
+        return rows and rows[0] or None
+
+    def jobs(self, inputFile=None):
+        """All jobs, or those of one input file, with one entry per job ID."""
+        if inputFile is None:
+            return self._rows('order by jobs.job, position', ())
+        return self._rows('where inputFile = ? order by jobs.job, position', (inputFile.decode('utf-8'),))
+
+    def close(self):
+        if not self.readOnly:
+            self.commit()
+        self.db.close()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# title: retry policy with backoff, jitter and a circuit breaker
+#
+# Used by dsub for the DFC registration and shipped in the input sandbox for
+# the checks in job.py, so it only needs the standard library.
+#
+# A call is retried with exponential backoff and full jitter (a random delay
+# up to base * factor**n), within a number of attempts and a deadline for the
+# whole operation. Calls to one service share a CircuitBreaker: after
+# 'threshold' failures in a row it opens and calls wait until 'resetTimeout'
+# has passed, then a single trial call decides whether it closes again.
+import time, random, threading
+
+_lock = threading.Lock()
+_stats = {}
+
+
+def S_ERROR(message=''):
+    return {'OK': False, 'Message': message}
+
+def _count(name, key, n=1):
+    _lock.acquire()
+    counters = _stats.setdefault(name, {'calls': 0, 'attempts': 0, 'retries': 0, 'failures': 0,\
+                                        'gaveUp': 0, 'deadlines': 0, 'breakerOpened': 0, 'slept': 0.0})
+    counters[key] += n
+    _lock.release()
+
+def reset():
+    _lock.acquire()
+    _stats.clear()
+    _lock.release()
+
+def summary():
+    """Return the retry counters of every policy and breaker, by name."""
+    _lock.acquire()
+    try:
+        return dict((name, dict(counters)) for name, counters in _stats.items())
+    finally:
+        _lock.release()
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, name, threshold=5, resetTimeout=30.0):
+        self.name = name
+        self.threshold = threshold
+        self.resetTimeout = resetTimeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.openedAt = None
+        self.trial = False
+
+    def wait(self, deadline):
+        # block while open, False if the deadline comes first
+        while True:
+            self.lock.acquire()
+            try:
+                if self.openedAt is None:
+                    return True
+                left = self.openedAt + self.resetTimeout - time.time()
+                if left <= 0 and not self.trial:
+                    # half open, let one call through
+                    self.trial = True
+                    return True
+            finally:
+                self.lock.release()
+            delay = max(left, 0.5)
+            if time.time() + delay > deadline:
+                return False
+            _count(self.name, 'slept', delay)
+            time.sleep(delay)
+
+    def pause(self, deadline):
+        # for callers that depend on the service without calling it: wait out
+        # the open period, but leave the trial call to the service's users
+        while True:
+            self.lock.acquire()
+            if self.openedAt is None:
+                left = 0
+            else:
+                left = self.openedAt + self.resetTimeout - time.time()
+            self.lock.release()
+            if left <= 0:
+                return True
+            if time.time() + left > deadline:
+                return False
+            _count(self.name, 'slept', left)
+            time.sleep(left)
+
+    def success(self):
+        self.lock.acquire()
+        self.failures = 0
+        self.openedAt = None
+        self.trial = False
+        self.lock.release()
+
+    def failure(self):
+        self.lock.acquire()
+        self.failures += 1
+        opened = (self.trial or (self.openedAt is None and self.failures >= self.threshold))
+        if opened:
+            self.openedAt = time.time()
+            self.trial = False
+        self.lock.release()
+        if opened:
+            _count(self.name, 'breakerOpened')
+
+
+class RetryPolicy(object):
+
+    def __init__(self, name, attempts=10, base=1.0, factor=2.0, maxDelay=60.0, deadline=600.0, breaker=None):
+        self.name = name
+        self.attempts = attempts
+        self.base = base
+        self.factor = factor
+        self.maxDelay = maxDelay
+        self.deadline = deadline
+        self.breaker = breaker
+        self.random = random.Random()
+
+    def delay(self, attempt):
+        return self.random.uniform(0, min(self.maxDelay, self.base * self.factor ** attempt))
+
+    def call(self, func, ok=None):
+        """Call func(), which returns a DIRAC style result dict,
+        until ok(result) holds (result['OK'] by default). The breaker only
+        counts results that are not OK, i.e. failures of the service itself.
+        Returns the last result.
+        """
+        if ok is None:
+            ok = lambda result: result['OK']
+        deadline = time.time() + self.deadline
+        result = S_ERROR('%s: no attempt made' %self.name)
+        _count(self.name, 'calls')
+        for attempt in range(self.attempts):
+            if attempt:
+                _count(self.name, 'retries')
+                delay = self.delay(attempt - 1)
+                if time.time() + delay > deadline:
+                    _count(self.name, 'deadlines')
+                    break
+                _count(self.name, 'slept', delay)
+                time.sleep(delay)
+            if self.breaker and not self.breaker.wait(deadline):
+                _count(self.name, 'deadlines')
+                result = S_ERROR('%s: circuit open' %self.name)
+                break
+            _count(self.name, 'attempts')
+            try:
+                result = func()
+            except Exception, e:
+                result = S_ERROR('%s: %s' %(e.__class__.__name__, e))
+            if self.breaker:
+                if result['OK']:
+                    self.breaker.success()
+                else:
+                    self.breaker.failure()
+            if ok(result):
+                return result
+            _count(self.name, 'failures')
+        _count(self.name, 'gaveUp')
+        return result
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# title: content-addressed input sandbox files for dsub
+#
+# With 'sandbox = shared' every production ships one generic job.py and one
+# copy of each macro/xml template, filled in on the worker node from the job
+# arguments. The files are stored under the hash of their content, so jobs
+# with the same content point at the same paths and DIRAC recognises their
+# input sandbox as one it already has.
+import os, os.path, hashlib
+
+sandboxDirName = 'sandbox'
+
+
+def storeShared(masterDir, name, content):
+    digest = hashlib.sha1(content).hexdigest()
+    dirpath = os.path.join(masterDir, sandboxDirName, digest)
+    path = os.path.join(dirpath, name)
+    if os.path.isfile(path):
+        return path
+    if not os.path.isdir(dirpath):
+        os.makedirs(dirpath)
+    tmp = '%s.%d' %(path, os.getpid())
+    f = open(tmp, 'w')
+    f.write(content)
+    f.close()
+    os.rename(tmp, path)
+    return path
+
+def storeModule(masterDir, module):
+    # the source of a dsub module, for job.py to import on the worker node
+    path = os.path.splitext(module.__file__)[0] + '.py'
+    f = open(path)
+    content = f.read()
+    f.close()
+    return storeShared(masterDir, os.path.basename(path), content)
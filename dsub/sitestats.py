@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# title: throughput-weighted site assignment for dsub
+#
+# Instead of sending every job to all configured sites, each job gets a
+# destination set of a few sites, drawn with weights from how the sites did
+# on the user's recent jobs:
+#   weight = completions per hour * success rate / (1 + hours of backlog)
+# where the backlog is the pending jobs over the completion rate. Jobs
+# assigned by the current submission count as pending, so a fast site does
+# not get everything. Sites without statistics count as the median one.
+#
+# The statistics come from a source:
+#   'jobs'   the user's last maxJobs jobs of the last site_stats_hours in the
+#            WMS. A waiting job sent to several sites is reported at 'ANY' or
+#            'Multiple', it counts as pending at each of its candidate sites in
+#            equal parts, taken from the JDL of a sample of such jobs
+#   'none'   all sites equal, every job goes to all of them as before
+#   a path   a JSON file {site: {completed, failed, pending, hours}}
+#
+# The scan of the WMS is kept for cacheTTL by CachedSource and is done by
+# loadInBackground() while the first jobs are submitted: until it is in, a
+# Scheduler sends every job to all sites, as without statistics.
+import os.path, time, json, random, threading, Queue
+import backend, cache
+
+defaultHours = 24
+defaultChoices = 2
+statusChunk = 500
+maxJobs = 5000
+cacheTTL = 3600
+jdlSample = 50
+jdlThreads = 8
+minRate = 0.1
+pendingStatuses = ['Received', 'Checking', 'Waiting', 'Matched', 'Staging']
+
+
+class SiteStats(object):
+
+    def __init__(self, completed=0, failed=0, pending=0, hours=defaultHours):
+        self.completed = completed
+        self.failed = failed
+        self.pending = pending
+        self.hours = hours
+
+    def rate(self):
+        # completions per hour
+        return max(float(self.completed) / max(self.hours, 1e-6), minRate)
+
+    def successRate(self):
+        return (self.completed + 1.0) / (self.completed + self.failed + 2.0)
+
+    def asDict(self):
+        return {'completed': self.completed, 'failed': self.failed, 'pending': self.pending, 'hours': self.hours}
+
+
+class NoSource(object):
+
+    def load(self, sites):
+        return {}
+
+
+class FileSource(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, sites):
+        f = open(self.path)
+        try:
+            return fromDict(json.load(f))
+        finally:
+            f.close()
+
+
+class JobsSource(object):
+    # the final and pending states of the owner's jobs in the WMS
+
+    def __init__(self, owner, hours=defaultHours):
+        self.owner = owner
+        self.hours = hours
+
+    def load(self, sites):
+        dirac = backend.get().Dirac()
+        since = time.strftime('%Y-%m-%d', time.gmtime(time.time() - self.hours * 3600))
+        result = dirac.selectJobs(owner=self.owner, date=since)
+        if not result['OK']:
+            raise IOError('selectJobs failed: %s' %result['Message'])
+        # the latest ones are enough to rank the sites
+        jobIDs = sorted(result['Value'] or [], key=int)[-maxJobs:]
+        statsBySite = dict((site, SiteStats(hours=self.hours)) for site in sites)
+        unplaced = []
+        for i in range(0, len(jobIDs), statusChunk):
+            result = dirac.status(jobIDs[i:i + statusChunk])
+            if not result['OK']:
+                raise IOError('status failed: %s' %result['Message'])
+            for jobID, info in result['Value'].items():
+                site = statsBySite.get(info.get('Site'))
+                if site is None:
+                    if info['Status'] in pendingStatuses:
+                        unplaced.append(jobID)
+                    continue
+                if info['Status'] == 'Done':
+                    site.completed += 1
+                elif info['Status'] in ['Failed', 'Stalled']:
+                    site.failed += 1
+                elif info['Status'] in pendingStatuses:
+                    site.pending += 1
+        self.spreadPending(dirac, unplaced, statsBySite)
+        # a site without jobs in the window is unknown, not slow
+        return dict((site, s) for site, s in statsBySite.items() if s.completed + s.failed + s.pending)
+
+
+    def spreadPending(self, dirac, jobIDs, statsBySite):
+        # the waiting jobs without a site count at each candidate site in equal
+        # parts; the candidates of a sample stand for those of all of them
+        sample = random.sample(jobIDs, min(len(jobIDs), jdlSample))
+        candidates = []
+        tasks = Queue.Queue()
+        for jobID in sample:
+            tasks.put(jobID)
+        def work():
+            while True:
+                try:
+                    jobID = tasks.get_nowait()
+                except Queue.Empty:
+                    return
+                result = dirac.getJobJDL(jobID)
+                if result['OK']:
+                    candidates.append(jdlSites(result['Value'], statsBySite.keys()))
+        threads = [threading.Thread(target=work) for i in range(min(jdlThreads, len(sample)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if not candidates:
+            return
+        scale = float(len(jobIDs)) / len(candidates)
+        for sites in candidates:
+            for site in sites:
+                statsBySite[site].pending += scale / len(sites)
+
+
+class CachedSource(object):
+    # the statistics of source for the same sites, kept in path for ttl seconds
+
+    def __init__(self, source, path, ttl=cacheTTL):
+        self.source = source
+        self.path = path
+        self.ttl = ttl
+
+    def cached(self, sites):
+        # the statistics in path, None if they are missing, stale or of other sites
+        entry = cache.readJson(self.path)
+        if not (entry and entry.get('sites') == sorted(sites) and time.time() - entry.get('time', 0) < self.ttl):
+            return None
+        return fromDict(entry.get('stats', {}))
+
+    def load(self, sites):
+        result = self.cached(sites)
+        if result is None:
+            result = self.source.load(sites)
+            cache.writeJson(self.path, {'sites': sorted(sites), 'time': time.time(),\
+                                        'stats': dict((site, s.asDict()) for site, s in result.items())})
+        return result
+
+
+def fromDict(entries):
+    result = {}
+    for site, entry in entries.items():
+        result[site.encode('utf-8')] = SiteStats(entry.get('completed', 0), entry.get('failed', 0),\
+                                                entry.get('pending', 0), entry.get('hours', defaultHours))
+    return result
+
+def jdlSites(jdl, sites):
+    # the ones of sites a job of the given JDL parameters may run at
+    value = jdl.get('Site', [])
+    if isinstance(value, basestring):
+        value = value.strip('{} ').split(',')
+    value = [site.strip('" ') for site in value]
+    value = [site for site in value if site and site != 'ANY']
+    if not value:
+        return sorted(sites)
+    return sorted([site for site in value if site in sites])
+
+
+def getSource(spec, owner=None, hours=defaultHours):
+    if spec == 'none':
+        return NoSource()
+    if spec == 'jobs':
+        return JobsSource(owner, hours)
+    if os.path.isfile(spec):
+        return FileSource(spec)
+    raise ValueError("site_stats should be 'jobs', 'none' or a JSON file, not %s" %spec)
+
+def loadInBackground(source, sites, done):
+    """Load the statistics of source in a thread of its own and call
+    done(statsBySite, error) with them, {} and the error if the load failed.
+    """
+    def run():
+        try:
+            statsBySite = source.load(sites)
+        except (IOError, OSError, ValueError), e:
+            done({}, e)
+            return
+        done(statsBySite, None)
+    thread = threading.Thread(target=run, name='sitestats')
+    thread.setDaemon(True)
+    thread.start()
+    return thread
+
+def save(statsBySite, path):
+    f = open(path, 'w')
+    json.dump(dict((site, s.asDict()) for site, s in statsBySite.items()), f, indent=1, sort_keys=True)
+    f.close()
+
+
+class Scheduler(object):
+
+    def __init__(self, sites, statsBySite, choices=defaultChoices, seed=None):
+        self.sites = list(sites)
+        self.choices = min(max(1, choices), len(self.sites))
+        self.random = random.Random(seed)
+        self.assigned = dict((site, 0.0) for site in self.sites)
+        self.stats = {}
+        self.update(statsBySite)
+
+    def update(self, statsBySite):
+        # the statistics to weight the sites with from now on
+        rates = sorted([statsBySite[site].rate() for site in self.sites if statsBySite.has_key(site)])
+        if not rates:
+            return
+        # unknown sites look like the median site with nothing pending
+        median = SiteStats(completed=rates[len(rates) // 2] * defaultHours)
+        self.stats = dict((site, statsBySite.get(site, median)) for site in self.sites)
+
+    def _weight(self, s, site):
+        backlog = (s.pending + self.assigned[site]) / s.rate()
+        return s.rate() * s.successRate() / (1.0 + backlog)
+
+    def weights(self, statsBySite=None):
+        # {site: weight} with this submission's assignments counted as pending
+        statsBySite = statsBySite or self.stats
+        return dict((site, self._weight(statsBySite[site], site)) for site in self.sites)
+
+    def assign(self, njobs=1):
+        """Return the destination sites for njobs jobs submitted together."""
+        statsBySite = self.stats
+        if not statsBySite:
+            return list(self.sites)
+        weights = self.weights(statsBySite)
+        chosen = []
+        candidates = list(self.sites)
+        while len(chosen) < self.choices:
+            total = sum([weights[site] for site in candidates])
+            point = self.random.random() * total
+            for site in candidates:
+                point -= weights[site]
+                if point <= 0:
+                    break
+            chosen.append(site)
+            candidates.remove(site)
+        for site in chosen:
+            self.assigned[site] += float(njobs) / len(chosen)
+        return sorted(chosen)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# title: per-stage timing and counters for dsub
+#
+# Stage functions are wrapped with @timed(name), which records the latency of
+# every call in a histogram of the active Stats. Counters (submissions,
+# failures, retries) are bumped with count(name). At the end of a run the
+# summary is written as json into the master directory.
+#
+# Each production of a run has a Stats of its own, with the one of the run as
+# its parent, which counts everything as well. A thread working for a
+# production records into its Stats after use(), the others into the run's.
+import sys, time, json, threading
+
+# upper bounds in seconds, 1-2-5 steps from 1 ms to 500 s, the last bucket is open
+bucketBounds = [m * 10 ** e for e in range(-3, 3) for m in (1, 2, 5)]
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.buckets = [0] * (len(bucketBounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        i = 0
+        while i < len(bucketBounds) and value > bucketBounds[i]:
+            i += 1
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        # upper bound of the bucket holding the given fraction of the calls
+        if not self.count:
+            return None
+        needed = fraction * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= needed:
+                if i < len(bucketBounds):
+                    return min(bucketBounds[i], self.max)
+                return self.max
+        return self.max
+
+    def summary(self):
+        return {'calls': self.count,
+                'total': self.total,
+                'mean': self.count and self.total / self.count or None,
+                'min': self.min,
+                'max': self.max,
+                'p50': self.percentile(0.5),
+                'p90': self.percentile(0.9),
+                'p99': self.percentile(0.99),
+                'buckets': [[bound, n] for bound, n in zip(bucketBounds + [None], self.buckets) if n]}
+
+
+class Stats(object):
+
+    def __init__(self, parent=None):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.stages = {}
+        self.counters = {}
+        self.parent = parent
+
+    def record(self, name, elapsed):
+        self.lock.acquire()
+        try:
+            if not self.stages.has_key(name):
+                self.stages[name] = Histogram()
+            self.stages[name].add(elapsed)
+        finally:
+            self.lock.release()
+        if self.parent:
+            self.parent.record(name, elapsed)
+
+    def count(self, name, n=1):
+        self.lock.acquire()
+        self.counters[name] = self.counters.get(name, 0) + n
+        self.lock.release()
+        if self.parent:
+            self.parent.count(name, n)
+
+    def summary(self):
+        self.lock.acquire()
+        try:
+            return {'start': self.start,
+                    'elapsed': time.time() - self.start,
+                    'stages': dict((name, h.summary()) for name, h in self.stages.items()),
+                    'counters': dict(self.counters)}
+        finally:
+            self.lock.release()
+
+    def write(self, path, extra=None):
+        summary = self.summary()
+        summary.update(extra or {})
+        f = open(path, 'w')
+        json.dump(summary, f, indent=1, sort_keys=True)
+        f.write('\n')
+        f.close()
+
+
+class Progress(object):
+    # prints the throughput at most every interval seconds during a long run
+
+    def __init__(self, total=None, interval=10.0, out=None):
+        self.total = total
+        self.interval = interval
+        self.out = out or sys.stdout
+        self.start = time.time()
+        self.last = self.start
+
+    def update(self, done, failed=0):
+        now = time.time()
+        if now - self.last < self.interval:
+            return
+        self.last = now
+        elapsed = now - self.start
+        rate = done / max(elapsed, 1e-6)
+        if self.total is None:
+            # still streaming, the total is not known yet
+            print >>self.out, 'Progress: %d jobs submitted, %d failed, %.1f jobs/s' %(done, failed, rate)
+            self.out.flush()
+            return
+        line = 'Progress: %d of %d jobs submitted, %d failed, %.1f jobs/s' %(done, self.total, failed, rate)
+        if rate > 0 and done < self.total:
+            line += ', about %d s left' %((self.total - done - failed) / rate)
+        print >>self.out, line
+        self.out.flush()
+
+
+_current = Stats()
+_local = threading.local()
+
+def reset():
+    global _current
+    _current = Stats()
+    return _current
+
+def use(stats):
+    """Make stats the Stats the calling thread records into, None for the
+    one of the run. Returns the one it replaces.
+    """
+    previous = getattr(_local, 'stats', None)
+    _local.stats = stats
+    return previous
+
+def get():
+    return getattr(_local, 'stats', None) or _current
+
+def count(name, n=1):
+    get().count(name, n)
+
+def timed(name):
+    # decorator recording the wall time of every call under name
+    def decorate(func):
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                get().record(name, time.time() - start)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorate
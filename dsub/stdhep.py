@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+# title: event counts of .stdhep files for dsub
+#
+# A .stdhep file is an XDR (mcfio) stream that starts with a file header:
+#   int blockid, int ntot, string version,
+#   string title, string comment, [string date, string closingDate,]
+#   int numevts_expect, int numevts, ...
+# where every XDR string is a 4 byte length and the bytes padded to 4. Only
+# the first block is read. Files with a header that does not parse, or
+# that was never closed (numevts 0), get an estimate from their size, in
+# bytes per event learned from the files that did parse.
+#
+# The counts are kept in an index next to the discovery index, keyed by
+# path, size and mtime, so a later submission reads no headers.
+#
+# Every mcfio record starts with int blockid, int ntot, ntot being the
+# length of the whole record. An event is an event header record and the
+# records up to the next event header; the event tables that index them are
+# left out when the events of a batch are sliced into a file of their own,
+# which gets one new table in front of its events. The data blocks of an
+# event are copied as they are, readers take them in sequence after the
+# event header.
+import os, os.path, struct, tempfile, threading, Queue
+import cache
+
+headerBytes = 2048
+defaultBytesPerEvent = 20000
+indexName = 'events.json'
+fileHeaderId = 100
+eventTableId = 101
+eventHeaderId = 103
+
+
+def _xdrString(data, pos):
+    (length,) = struct.unpack('>i', data[pos:pos + 4])
+    if length < 0 or length > 1024 or pos + 4 + length > len(data):
+        raise ValueError('bad xdr string')
+    end = pos + 4 + length
+    return data[pos + 4:end], end + (-length % 4)
+
+def _xdrStringValue(value):
+    return struct.pack('>i', len(value)) + value + '\0' * (-len(value) % 4)
+
+def _countsOffset(data):
+    # -> (version, offset of numevts_expect) in a file header record
+    version, pos = _xdrString(data, 8)
+    if not (len(version) == 4 and version[0].isdigit() and version[1] == '.'):
+        raise ValueError('not a mcfio file header')
+    title, pos = _xdrString(data, pos)
+    comment, pos = _xdrString(data, pos)
+    if version >= '2.00':
+        date, pos = _xdrString(data, pos)
+        closingDate, pos = _xdrString(data, pos)
+    return version, pos
+
+def parseHeader(data):
+    """Return (numevts_expect, numevts) from the start of a .stdhep file."""
+    blockid, ntot = struct.unpack('>ii', data[:8])
+    version, pos = _countsOffset(data)
+    expect, numevts = struct.unpack('>ii', data[pos:pos + 8])
+    if expect < 0 or numevts < 0:
+        raise ValueError('bad event counts')
+    return expect, numevts
+
+def readHeader(path):
+    """Return (numevts_expect, numevts) from the header of path, None if it
+    does not parse.
+    """
+    try:
+        f = open(path, 'rb')
+        try:
+            data = f.read(headerBytes)
+        finally:
+            f.close()
+        return parseHeader(data)
+    except (IOError, OSError, ValueError, struct.error):
+        return None
+
+def readEventCount(path):
+    """Return the number of events in the header of path, None if unknown."""
+    counts = readHeader(path)
+    return counts and counts[1] or None
+
+def writeHeader(f, numevts, title='dsub', comment=''):
+    # a file header as mcfio writes it, for tests and benchmarks
+    body = _xdrStringValue('2.00') + _xdrStringValue(title) + _xdrStringValue(comment) + _xdrStringValue('')\
+            + _xdrStringValue('') + struct.pack('>iiIII', numevts, numevts, 0, 0, 0)
+    f.write(struct.pack('>ii', fileHeaderId, len(body) + 8) + body)
+
+def writeEvent(f, evtnum, payload):
+    # an event header and one data block, for tests and benchmarks
+    body = _xdrStringValue('2.00') + struct.pack('>iiiiii', evtnum, 0, 1, 0, 1, 1)
+    f.write(struct.pack('>ii', eventHeaderId, len(body) + 8) + body)
+    f.write(struct.pack('>ii', 1, len(payload) + 8) + payload)
+
+
+def _key(path):
+    if isinstance(path, str):
+        return path.decode('utf-8', 'replace')
+    return path
+
+_saveLock = threading.Lock()
+
+class EventIndex(object):
+
+    def __init__(self, indexDir):
+        self.path = os.path.join(indexDir, indexName)
+        self.lock = threading.Lock()
+        self.entries = cache.readJson(self.path) or {}
+        self.updates = {}
+
+    def get(self, path, st):
+        entry = self.entries.get(_key(path))
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime:
+            return entry[2]
+        return False
+
+    def put(self, path, st, numevts):
+        self.lock.acquire()
+        self.entries[_key(path)] = self.updates[_key(path)] = [st.st_size, st.st_mtime, numevts]
+        self.lock.release()
+
+    def save(self):
+        # merged into the index as it is now, other productions count into it too
+        if not self.updates:
+            return
+        _saveLock.acquire()
+        try:
+            entries = cache.readJson(self.path) or {}
+            entries.update(self.updates)
+            cache.writeJson(self.path, entries)
+            self.updates = {}
+        finally:
+            _saveLock.release()
+
+
+def countEvents(inputDataList, indexDir, threads=8, bytesPerEvent=None):
+    """Return {filepath: (events, 'header' or 'estimate')} for the
+    (filepath, size, ...) tuples in inputDataList. A file whose header can
+    not be read is reported and estimated.
+    """
+    index = EventIndex(indexDir)
+    counts = {}
+    tasks = Queue.Queue()
+    def work():
+        while True:
+            item = tasks.get()
+            if item is None:
+                break
+            filepath = item[0]
+            numevts = None
+            try:
+                try:
+                    st = os.stat(filepath)
+                except OSError:
+                    st = None
+                if st is not None:
+                    numevts = index.get(filepath, st)
+                    if numevts is False:
+                        numevts = readEventCount(filepath)
+                        index.put(filepath, st, numevts)
+            except Exception, e:
+                print 'WARNNING: failed to count the events of %s, estimated from its size. %s: %s'\
+                        %(filepath, e.__class__.__name__, e)
+                numevts = None
+            finally:
+                counts[filepath] = numevts
+                tasks.task_done()
+    workers = [threading.Thread(target=work) for i in range(max(1, threads))]
+    for t in workers:
+        t.setDaemon(True)
+        t.start()
+    for item in inputDataList:
+        tasks.put(item)
+    tasks.join()
+    for t in workers:
+        tasks.put(None)
+    for t in workers:
+        t.join()
+    try:
+        index.save()
+    except (IOError, OSError), e:
+        print 'WARNNING: failed to save event index %s: %s' %(index.path, e)
+    if bytesPerEvent is None:
+        known = [(item[1], counts[item[0]]) for item in inputDataList if counts.get(item[0])]
+        if known:
+            bytesPerEvent = float(sum([size for size, n in known])) / sum([n for size, n in known])
+        else:
+            bytesPerEvent = defaultBytesPerEvent
+    result = {}
+    for item in inputDataList:
+        filepath, size = item[0], item[1]
+        if counts.get(filepath):
+            result[filepath] = (counts[filepath], 'header')
+        else:
+            result[filepath] = (max(1, int(size / bytesPerEvent)), 'estimate')
+    return result
+
+def splitEvents(nEvents, evtstart, eventsPerJob):
+    """Split the events from evtstart on into balanced [(evtStart, n)] slices
+    of at most eventsPerJob events.
+    """
+    total = nEvents - evtstart
+    if total <= 0:
+        return []
+    njobs = (total + eventsPerJob - 1) // eventsPerJob
+    size, extra = divmod(total, njobs)
+    slices = []
+    start = evtstart
+    for i in range(njobs):
+        n = size + (i < extra and 1 or 0)
+        slices.append((start, n))
+        start += n
+    return slices
+
+
+def readRecords(f):
+    """Yield (blockid, record) for the records of an mcfio stream."""
+    while True:
+        head = f.read(8)
+        if not head:
+            return
+        if len(head) < 8:
+            raise ValueError('truncated record')
+        blockid, ntot = struct.unpack('>ii', head)
+        if ntot < 8:
+            raise ValueError('bad record length %d' %ntot)
+        body = f.read(ntot - 8)
+        if len(body) < ntot - 8:
+            raise ValueError('truncated record')
+        yield blockid, head + body
+
+def _eventNumbers(record):
+    # (evtnum, storenum, runnum, trigMask) of an event header
+    try:
+        version, pos = _xdrString(record, 8)
+        return struct.unpack('>iiii', record[pos:pos + 16])
+    except (ValueError, struct.error):
+        return (0, 0, 0, 0)
+
+def _tableSize(version, dim):
+    return 8 + len(_xdrStringValue(version)) + 8 + 5 * (4 + 4 * dim)
+
+def _eventTable(version, dim, entries):
+    # one table for the [(offset, numbers)] events of a slice, sized for dim
+    entries = entries + [(-1, (0, 0, 0, 0))] * (dim - len(entries))
+    body = _xdrStringValue(version) + struct.pack('>ii', -1, len([1 for offset, n in entries if offset >= 0]))
+    for column in range(4):
+        body += struct.pack('>i%di' %dim, dim, *[n[column] for offset, n in entries])
+    body += struct.pack('>i%di' %dim, dim, *[offset for offset, n in entries])
+    return struct.pack('>ii', eventTableId, len(body) + 8) + body
+
+
+class _Slice(object):
+    # one output file being written: header, table, then its events
+
+    def __init__(self, path, header, version, countsPos, nEvents):
+        self.path = path
+        self.header = header
+        self.version = version
+        self.countsPos = countsPos
+        self.dim = max(nEvents, 1)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(path)):
+                    raise
+        fd, self.tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + '.')
+        self.f = os.fdopen(fd, 'wb')
+        self.offset = len(header) + _tableSize(version, self.dim)
+        self.f.write('\0' * self.offset)
+        self.entries = []
+
+    def write(self, blockid, record):
+        if blockid == eventHeaderId:
+            self.entries.append((self.offset, _eventNumbers(record)))
+        self.f.write(record)
+        self.offset += len(record)
+
+    def close(self):
+        n = len(self.entries)
+        pos = self.countsPos
+        header = self.header[:pos] + struct.pack('>iiii', n, n, len(self.header), self.dim)\
+                    + self.header[pos + 16:]
+        self.f.seek(0)
+        self.f.write(header + _eventTable(self.version, self.dim, self.entries))
+        self.f.close()
+        os.chmod(self.tmp, 0644)
+        os.rename(self.tmp, self.path)
+        return n
+
+    def abort(self):
+        self.f.close()
+        os.remove(self.tmp)
+
+
+def sliceEvents(path, ranges, outputs):
+    """Write the events [start, start + n) of path to the output of each
+    (start, n) in ranges, reading path once. The ranges are in order and do
+    not overlap. Returns the numbers of events written, fewer than asked
+    where the input ends early.
+    """
+    f = open(path, 'rb')
+    written = []
+    current = None
+    try:
+        records = readRecords(f)
+        for blockid, header in records:
+            break
+        else:
+            raise ValueError('empty file')
+        if blockid != fileHeaderId:
+            raise ValueError('not a mcfio file header')
+        version, countsPos = _countsOffset(header)
+        if len(header) < countsPos + 16:
+            raise ValueError('bad file header')
+        event = -1
+        for blockid, record in records:
+            if blockid == eventHeaderId:
+                event += 1
+                while current is None and len(written) < len(ranges) and event >= sum(ranges[len(written)]):
+                    # a range with no events in it, e.g. starting beyond the end
+                    written.append(_Slice(outputs[len(written)], header, version, countsPos, 0).close())
+                if current is not None and event >= sum(ranges[len(written)]):
+                    written.append(current.close())
+                    current = None
+                if len(written) == len(ranges):
+                    break
+                if current is None and event >= ranges[len(written)][0]:
+                    i = len(written)
+                    current = _Slice(outputs[i], header, version, countsPos, ranges[i][1])
+            if blockid in [fileHeaderId, eventTableId]:
+                continue
+            if current is not None:
+                current.write(blockid, record)
+        if current is not None:
+            written.append(current.close())
+            current = None
+        while len(written) < len(ranges):
+            i = len(written)
+            written.append(_Slice(outputs[i], header, version, countsPos, ranges[i][1]).close())
+    except:
+        if current is not None:
+            current.abort()
+        raise
+    finally:
+        f.close()
+    return written
+
+def sliceFiles(tasks, threads=8):
+    """Slice the (path, ranges, outputs) tasks, threads files at a time.
+    Returns {path: events written per output}, an error message instead
+    for a file that could not be sliced.
+    """
+    results = {}
+    queue = Queue.Queue()
+    def work():
+        while True:
+            task = queue.get()
+            if task is None:
+                break
+            path, ranges, outputs = task
+            try:
+                results[path] = sliceEvents(path, ranges, outputs)
+            except (IOError, OSError, ValueError, struct.error), e:
+                results[path] = str(e)
+            queue.task_done()
+    workers = [threading.Thread(target=work) for i in range(max(1, threads))]
+    for t in workers:
+        t.setDaemon(True)
+        t.start()
+    for task in tasks:
+        queue.put(task)
+    queue.join()
+    for t in workers:
+        queue.put(None)
+    for t in workers:
+        t.join()
+    return results
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# title: bounded pool of job submitters for dsub
+#
+# Every worker thread owns one client (e.g. a Dirac() instance) for the whole
+# run. Jobs are handed over through a bounded queue, so the caller blocks once
+# 'inflight' submissions are pending and can prepare the next job while the
+# previous ones are being submitted. Results come back in submission order.
+import threading, Queue
+
+
+class SubmitPool(object):
+
+    def __init__(self, submitFunc, newClient, workers=1, inflight=0):
+        self.submitFunc = submitFunc
+        self.newClient = newClient
+        self.workers = max(1, workers)
+        self.inflight = max(self.workers, inflight)
+        self.tasks = Queue.Queue(self.inflight)
+        self.results = {}
+        self.done = threading.Condition()
+        self.submitted = 0
+        self.collected = 0
+        self.threads = []
+        for i in range(self.workers):
+            t = threading.Thread(target=self._work, name='submitter-%d' %i)
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+    def _work(self):
+        client = None
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            index, jobPara = task
+            try:
+                if client is None:
+                    client = self.newClient()
+                result = self.submitFunc(jobPara, client)
+            except Exception, e:
+                result = {'OK': False, 'Message': '%s: %s' %(e.__class__.__name__, e)}
+            self.done.acquire()
+            self.results[index] = (jobPara, result)
+            self.done.notifyAll()
+            self.done.release()
+
+    def submit(self, jobPara):
+        # blocks while 'inflight' jobs are already waiting for a submitter
+        self.tasks.put((self.submitted, jobPara))
+        self.submitted += 1
+
+    def ready(self, wait=False):
+        # yield (jobPara, result) in submission order, as far as available
+        while self.collected < self.submitted:
+            self.done.acquire()
+            try:
+                while wait and self.collected not in self.results:
+                    self.done.wait(1.0)
+                if self.collected not in self.results:
+                    return
+                item = self.results.pop(self.collected)
+            finally:
+                self.done.release()
+            self.collected += 1
+            yield item
+
+    def close(self):
+        for t in self.threads:
+            self.tasks.put(None)
+        for item in self.ready(wait=True):
+            yield item
+        for t in self.threads:
+            t.join()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# title: precompiled job file templates for dsub
+#
+# event.macro, simu.macro and reco.xml are compiled once per production into
+# fixed text chunks and named slots. Rendering a job is then a join of the
+# chunks with the slot values, and gives the same bytes as rewriting the
+# macro lines or writing the modified ElementTree for every job.
+from cStringIO import StringIO
+from xml.sax.saxutils import escape
+
+
+def _escapeXML(value):
+    # what ElementTree.write does to element text with the default us-ascii encoding
+    if isinstance(value, str):
+        value = value.decode('utf-8')
+    return escape(value).encode('us-ascii', 'xmlcharrefreplace')
+
+
+class Template(object):
+
+    def __init__(self, chunks, slots, escapeFunc=None):
+        self.chunks = chunks
+        self.slots = slots
+        self.escapeFunc = escapeFunc
+
+    def render(self, values):
+        parts = [self.chunks[0]]
+        for slot, chunk in zip(self.slots, self.chunks[1:]):
+            value = str(values[slot])
+            if self.escapeFunc:
+                value = self.escapeFunc(value)
+            parts.append(value)
+            parts.append(chunk)
+        return ''.join(parts)
+
+
+def compileMacro(lines, rules):
+    """Compile macro lines, where a line starting with one of the prefixes
+    in rules [(prefix, slot)] becomes 'prefix <slot value>'.
+    """
+    chunks = []
+    slots = []
+    current = []
+    for line in lines:
+        for prefix, slot in rules:
+            if line.startswith(prefix):
+                current.append(prefix + ' ')
+                chunks.append(''.join(current))
+                slots.append(slot)
+                current = ['\n']
+                break
+        else:
+            current.append(line)
+    chunks.append(''.join(current))
+    return Template(chunks, slots)
+
+def compileXML(tree, rules):
+    """Compile an ElementTree, where the text of the elements matching the
+    paths in rules [(path, slot)] becomes the slot value.
+    """
+    saved = []
+    tokens = {}
+    for path, slot in rules:
+        for element in tree.findall(path):
+            saved.append((element, element.text))
+            token = '@DSUB_SLOT_%d@' %len(saved)
+            element.text = token
+            tokens[token] = slot
+    buf = StringIO()
+    tree.write(buf)
+    for element, text in saved:
+        element.text = text
+    text = buf.getvalue()
+    chunks = []
+    slots = []
+    while True:
+        positions = [(text.find(token), token) for token in tokens if text.find(token) != -1]
+        if not positions:
+            break
+        pos, token = min(positions)
+        chunks.append(text[:pos])
+        slots.append(tokens[token])
+        text = text[pos + len(token):]
+    chunks.append(text)
+    return Template(chunks, slots, _escapeXML)
+
+def writeFiles(files):
+    # write a batch of rendered (path, text) pairs
+    for path, text in files:
+        f = open(path, 'w')
+        f.write(text)
+        f.close()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# title: tests of the .stdhep slicing of dsub
+# usage: python test_stdhep.py
+#
+# A file is written with stdhep.writeEvent, sliced, and the slices are read
+# back with stdhep.countEvents and stdhep.readRecords.
+import sys, os, os.path, shutil, tempfile, unittest
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import stdhep
+
+
+class SliceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='dsub-test-')
+        self.path = os.path.join(self.root, 'sample.stdhep')
+        # the header expects more events than the file holds, as an unfinished run leaves it
+        f = open(self.path, 'wb')
+        stdhep.writeHeader(f, 100)
+        for evtnum in range(10):
+            stdhep.writeEvent(f, evtnum, 'event %d' %evtnum)
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def slice(self, ranges):
+        outputs = [os.path.join(self.root, 'slices', 'sample.%d-%d.stdhep' %(start, n)) for start, n in ranges]
+        return outputs, stdhep.sliceEvents(self.path, ranges, outputs)
+
+    def eventNumbers(self, path):
+        f = open(path, 'rb')
+        try:
+            return [stdhep._eventNumbers(record)[0] for blockid, record in stdhep.readRecords(f)\
+                    if blockid == stdhep.eventHeaderId]
+        finally:
+            f.close()
+
+    def testRoundTrip(self):
+        outputs, written = self.slice([(0, 4), (4, 4), (8, 4)])
+        self.assertEqual(written, [4, 4, 2])
+        counts = stdhep.countEvents([(path, os.path.getsize(path)) for path in outputs],\
+                                    os.path.join(self.root, 'index'))
+        self.assertEqual([counts[path] for path in outputs], [(4, 'header'), (4, 'header'), (2, 'header')])
+        self.assertEqual([self.eventNumbers(path) for path in outputs], [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
+
+    def testRangePastTheEnd(self):
+        outputs, written = self.slice([(8, 4), (12, 4)])
+        self.assertEqual(written, [2, 0])
+        self.assertEqual(stdhep.readHeader(outputs[1]), (0, 0))
+        self.assertEqual(self.eventNumbers(outputs[1]), [])
+
+    def testUnreadableHeader(self):
+        # a file that fails to be read is estimated, the others are still counted
+        readHeader = stdhep.readHeader
+        def failing(path):
+            if path == self.path:
+                raise IOError('Permission denied')
+            return readHeader(path)
+        outputs, written = self.slice([(0, 4)])
+        stdhep.readHeader = failing
+        try:
+            counts = stdhep.countEvents([(self.path, os.path.getsize(self.path)),\
+                                        (outputs[0], os.path.getsize(outputs[0]))], os.path.join(self.root, 'index'), 1)
+        finally:
+            stdhep.readHeader = readHeader
+        self.assertEqual(counts[self.path][1], 'estimate')
+        self.assertEqual(counts[outputs[0]], (4, 'header'))
+
+
+if __name__ == '__main__':
+    unittest.main()